@@ -1,8 +1,10 @@
 from __future__ import annotations
+import asyncio
 import math
 import os
-from typing import Dict, List
+from typing import Callable, Dict, List
 from langchain_openai import ChatOpenAI
+import openai
 from langchain_core.messages import HumanMessage, SystemMessage
 import numpy as np
 
@@ -26,6 +28,8 @@ class LLMProgramGenerator:
         action_shots: int = 0,
         perception_shots: int = 0,
         program_shots: int = 0,
+        concurrent_requests: int = 1,
+        base_url: str | None = None,
     ) -> None:
         self.seed = seed
         self.task = task
@@ -36,6 +40,14 @@ class LLMProgramGenerator:
         self.model_name = "gpt-4-turbo-2024-04-09"
         self.temperature = temperature
         self.top_p = top_p
+        # Number of requests sent at once, 1 keeps the sequential request -> parse -> retry loop
+        self.concurrent_requests = concurrent_requests
+        # Endpoint of an OpenAI-compatible server, None uses the default API (or OPENAI_BASE_URL)
+        self.base_url = base_url
+        self.max_rate_limit_retries = 6
+        self.rate_limit_delay = 1.0
+        self.chat_model = None
+        self.event_loop = None
 
         self.np_rng = np.random.RandomState(self.seed)
 
@@ -50,30 +62,62 @@ class LLMProgramGenerator:
             self.program_shots,
         )
 
+    def _get_chat_model(self) -> ChatOpenAI:
+        # The client is created once and reused, the number of samples is set per request
+        if self.chat_model is None:
+            self.chat_model = ChatOpenAI(
+                api_key=CHATGPT_KEY,
+                model=self.model_name,
+                temperature=self.temperature,
+                model_kwargs={"top_p": self.top_p},
+                base_url=self.base_url,
+            )
+        return self.chat_model
+
     def _call_llm(
         self,
         system_prompt: str,
         user_prompt: str,
         llm_program_num: int,
     ) -> str | List[str | Dict]:
-        chatgpt = ChatOpenAI(
-            api_key=CHATGPT_KEY,
-            model=self.model_name,
-            temperature=self.temperature,
-            n=llm_program_num,
-            model_kwargs={"top_p": self.top_p},
-        )
-        response = chatgpt.generate(
+        response = self._get_chat_model().generate(
             [
                 [
                     SystemMessage(content=system_prompt),
                     HumanMessage(content=user_prompt),
                 ]
-            ]
+            ],
+            n=llm_program_num,
         ).generations[0]
 
         return list(map(lambda x: x.text, response))
 
+    async def _acall_llm(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        llm_program_num: int,
+    ) -> List[str]:
+        delay = self.rate_limit_delay
+        for retry in range(self.max_rate_limit_retries + 1):
+            try:
+                response = await self._get_chat_model().agenerate(
+                    [
+                        [
+                            SystemMessage(content=system_prompt),
+                            HumanMessage(content=user_prompt),
+                        ]
+                    ],
+                    n=llm_program_num,
+                )
+                return list(map(lambda x: x.text, response.generations[0]))
+            except openai.RateLimitError:
+                if retry == self.max_rate_limit_retries:
+                    raise
+                # Exponential backoff on top of the client's own retries
+                await asyncio.sleep(delay)
+                delay *= 2
+
     def _get_program_list_from_llm_response_python_to_dsl(self, response) -> list[str]:
         program_str_list = []
         for x in response:
@@ -114,55 +158,74 @@ class LLMProgramGenerator:
                 pass
         return program_str_list
 
-    def get_program_list_python_to_dsl(self) -> tuple[list, dict]:
+    def _get_programs_python_to_dsl(self, llm_response: list[str]) -> list[dsl_nodes.Program]:
+        candidates_list = self._get_program_list_from_llm_response_python_to_dsl(llm_response)
+        # The candidates of all responses are parsed as one batch
+        programs = self.dsl.parse_str_batch_to_nodes(
+            [candidate for candidates in candidates_list for candidate in candidates]
+        )
         program_list = []
-        record_list = []
-        attempts = 0
-        program_num = self.llm_program_num
-        while len(program_list) < program_num:
-            attempts += 1
-            seed = self.np_rng.randint(0, 2**32)
-            llm_program_num = math.ceil((program_num - len(program_list)) * self.ratio)
-            system_prompt = self.prompt_generator.get_system_prompt_python_to_dsl()
-            user_prompt = self.prompt_generator.get_user_prompt_python_to_dsl()
-            llm_response = self._call_llm(system_prompt, user_prompt, llm_program_num)
-            program_str_list = self._get_program_list_from_llm_response_python_to_dsl(llm_response)
-            for candidates in program_str_list:
-                tmp = []
-                for candidate in candidates:
-                    try:
-                        program = self.dsl.parse_str_to_node(candidate)
-                        tmp.append(program)
-                    except:
-                        pass
-                if len(tmp) > 0:
-                    program_list.append(self.np_rng.choice(tmp))
-                    
-            available_program_num = len(program_list)
-            print(f"Attempts: {attempts}, Program_nums: {available_program_num}")
-            
-            if len(program_list) > program_num:
-                program_list = program_list[:program_num]
-            program_str_list = [self.dsl.parse_node_to_str(program) for program in program_list]
-            
-            record_list.append(
-                {
-                    "seed": seed,
-                    "temperature": self.temperature,
-                    "top_p": self.top_p,
-                    "system_prompt": system_prompt,
-                    "user_prompt": user_prompt,
-                    "llm_response": llm_response,
-                    "available_program_num": available_program_num,
-                    "program_str_list": program_str_list,
-                }
-            )
+        start = 0
+        for candidates in candidates_list:
+            tmp = [program for program in programs[start:start + len(candidates)] if program is not None]
+            start += len(candidates)
+            if len(tmp) > 0:
+                program_list.append(self.np_rng.choice(tmp))
+        return program_list
 
-        log = {"attemps": attempts, "record_list": record_list}
+    def _get_programs_python(self, llm_response: list[str]) -> list[dsl_nodes.Program]:
+        program_strs = self._get_program_list_from_llm_response_python(llm_response)
+        return [program for program in self.dsl.parse_str_batch_to_nodes(program_strs) if program is not None]
+
+    def _get_programs_dsl(self, llm_response: list[str]) -> list[dsl_nodes.Program]:
+        program_strs = self._get_program_list_from_llm_response_dsl(llm_response)
+        return [program for program in self.dsl.parse_str_batch_to_nodes(program_strs) if program is not None]
+
+    def _record_response(
+        self,
+        program_list: list[dsl_nodes.Program],
+        record_list: list[dict],
+        attempts: int,
+        seed: int,
+        system_prompt: str,
+        user_prompt: str,
+        llm_response: list[str],
+    ) -> list[dsl_nodes.Program]:
+        available_program_num = len(program_list)
+        print(f"Attempts: {attempts}, Program_nums: {available_program_num}")
+
+        if len(program_list) > self.llm_program_num:
+            program_list = program_list[:self.llm_program_num]
+        program_str_list = [self.dsl.parse_node_to_str(program) for program in program_list]
+
+        record_list.append(
+            {
+                "seed": seed,
+                "temperature": self.temperature,
+                "top_p": self.top_p,
+                "system_prompt": system_prompt,
+                "user_prompt": user_prompt,
+                "llm_response": llm_response,
+                "available_program_num": available_program_num,
+                "program_str_list": program_str_list,
+            }
+        )
+        return program_list
+
+    def _generate_program_list(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        get_programs: Callable[[list[str]], list[dsl_nodes.Program]],
+    ) -> tuple[list[dsl_nodes.Program], dict]:
+        if self.concurrent_requests > 1:
+            # A single event loop is kept so the async client stays bound to it
+            if self.event_loop is None:
+                self.event_loop = asyncio.new_event_loop()
+            return self.event_loop.run_until_complete(
+                self._agenerate_program_list(system_prompt, user_prompt, get_programs)
+            )
 
-        return program_list, log
-    
-    def get_program_list_python(self) -> tuple[list, dict]:
         program_list = []
         record_list = []
         attempts = 0
@@ -171,284 +234,103 @@ class LLMProgramGenerator:
             attempts += 1
             seed = self.np_rng.randint(0, 2**32)
             llm_program_num = math.ceil((program_num - len(program_list)) * self.ratio)
-            system_prompt = self.prompt_generator.get_system_prompt_python()
-            user_prompt = self.prompt_generator.get_user_prompt_python()
             llm_response = self._call_llm(system_prompt, user_prompt, llm_program_num)
-            program_str_list = self._get_program_list_from_llm_response_python(llm_response)
-            for program_str in program_str_list:
-                try:
-                    program = self.dsl.parse_str_to_node(program_str)
-                    program_list.append(program)
-                except:
-                    pass
-                
-            available_program_num = len(program_list)
-            print(f"Attempts: {attempts}, Program_nums: {available_program_num}")
-            
-            if len(program_list) > program_num:
-                program_list = program_list[:program_num]
-            program_str_list = [self.dsl.parse_node_to_str(program) for program in program_list]
-            
-            record_list.append(
-                {
-                    "seed": seed,
-                    "temperature": self.temperature,
-                    "top_p": self.top_p,
-                    "system_prompt": system_prompt,
-                    "user_prompt": user_prompt,
-                    "llm_response": llm_response,
-                    "available_program_num": available_program_num,
-                    "program_str_list": program_str_list,
-                }
+            program_list += get_programs(llm_response)
+            program_list = self._record_response(
+                program_list, record_list, attempts, seed, system_prompt, user_prompt, llm_response
             )
 
         log = {"attemps": attempts, "record_list": record_list}
 
         return program_list, log
-    
-    def get_program_list_dsl(self) -> tuple[list, dict]:
+
+    async def _agenerate_program_list(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        get_programs: Callable[[list[str]], list[dsl_nodes.Program]],
+    ) -> tuple[list[dsl_nodes.Program], dict]:
         program_list = []
         record_list = []
         attempts = 0
         program_num = self.llm_program_num
         while len(program_list) < program_num:
-            attempts += 1
-            seed = self.np_rng.randint(0, 2**32)
+            # Split the samples still needed across concurrent requests
             llm_program_num = math.ceil((program_num - len(program_list)) * self.ratio)
-            system_prompt = self.prompt_generator.get_system_prompt_dsl()
-            user_prompt = self.prompt_generator.get_user_prompt_dsl()
-            llm_response = self._call_llm(system_prompt, user_prompt, llm_program_num)
-            program_str_list = self._get_program_list_from_llm_response_dsl(llm_response)
-            for program_str in program_str_list:
-                try:
-                    program = self.dsl.parse_str_to_node(program_str)
-                    program_list.append(program)
-                except:
-                    pass
-            
-            available_program_num = len(program_list)
-            print(f"Attempts: {attempts}, Program_nums: {available_program_num}")
-            
-            if len(program_list) > program_num:
-                program_list = program_list[:program_num]
-            program_str_list = [self.dsl.parse_node_to_str(program) for program in program_list]    
-            
-            record_list.append(
-                {
-                    "seed": seed,
-                    "temperature": self.temperature,
-                    "top_p": self.top_p,
-                    "system_prompt": system_prompt,
-                    "user_prompt": user_prompt,
-                    "llm_response": llm_response,
-                    "available_program_num": available_program_num,
-                    "program_str_list": program_str_list,
-                }
-            )
+            num_requests = min(self.concurrent_requests, llm_program_num)
+            requests = [
+                asyncio.ensure_future(self._acall_llm(
+                    system_prompt, user_prompt,
+                    llm_program_num // num_requests + (i < llm_program_num % num_requests)
+                ))
+                for i in range(num_requests)
+            ]
+            try:
+                # Responses are parsed in request order while the later requests are still running,
+                # so the programs do not depend on which request completes first
+                for request in requests:
+                    if len(program_list) >= program_num:
+                        break
+                    llm_response = await request
+                    attempts += 1
+                    seed = self.np_rng.randint(0, 2**32)
+                    program_list += get_programs(llm_response)
+                    program_list = self._record_response(
+                        program_list, record_list, attempts, seed, system_prompt, user_prompt, llm_response
+                    )
+            finally:
+                # Stop the requests that are no longer needed
+                for request in requests:
+                    request.cancel()
+                await asyncio.gather(*requests, return_exceptions=True)
 
         log = {"attemps": attempts, "record_list": record_list}
 
         return program_list, log
 
+    def get_program_list_python_to_dsl(self) -> tuple[list, dict]:
+        system_prompt = self.prompt_generator.get_system_prompt_python_to_dsl()
+        user_prompt = self.prompt_generator.get_user_prompt_python_to_dsl()
+        return self._generate_program_list(system_prompt, user_prompt, self._get_programs_python_to_dsl)
+
+    def get_program_list_python(self) -> tuple[list, dict]:
+        system_prompt = self.prompt_generator.get_system_prompt_python()
+        user_prompt = self.prompt_generator.get_user_prompt_python()
+        return self._generate_program_list(system_prompt, user_prompt, self._get_programs_python)
+
+    def get_program_list_dsl(self) -> tuple[list, dict]:
+        system_prompt = self.prompt_generator.get_system_prompt_dsl()
+        user_prompt = self.prompt_generator.get_user_prompt_dsl()
+        return self._generate_program_list(system_prompt, user_prompt, self._get_programs_dsl)
+
     def get_program_list_revision_regeneration_with_reward(
         self,
         progs_rewards: list[dsl_nodes.Program, float]
     ):
-        program_list = []
-        record_list = []
-        attempts = 0
-        program_num = self.llm_program_num
-        while len(program_list) < program_num:
-            attempts += 1
-            seed = self.np_rng.randint(0, 2**32)
-            llm_program_num = math.ceil((program_num - len(program_list)) * self.ratio)
-            system_prompt = self.prompt_generator.get_system_prompt_python_to_dsl()
-            user_prompt = self.prompt_generator.get_user_prompt_revision_regeneration_with_reward(progs_rewards, self.dsl)
-            llm_response = self._call_llm(system_prompt, user_prompt, llm_program_num)
-            program_str_list = self._get_program_list_from_llm_response_python_to_dsl(llm_response)
-            for candidates in program_str_list:
-                tmp = []
-                for candidate in candidates:
-                    try:
-                        program = self.dsl.parse_str_to_node(candidate)
-                        tmp.append(program)
-                    except:
-                        pass
-                if len(tmp) > 0:
-                    program_list.append(self.np_rng.choice(tmp))
-            
-            available_program_num = len(program_list)
-            print(f"Attempts: {attempts}, Program_nums: {available_program_num}")
-            
-            if len(program_list) > program_num:
-                program_list = program_list[:program_num]
-            program_str_list = [self.dsl.parse_node_to_str(program) for program in program_list]  
-            
-            record_list.append(
-                {
-                    "seed": seed,
-                    "temperature": self.temperature,
-                    "top_p": self.top_p,
-                    "system_prompt": system_prompt,
-                    "user_prompt": user_prompt,
-                    "llm_response": llm_response,
-                    "available_program_num": available_program_num,
-                    "program_str_list": program_str_list,
-                }
-            )
-
-        log = {"attemps": attempts, "record_list": record_list}
-
-        return program_list, log
+        system_prompt = self.prompt_generator.get_system_prompt_python_to_dsl()
+        user_prompt = self.prompt_generator.get_user_prompt_revision_regeneration_with_reward(progs_rewards, self.dsl)
+        return self._generate_program_list(system_prompt, user_prompt, self._get_programs_python_to_dsl)
 
     def get_program_list_revision_regeneration(
         self,
         previous_program_list: List[dsl_nodes.Program],
     ):
-        program_list = []
-        record_list = []
-        attempts = 0
-        program_num = self.llm_program_num
-        while len(program_list) < program_num:
-            attempts += 1
-            seed = self.np_rng.randint(0, 2**32)
-            llm_program_num = math.ceil((program_num - len(program_list)) * self.ratio)
-            system_prompt = self.prompt_generator.get_system_prompt_python_to_dsl()
-            user_prompt = self.prompt_generator.get_user_prompt_revision_regeneration(previous_program_list, self.dsl)
-            llm_response = self._call_llm(system_prompt, user_prompt, llm_program_num)
-            program_str_list = self._get_program_list_from_llm_response_python_to_dsl(llm_response)
-            for candidates in program_str_list:
-                tmp = []
-                for candidate in candidates:
-                    try:
-                        program = self.dsl.parse_str_to_node(candidate)
-                        tmp.append(program)
-                    except:
-                        pass
-                if len(tmp) > 0:
-                    program_list.append(self.np_rng.choice(tmp))
-            
-            available_program_num = len(program_list)
-            print(f"Attempts: {attempts}, Program_nums: {available_program_num}")
-            
-            if len(program_list) > program_num:
-                program_list = program_list[:program_num]
-            program_str_list = [self.dsl.parse_node_to_str(program) for program in program_list]  
-            
-            record_list.append(
-                {
-                    "seed": seed,
-                    "temperature": self.temperature,
-                    "top_p": self.top_p,
-                    "system_prompt": system_prompt,
-                    "user_prompt": user_prompt,
-                    "llm_response": llm_response,
-                    "available_program_num": available_program_num,
-                    "program_str_list": program_str_list,
-                }
-            )
+        system_prompt = self.prompt_generator.get_system_prompt_python_to_dsl()
+        user_prompt = self.prompt_generator.get_user_prompt_revision_regeneration(previous_program_list, self.dsl)
+        return self._generate_program_list(system_prompt, user_prompt, self._get_programs_python_to_dsl)
 
-        log = {"attemps": attempts, "record_list": record_list}
-
-        return program_list, log
-    
     def get_program_list_revision_agent_execution_trace(
         self,
         reward: float, logs: list[dict[str, str]], average_reward: float,
     ) -> tuple[list[dsl_nodes.Program], dict]:
-        program_list = []
-        record_list = []
-        attempts = 0
-        program_num = self.llm_program_num
-        while len(program_list) < program_num:
-            attempts += 1
-            seed = self.np_rng.randint(0, 2**32)
-            llm_program_num = math.ceil((program_num - len(program_list)) * self.ratio)
-            system_prompt = self.prompt_generator.get_system_prompt_python_to_dsl()
-            user_prompt = self.prompt_generator.get_user_prompt_revision_agent_execution_trace(reward, logs, average_reward)
-            llm_response = self._call_llm(system_prompt, user_prompt, llm_program_num)
-            program_str_list = self._get_program_list_from_llm_response_python_to_dsl(llm_response)
-            for candidates in program_str_list:
-                tmp = []
-                for candidate in candidates:
-                    try:
-                        program = self.dsl.parse_str_to_node(candidate)
-                        tmp.append(program)
-                    except:
-                        pass
-                if len(tmp) > 0:
-                    program_list.append(self.np_rng.choice(tmp))
-            
-            available_program_num = len(program_list)
-            print(f"Attempts: {attempts}, Program_nums: {available_program_num}")
-            
-            if len(program_list) > program_num:
-                program_list = program_list[:program_num]
-            program_str_list = [self.dsl.parse_node_to_str(program) for program in program_list]  
-            
-            record_list.append(
-                {
-                    "seed": seed,
-                    "temperature": self.temperature,
-                    "top_p": self.top_p,
-                    "system_prompt": system_prompt,
-                    "user_prompt": user_prompt,
-                    "llm_response": llm_response,
-                    "available_program_num": available_program_num,
-                    "program_str_list": program_str_list,
-                }
-            )
+        system_prompt = self.prompt_generator.get_system_prompt_python_to_dsl()
+        user_prompt = self.prompt_generator.get_user_prompt_revision_agent_execution_trace(reward, logs, average_reward)
+        return self._generate_program_list(system_prompt, user_prompt, self._get_programs_python_to_dsl)
 
-        log = {"attemps": attempts, "record_list": record_list}
-
-        return program_list, log
-    
     def get_program_list_revision_agent_program_execution_trace(
         self,
         reward: float, logs: list[dict[str, str]], average_reward: float,
     ) -> tuple[list[dsl_nodes.Program], dict]:
-        program_list = []
-        record_list = []
-        attempts = 0
-        program_num = self.llm_program_num
-        while len(program_list) < program_num:
-            attempts += 1
-            seed = self.np_rng.randint(0, 2**32)
-            llm_program_num = math.ceil((program_num - len(program_list)) * self.ratio)
-            system_prompt = self.prompt_generator.get_system_prompt_python_to_dsl()
-            user_prompt = self.prompt_generator.get_user_prompt_revision_agent_program_execution_trace(reward, logs, average_reward)
-            llm_response = self._call_llm(system_prompt, user_prompt, llm_program_num)
-            program_str_list = self._get_program_list_from_llm_response_python_to_dsl(llm_response)
-            for candidates in program_str_list:
-                tmp = []
-                for candidate in candidates:
-                    try:
-                        program = self.dsl.parse_str_to_node(candidate)
-                        tmp.append(program)
-                    except:
-                        pass
-                if len(tmp) > 0:
-                    program_list.append(self.np_rng.choice(tmp))
-            
-            available_program_num = len(program_list)
-            print(f"Attempts: {attempts}, Program_nums: {available_program_num}")
-            
-            if len(program_list) > program_num:
-                program_list = program_list[:program_num]
-            program_str_list = [self.dsl.parse_node_to_str(program) for program in program_list]  
-            
-            record_list.append(
-                {
-                    "seed": seed,
-                    "temperature": self.temperature,
-                    "top_p": self.top_p,
-                    "system_prompt": system_prompt,
-                    "user_prompt": user_prompt,
-                    "llm_response": llm_response,
-                    "available_program_num": available_program_num,
-                    "program_str_list": program_str_list,
-                }
-            )
-        log = {"attemps": attempts, "record_list": record_list}
-        return program_list, log
-    
+        system_prompt = self.prompt_generator.get_system_prompt_python_to_dsl()
+        user_prompt = self.prompt_generator.get_user_prompt_revision_agent_program_execution_trace(reward, logs, average_reward)
+        return self._generate_program_list(system_prompt, user_prompt, self._get_programs_python_to_dsl)
@@ -155,13 +155,7 @@ def indent_python_to_str(code: str) -> str:
 
 
 def parse_program_str_list(program_str_list: list[str], dsl: BaseDSL) -> list[dsl_nodes.Program]:
-    program_list = []
-    for program_str in program_str_list:
-        try:
-            program_list.append(dsl.parse_str_to_node(program_str))
-        except:
-            pass
-    return program_list
+    return [program for program in dsl.parse_str_batch_to_nodes(program_str_list) if program is not None]
 
 def get_program_str_from_llm_response_python(llm_response, env_name="karel"):
     result = re.findall("```python.*?```", llm_response, flags=re.DOTALL)[0]
@@ -1,3 +1,8 @@
 from .dsl import BaseDSL
-from .environment import BaseEnvironment
-from .task import BaseTask
\ No newline at end of file
+from .environment import BaseEnvironment, EnvironmentListener
+from .task import BaseTask
+from .compiler import CompiledProgram, compile_program
+from .sampler import ProgramSampler
+from .subtree_table import SubtreeTable
+from .normalizer import ProgramNormalizer
+from .analyzer import ProgramAnalyzer
@@ -0,0 +1,127 @@
+from __future__ import annotations
+from typing import Union
+
+from . import dsl_nodes
+from .compiler import CompiledProgram
+from .task import BaseTask
+
+# Outcomes of the execution of a program until its first action, besides the name of that action
+_FINISHED = 0  # The program ends without running an action
+_CRASHED = 1  # The environment crashes before the first action (loop detection or max_calls)
+
+
+class ProgramAnalyzer:
+    """Proves the episodic return of programs from the initial state of the tasks, without running
+    them.
+
+    Until its first action, a program queries features of the initial state only, so its control flow
+    is decided by the value of its conditions in that state, computed once per task. Programs that end,
+    or crash in a WHILE that runs no action, before their first action get a return of 0. Programs whose
+    first action ends the episode (e.g. pickMarker on a cell without markers in a crashable environment)
+    get the reward of that step, also computed once per task and action.
+
+    Only seeded BaseTask environments are analyzed, the episodes of other tasks are not reproducible.
+    """
+
+    def __init__(self):
+        # Evaluations replaced by a proven return and evaluations cut off by a proven upper bound
+        self.skipped = 0
+        self.bounded = 0
+        self.conditions: dict[tuple, tuple[bool, int]] = {}
+        self.first_steps: dict[tuple[BaseTask, str], tuple[bool, float]] = {}
+
+    def get_env_rewards(self, program: Union[dsl_nodes.Program, CompiledProgram],
+                        task_envs: list[BaseTask]) -> Union[list[Union[float, None]], None]:
+        """Episodic return of the program in each task environment, None where it is not proven
+
+        Args:
+            program (Union[dsl_nodes.Program, CompiledProgram]): Program to analyze
+            task_envs (list[BaseTask]): List of task environments
+
+        Returns:
+            Union[list[Union[float, None]], None]: Returns, or None if the tasks can not be analyzed
+        """
+        if not all(isinstance(task_env, BaseTask) and task_env.seed is not None for task_env in task_envs):
+            return None
+        if isinstance(program, CompiledProgram):
+            program = program.program
+        rewards = []
+        for task_env in task_envs:
+            outcome, calls = self._run(program.children[0], task_env, 0)
+            if outcome is None:
+                rewards.append(None)
+            elif outcome == _FINISHED or outcome == _CRASHED:
+                rewards.append(0.)
+            elif calls + 1 > task_env.environment.max_calls:
+                # The first action is the one that exceeds max_calls
+                rewards.append(None)
+            else:
+                ended, reward = self._get_first_step(task_env, outcome)
+                rewards.append(reward if ended else None)
+        return rewards
+
+    def _run(self, node: dsl_nodes.BaseNode, task_env: BaseTask, calls: int) -> tuple[Union[int, str, None], int]:
+        # Follows the execution of node from the initial state, returns the outcome (None if unknown)
+        # and the number of calls so far
+        if calls > task_env.environment.max_calls:
+            return _CRASHED, calls
+        if isinstance(node, dsl_nodes.Action):
+            return node.name, calls
+        if isinstance(node, dsl_nodes.Concatenate):
+            outcome, calls = self._run(node.children[0], task_env, calls)
+            if outcome != _FINISHED:
+                return outcome, calls
+            return self._run(node.children[1], task_env, calls)
+        if isinstance(node, dsl_nodes.Repeat):
+            if not isinstance(node.children[0], dsl_nodes.ConstInt):
+                return None, calls
+            for _ in range(node.children[0].value):
+                outcome, calls = self._run(node.children[1], task_env, calls)
+                if outcome != _FINISHED:
+                    return outcome, calls
+            return _FINISHED, calls
+        if isinstance(node, dsl_nodes.If) or isinstance(node, dsl_nodes.ITE):
+            value, calls = self._interpret(node.children[0], task_env, calls)
+            if value:
+                return self._run(node.children[1], task_env, calls)
+            if isinstance(node, dsl_nodes.ITE):
+                return self._run(node.children[2], task_env, calls)
+            return _FINISHED, calls
+        if isinstance(node, dsl_nodes.While):
+            value, calls = self._interpret(node.children[0], task_env, calls)
+            if not value:
+                return _FINISHED, calls
+            outcome, calls = self._run(node.children[1], task_env, calls)
+            if outcome != _FINISHED:
+                return outcome, calls
+            # Without actions the state is the same, the condition holds again and the loop is detected
+            _, calls = self._interpret(node.children[0], task_env, calls)
+            return _CRASHED, calls
+        return None, calls
+
+    def _interpret(self, node: dsl_nodes.BaseNode, task_env: BaseTask, calls: int) -> tuple[bool, int]:
+        key = (task_env,) + self._get_condition_key(node)
+        if key not in self.conditions:
+            task_env.reset_environment()
+            environment = task_env.get_environment()
+            initial_calls = environment.num_calls
+            value = bool(node.interpret(environment))
+            self.conditions[key] = (value, environment.num_calls - initial_calls)
+        value, condition_calls = self.conditions[key]
+        return value, calls + condition_calls
+
+    def _get_condition_key(self, node: dsl_nodes.BaseNode) -> tuple:
+        key = node.get_label()
+        for child in node.children:
+            key += self._get_condition_key(child)
+        return key
+
+    def _get_first_step(self, task_env: BaseTask, action: str) -> tuple[bool, float]:
+        # Whether the episode ends after running action in the initial state, and the reward of that step
+        if (task_env, action) not in self.first_steps:
+            task_env.reset_environment()
+            environment = task_env.get_environment()
+            environment.run_action(action)
+            terminated, reward = task_env.get_reward(environment)
+            self.first_steps[(task_env, action)] = (terminated or environment.is_crashed(), reward)
+        return self.first_steps[(task_env, action)]
@@ -0,0 +1,427 @@
+from __future__ import annotations
+from typing import Any, Callable, Generator, Union
+
+import numpy as np
+
+from .environment import BaseEnvironment
+from .dsl_nodes import dsl_nodes
+from .subtree_table import SubtreeTable
+
+# Opcodes of the flat instruction list. Every instruction is a tuple whose first element is the
+# opcode, the remaining elements depend on the opcode:
+# (ACTION, action_name, action_node)
+# (JUMP, target)
+# (IF, feature_name, negated, false_target)
+# (IF_NODE, bool_node, false_target)
+# (WHILE, feature_name, negated, exit_target, loop_slot)
+# (WHILE_NODE, bool_node, exit_target, loop_slot)
+# (REPEAT_INIT, times, repeat_slot)  -- times is an int or an IntNode
+# (REPEAT, repeat_slot, exit_target)
+# (CHECKPOINT, paths)  -- only in programs compiled with record_checkpoints, see BaseTask.record_checkpoints
+ACTION = 0
+JUMP = 1
+IF = 2
+IF_NODE = 3
+WHILE = 4
+WHILE_NODE = 5
+REPEAT_INIT = 6
+REPEAT = 7
+CHECKPOINT = 8
+
+
+class CompiledProgram:
+    """Program lowered into a flat list of instructions, executed by a single dispatch loop.
+
+    The interpreter reproduces the semantics of Program.run_generator: it yields every executed
+    Action node, While loops crash the environment when they revisit a state and execution stops
+    once the environment is crashed.
+    """
+
+    def __init__(self, program: dsl_nodes.Program, record_checkpoints: bool = False):
+        assert program.is_complete(), "Incomplete Program"
+        self.program = program
+        self.record_checkpoints = record_checkpoints
+        self.instructions: list[tuple] = []
+        self.num_loops = 0
+        self.num_repeats = 0
+        # Nodes are identified by their AST path (child indices from the Program node), which stays
+        # the same in a mutated copy of the program outside of the mutated subtree
+        self.entries: dict[tuple[int, ...], int] = {}
+        self.loop_paths: list[tuple[int, ...]] = []
+        self.repeat_paths: list[tuple[int, ...]] = []
+        self._compile_statement(program.children[0], (0,))
+
+    # Returns (feature_name, negated) if the condition is a plain environment feature, None otherwise
+    @staticmethod
+    def _simple_condition(node: dsl_nodes.BaseNode) -> Union[tuple[str, bool], None]:
+        if type(node) == dsl_nodes.BoolFeature:
+            return node.name, False
+        if type(node) == dsl_nodes.Not and type(node.children[0]) == dsl_nodes.BoolFeature:
+            return node.children[0].name, True
+        return None
+
+    def _compile_statement(self, node: dsl_nodes.BaseNode, path: tuple[int, ...]) -> None:
+        code = self.instructions
+        if self.record_checkpoints:
+            # Statements starting at the same instruction (e.g. a Concatenate and its first child)
+            # share a single checkpoint
+            if len(code) > 0 and code[-1] is not None and code[-1][0] == CHECKPOINT:
+                code[-1] = (CHECKPOINT, code[-1][1] + (path,))
+                self.entries[path] = len(code) - 1
+            else:
+                self.entries[path] = len(code)
+                code.append((CHECKPOINT, (path,)))
+        else:
+            self.entries[path] = len(code)
+        if isinstance(node, dsl_nodes.Concatenate):
+            self._compile_statement(node.children[0], path + (0,))
+            self._compile_statement(node.children[1], path + (1,))
+        elif isinstance(node, dsl_nodes.Action):
+            code.append((ACTION, node.name, node))
+        elif isinstance(node, (dsl_nodes.If, dsl_nodes.ITE)):
+            condition = self._simple_condition(node.children[0])
+            branch_index = len(code)
+            code.append(None)
+            self._compile_statement(node.children[1], path + (1,))
+            if isinstance(node, dsl_nodes.ITE):
+                jump_index = len(code)
+                code.append(None)
+                false_target = len(code)
+                self._compile_statement(node.children[2], path + (2,))
+                code[jump_index] = (JUMP, len(code))
+            else:
+                false_target = len(code)
+            if condition is not None:
+                code[branch_index] = (IF, condition[0], condition[1], false_target)
+            else:
+                code[branch_index] = (IF_NODE, node.children[0], false_target)
+        elif isinstance(node, dsl_nodes.While):
+            condition = self._simple_condition(node.children[0])
+            slot = self.num_loops
+            self.num_loops += 1
+            self.loop_paths.append(path)
+            loop_index = len(code)
+            code.append(None)
+            self._compile_statement(node.children[1], path + (1,))
+            code.append((JUMP, loop_index))
+            exit_target = len(code)
+            if condition is not None:
+                code[loop_index] = (WHILE, condition[0], condition[1], exit_target, slot)
+            else:
+                code[loop_index] = (WHILE_NODE, node.children[0], exit_target, slot)
+        elif isinstance(node, dsl_nodes.Repeat):
+            slot = self.num_repeats
+            self.num_repeats += 1
+            self.repeat_paths.append(path)
+            times = node.children[0]
+            if type(times) == dsl_nodes.ConstInt:
+                times = int(times.value)
+            code.append((REPEAT_INIT, times, slot))
+            loop_index = len(code)
+            code.append(None)
+            self._compile_statement(node.children[1], path + (1,))
+            code.append((JUMP, loop_index))
+            code[loop_index] = (REPEAT, slot, len(code))
+        else:
+            raise Exception(f'Unsupported node in compilation: {type(node).__name__}')
+
+    def run_generator(self, env, frame: Union[tuple[int, list[int], list[set]], None] = None,
+                      recorder: Union[Callable[[tuple, list[int], list[set]], None], None] = None
+                      ) -> Generator[dsl_nodes.Action, None, None]:
+        """Runs the program in env, yielding every executed Action node
+
+        Args:
+            env: Environment
+            frame (tuple, optional): Interpreter state (pc, repeat counters, While visited states) to
+            resume from, see get_frame. Defaults to None (start of the program).
+            recorder (Callable, optional): Called with (paths, repeat counters, While visited states)
+            at every checkpoint of a program compiled with record_checkpoints. Defaults to None.
+        """
+        # Environments that keep the default call counting of BaseEnvironment get a loop with the
+        # bookkeeping inlined, everything else (e.g. Minigrid wrappers) goes through the env API
+        env_type = type(env)
+        if isinstance(env, BaseEnvironment) \
+                and env_type.run_action is BaseEnvironment.run_action \
+                and env_type.get_bool_feature is BaseEnvironment.get_bool_feature \
+                and env_type.is_crashed is BaseEnvironment.is_crashed:
+            return self._run_base_environment(env, frame, recorder)
+        return self._run_generic(env, frame, recorder)
+
+    def get_frame(self, path: tuple[int, ...], loop_states: dict[tuple[int, ...], set],
+                  repeat_counters: dict[tuple[int, ...], int]) -> tuple[int, list[int], list[set]]:
+        """Interpreter state that starts executing the statement at path, with the visited states of
+        While loops and the counters of Repeat loops given by node path (missing loops start empty)"""
+        seen_hashes = [set(loop_states[loop_path]) if loop_path in loop_states else set()
+                       for loop_path in self.loop_paths]
+        counters = [repeat_counters.get(repeat_path, 0) for repeat_path in self.repeat_paths]
+        return self.entries[path], counters, seen_hashes
+
+    def get_statement_path(self, path: tuple[int, ...]) -> Union[tuple[int, ...], None]:
+        # Conditions and repeat counts are evaluated by the statement that owns them
+        while path not in self.entries:
+            if len(path) == 0:
+                return None
+            path = path[:-1]
+        return path
+
+    def _run_base_environment(self, env: BaseEnvironment, frame=None, recorder=None):
+        code = self.instructions
+        code_length = len(code)
+        actions = env.actions
+        features = env.bool_features
+        max_calls = env.max_calls
+        calls = env.num_calls
+        if frame is None:
+            seen_hashes = [set() for _ in range(self.num_loops)]
+            counters = [0] * self.num_repeats
+            pc = 0
+        else:
+            pc, counters, seen_hashes = frame
+        while pc < code_length:
+            instruction = code[pc]
+            op = instruction[0]
+            if op == ACTION:
+                if env.crashed:
+                    break
+                calls += 1
+                if calls > max_calls:
+                    env.crashed = True
+                actions[instruction[1]]()
+                env.num_calls = calls
+                yield instruction[2]
+                pc += 1
+            elif op == IF:
+                calls += 1
+                if calls > max_calls:
+                    env.crashed = True
+                if features[instruction[1]]() != instruction[2]:
+                    pc += 1
+                else:
+                    pc = instruction[3]
+            elif op == WHILE:
+                calls += 1
+                if calls > max_calls:
+                    env.crashed = True
+                if features[instruction[1]]() != instruction[2]:
+                    env_hash = env.state_fingerprint()
+                    loop_hashes = seen_hashes[instruction[4]]
+                    # If we have seen this state previously, we're in an infinite loop
+                    if env_hash in loop_hashes:
+                        env.crash()
+                    loop_hashes.add(env_hash)
+                    if env.crashed:
+                        break
+                    pc += 1
+                else:
+                    pc = instruction[3]
+            elif op == JUMP:
+                pc = instruction[1]
+            elif op == REPEAT:
+                slot = instruction[1]
+                if counters[slot] > 0:
+                    counters[slot] -= 1
+                    pc += 1
+                else:
+                    pc = instruction[2]
+            elif op == REPEAT_INIT:
+                times = instruction[1]
+                if type(times) != int:
+                    env.num_calls = calls
+                    times = times.interpret(env)
+                    calls = env.num_calls
+                counters[instruction[2]] = times
+                pc += 1
+            elif op == CHECKPOINT:
+                env.num_calls = calls
+                if recorder is not None:
+                    recorder(instruction[1], counters, seen_hashes)
+                pc += 1
+            else:
+                # Generic conditions read the counter from the environment
+                env.num_calls = calls
+                condition = instruction[1].interpret(env)
+                calls = env.num_calls
+                if op == IF_NODE:
+                    pc = pc + 1 if condition else instruction[2]
+                elif condition:
+                    env_hash = env.state_fingerprint()
+                    loop_hashes = seen_hashes[instruction[3]]
+                    if env_hash in loop_hashes:
+                        env.crash()
+                    loop_hashes.add(env_hash)
+                    if env.crashed:
+                        break
+                    pc += 1
+                else:
+                    pc = instruction[2]
+        env.num_calls = calls
+
+    def _run_generic(self, env, frame=None, recorder=None):
+        code = self.instructions
+        code_length = len(code)
+        if frame is None:
+            seen_hashes = [set() for _ in range(self.num_loops)]
+            counters = [0] * self.num_repeats
+            pc = 0
+        else:
+            pc, counters, seen_hashes = frame
+        while pc < code_length:
+            instruction = code[pc]
+            op = instruction[0]
+            if op == ACTION:
+                if env.is_crashed():
+                    return
+                env.run_action(instruction[1])
+                yield instruction[2]
+                pc += 1
+            elif op == JUMP:
+                pc = instruction[1]
+            elif op == REPEAT:
+                slot = instruction[1]
+                if counters[slot] > 0:
+                    counters[slot] -= 1
+                    pc += 1
+                else:
+                    pc = instruction[2]
+            elif op == REPEAT_INIT:
+                times = instruction[1]
+                if type(times) != int:
+                    times = times.interpret(env)
+                counters[instruction[2]] = times
+                pc += 1
+            elif op == CHECKPOINT:
+                if recorder is not None:
+                    recorder(instruction[1], counters, seen_hashes)
+                pc += 1
+            else:
+                if op == IF or op == WHILE:
+                    condition = bool(env.get_bool_feature(instruction[1])) != instruction[2]
+                    target, slot = instruction[3], instruction[-1]
+                else:
+                    condition = instruction[1].interpret(env)
+                    target, slot = instruction[2], instruction[-1]
+                if op == IF or op == IF_NODE:
+                    pc = pc + 1 if condition else target
+                elif condition:
+                    env_hash = env.state_fingerprint()
+                    loop_hashes = seen_hashes[slot]
+                    if env_hash in loop_hashes:
+                        env.crash()
+                    loop_hashes.add(env_hash)
+                    if env.is_crashed():
+                        return
+                    pc += 1
+                else:
+                    pc = target
+
+    def supports_batch(self) -> bool:
+        # Batched execution only handles plain feature conditions and constant repeats
+        for instruction in self.instructions:
+            if instruction[0] in (IF_NODE, WHILE_NODE, CHECKPOINT):
+                return False
+            if instruction[0] == REPEAT_INIT and type(instruction[1]) != int:
+                return False
+        return True
+
+    def run_batch(self, env: Any, get_batch_reward: Callable[[Any, np.ndarray], tuple[np.ndarray, np.ndarray]]) -> np.ndarray:
+        """Runs the program in every lane of a batched environment (see BaseEnvironment.stack).
+
+        Each lane has its own program counter; at every step the lanes sharing the smallest program
+        counter execute the instruction together. Lanes are independent, so the result of each lane is
+        the same as running the program on that environment alone.
+
+        Args:
+            env: Batched environment, with per-lane crashed and num_calls arrays
+            get_batch_reward (Callable): Receives the environment and the lanes that just executed an
+            action, returns their (terminated, reward) arrays
+
+        Returns:
+            np.ndarray: Episodic return of each lane
+        """
+        assert self.supports_batch(), "Program cannot be executed in batch"
+        code = self.instructions
+        code_length = len(code)
+        num_lanes = env.num_lanes
+        pc = np.zeros(num_lanes, dtype=np.int64)
+        active = np.ones(num_lanes, dtype=bool)
+        returns = np.zeros(num_lanes)
+        counters = np.zeros((num_lanes, self.num_repeats), dtype=np.int64)
+        seen_states = [[set() for _ in range(num_lanes)] for _ in range(self.num_loops)]
+        while True:
+            active &= pc < code_length
+            active_lanes = np.flatnonzero(active)
+            if len(active_lanes) == 0:
+                break
+            current_pc = pc[active_lanes].min()
+            lanes = active_lanes[pc[active_lanes] == current_pc]
+            instruction = code[current_pc]
+            op = instruction[0]
+            if op == ACTION:
+                crashed = env.crashed[lanes]
+                active[lanes[crashed]] = False
+                lanes = lanes[~crashed]
+                env.run_action(instruction[1], lanes)
+                terminated, reward = get_batch_reward(env, lanes)
+                returns[lanes] += reward
+                active[lanes[terminated | env.crashed[lanes]]] = False
+                pc[lanes] += 1
+            elif op == IF:
+                condition = env.get_bool_feature(instruction[1], lanes) != instruction[2]
+                pc[lanes] = np.where(condition, current_pc + 1, instruction[3])
+            elif op == WHILE:
+                condition = env.get_bool_feature(instruction[1], lanes) != instruction[2]
+                pc[lanes[~condition]] = instruction[3]
+                loop_lanes = lanes[condition]
+                loop_states = seen_states[instruction[4]]
+                for lane in loop_lanes:
+                    state_key = env.state_key(lane)
+                    # If we have seen this state previously, we're in an infinite loop
+                    if state_key in loop_states[lane]:
+                        env.crashed[lane] = True
+                    loop_states[lane].add(state_key)
+                crashed = env.crashed[loop_lanes]
+                active[loop_lanes[crashed]] = False
+                pc[loop_lanes[~crashed]] = current_pc + 1
+            elif op == JUMP:
+                pc[lanes] = instruction[1]
+            elif op == REPEAT:
+                slot = instruction[1]
+                repeating = counters[lanes, slot] > 0
+                counters[lanes[repeating], slot] -= 1
+                pc[lanes] = np.where(repeating, current_pc + 1, instruction[2])
+            elif op == REPEAT_INIT:
+                counters[lanes, instruction[2]] = instruction[1]
+                pc[lanes] += 1
+        return returns
+
+
+def compile_program(program: Union[dsl_nodes.Program, CompiledProgram]) -> CompiledProgram:
+    if isinstance(program, CompiledProgram):
+        return program
+    return CompiledProgram(program)
+
+
+def get_divergence_path(program: dsl_nodes.BaseNode, other: dsl_nodes.BaseNode,
+                        subtree_table: SubtreeTable = None) -> Union[tuple[int, ...], None]:
+    """Returns the AST path of the smallest subtree of program that contains every difference with
+    other (e.g. the mutated node of a neighbor), or None if both programs are the same.
+
+    Both programs execute identically until that subtree is reached for the first time. Subtrees
+    shared by both programs are skipped, and with a subtree_table so are equal subtrees.
+    """
+    if program is other:
+        return None
+    if subtree_table is not None and subtree_table.get_id(program) == subtree_table.get_id(other):
+        return None
+    if program.get_label() != other.get_label() or len(program.children) != len(other.children):
+        return ()
+    diverging_paths = []
+    for index, (child, other_child) in enumerate(zip(program.children, other.children)):
+        child_path = get_divergence_path(child, other_child, subtree_table)
+        if child_path is not None:
+            diverging_paths.append((index,) + child_path)
+    if len(diverging_paths) == 0:
+        return None
+    if len(diverging_paths) == 1:
+        return diverging_paths[0]
+    return ()
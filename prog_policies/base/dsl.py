@@ -1,22 +1,58 @@
 from __future__ import annotations
+from typing import Union
 from abc import ABC
+from bisect import bisect_right
 import copy
 
+import numpy as np
+
 from . import dsl_nodes
 
-def _find_close_token(token_list: list[str], character: str, start_index: int = 0) -> int:
-    open_token = character + '('
-    close_token = character + ')'
-    assert token_list[start_index] == open_token, 'Invalid program'
-    parentheses = 1
-    for i, t in enumerate(token_list[start_index+1:]):
-        if t == open_token:
-            parentheses += 1
-        elif t == close_token:
-            parentheses -= 1
-        if parentheses == 0:
-            return i + 1 + start_index
-    raise Exception('Invalid program')
+# Parentheses whose matching token is looked up by the parser, by closing token
+_OPEN_TOKENS = {'c)': 'c(', 'i)': 'i(', 'e)': 'e(', 'w)': 'w(', 'r)': 'r('}
+
+def _match_parentheses(token_list: list[str]) -> list[int]:
+    # Index of the closing token of each opening token (e.g. 'c(' and 'c)'), -1 if there is none.
+    # Each kind of parenthesis is matched on its own
+    closes = [-1] * len(token_list)
+    open_indices = {open_token: [] for open_token in _OPEN_TOKENS.values()}
+    for i, t in enumerate(token_list):
+        if t in open_indices:
+            open_indices[t].append(i)
+        elif t in _OPEN_TOKENS:
+            stack = open_indices[_OPEN_TOKENS[t]]
+            if stack:
+                closes[stack.pop()] = i
+    return closes
+
+def _get_token(token_list: list[str], index: int, end: int) -> str:
+    if index >= end:
+        raise IndexError('Invalid program')
+    return token_list[index]
+
+def _find_close_token(token_list: list[str], closes: list[int], character: str,
+                      start_index: int, end: int) -> int:
+    assert _get_token(token_list, start_index, end) == character + '(', 'Invalid program'
+    if closes[start_index] < 0 or closes[start_index] >= end:
+        raise Exception('Invalid program')
+    return closes[start_index]
+
+class SamplingTable:
+    """Categorical distribution with a precomputed cumulative table. A draw uses one random_sample
+    of the RNG and returns the same value as np.random.RandomState.choice(values, p=probs)"""
+
+    def __init__(self, values: list, probs: np.ndarray):
+        self.values = list(values)
+        self.probs = np.array(probs, dtype=np.double)
+        cdf = self.probs.cumsum()
+        if not cdf[-1] > 0.:
+            raise Exception('Sampling table without positive probabilities')
+        cdf /= cdf[-1]
+        self.cdf = cdf.tolist()
+
+    def sample(self, rng: np.random.RandomState):
+        return self.values[bisect_right(self.cdf, rng.random_sample())]
+
 
 class BaseDSL(ABC):
 
@@ -28,6 +64,8 @@ class BaseDSL(ABC):
         self.actions = [n.name for n in self.nodes_list if isinstance(n, dsl_nodes.Action)]
         self.bool_features = [n.name for n in self.nodes_list if isinstance(n, dsl_nodes.BoolFeature)]
         self.int_features = [n.name for n in self.nodes_list if isinstance(n, dsl_nodes.IntFeature)]
+        # Sampling tables are built on first use, the production rules and probabilities are fixed
+        self.sampling_tables: dict[tuple, SamplingTable] = {}
     
     @property
     def prod_rules(self) -> dict[type[dsl_nodes.BaseNode], list[list[type[dsl_nodes.BaseNode]]]]:
@@ -54,6 +92,49 @@ class BaseDSL(ABC):
     def get_dsl_nodes_probs(self, node_type: type[dsl_nodes.BaseNode]) -> dict[dsl_nodes.BaseNode, float]:
         return {}
     
+    def get_children_table(self, node_type: type[dsl_nodes.BaseNode], index: int,
+                           height_exhausted: bool = False, sequence_exhausted: bool = False) -> SamplingTable:
+        """Distribution of the node type of a child, from get_dsl_nodes_probs restricted to the
+        production rules
+
+        Args:
+            node_type (type[dsl_nodes.BaseNode]): Type of the parent node
+            index (int): Index of the child
+            height_exhausted (bool, optional): Excludes node types of positive depth. Defaults to False.
+            sequence_exhausted (bool, optional): Excludes Concatenate. Defaults to False.
+
+        Returns:
+            SamplingTable: Child node types and their normalized probabilities
+        """
+        key = (node_type, index, height_exhausted, sequence_exhausted)
+        if key not in self.sampling_tables:
+            node_prod_rules = self.prod_rules[node_type]
+            child_probs = self.get_dsl_nodes_probs(node_type.get_children_types()[index])
+            for child_type in child_probs:
+                if child_type not in node_prod_rules[index]:
+                    child_probs[child_type] = 0.
+                if height_exhausted and child_type.get_node_depth() > 0:
+                    child_probs[child_type] = 0.
+            if sequence_exhausted and dsl_nodes.Concatenate in child_probs:
+                child_probs[dsl_nodes.Concatenate] = 0.
+            p_list = list(child_probs.values()) / np.sum(list(child_probs.values()))
+            self.sampling_tables[key] = SamplingTable(child_probs.keys(), p_list)
+        return self.sampling_tables[key]
+
+    def get_terminal_table(self, probs_name: str) -> SamplingTable:
+        """Distribution of the value of a terminal node, e.g. get_terminal_table('action_probs')
+
+        Args:
+            probs_name (str): Name of the property with the probabilities
+
+        Returns:
+            SamplingTable: Values and their probabilities
+        """
+        if probs_name not in self.sampling_tables:
+            probs = getattr(self, probs_name)
+            self.sampling_tables[probs_name] = SamplingTable(probs.keys(), list(probs.values()))
+        return self.sampling_tables[probs_name]
+
     @property
     def action_probs(self) -> dict[str, float]:
         return {}
@@ -74,6 +155,16 @@ class BaseDSL(ABC):
     def const_int_probs(self) -> dict[int, float]:
         return {}
     
+    # Boolean features that always take the opposite value of another feature, see ProgramNormalizer
+    @property
+    def complementary_features(self) -> dict[str, str]:
+        return {}
+    
+    # Actions (left, right) that only rotate the agent by a quarter turn, see ProgramNormalizer
+    @property
+    def rotation_actions(self) -> Union[tuple[str, str], None]:
+        return None
+    
     def structure_only(self):
         structure_nodes = [n for n in self.nodes_list if not isinstance(n, dsl_nodes.BoolFeature)
                         and not isinstance(n, dsl_nodes.IntFeature)
@@ -139,9 +230,15 @@ class BaseDSL(ABC):
         return list(dict.fromkeys(tokens_list)) # Remove duplicates
 
     def parse_node_to_str(self, node: dsl_nodes.BaseNode) -> str:
+        """String of a program or subtree, cached on each node of the subtree"""
         if node is None:
             return '<HOLE>'
-        
+        if node.program_str is None:
+            node.program_str = self._node_to_str(node)
+        return node.program_str
+
+    # String of the node, with its children from parse_node_to_str
+    def _node_to_str(self, node: dsl_nodes.BaseNode) -> str:
         if isinstance(node, dsl_nodes.ConstInt):
             return 'R=' + str(node.value)
         if isinstance(node, dsl_nodes.ConstBool):
@@ -191,125 +288,217 @@ class BaseDSL(ABC):
         
         raise Exception(f'Unknown node type: {type(node)}')
     
+    def get_num_tokens(self, node: dsl_nodes.BaseNode) -> int:
+        """Number of tokens of parse_node_to_str(node), cached on each node of the subtree"""
+        if node is None:
+            return 1
+        if node.num_tokens is None:
+            num_tokens = self.get_node_num_tokens(node)
+            for child in node.children:
+                num_tokens += self.get_num_tokens(child)
+            node.num_tokens = num_tokens
+        return node.num_tokens
+    
+    # Tokens written by parse_node_to_str for the node itself, excluding its children
+    def get_node_num_tokens(self, node: dsl_nodes.BaseNode) -> int:
+        if isinstance(node, dsl_nodes.ConstInt) \
+            or isinstance(node, dsl_nodes.ConstBool) \
+            or isinstance(node, dsl_nodes.Action) \
+            or isinstance(node, dsl_nodes.BoolFeature) \
+            or isinstance(node, dsl_nodes.IntFeature):
+            return 1
+        if isinstance(node, dsl_nodes.Program):
+            return 4
+        if isinstance(node, dsl_nodes.While):
+            return 5
+        if isinstance(node, dsl_nodes.Repeat):
+            return 3
+        if isinstance(node, dsl_nodes.If):
+            return 5
+        if isinstance(node, dsl_nodes.ITE):
+            return 8
+        if isinstance(node, dsl_nodes.Concatenate):
+            return 0
+        if isinstance(node, dsl_nodes.Not):
+            return 3
+        if isinstance(node, dsl_nodes.And) or isinstance(node, dsl_nodes.Or):
+            return 5
+        
+        raise Exception(f'Unknown node type: {type(node)}')
+    
     def parse_str_list_to_node(self, prog_str_list: list[str]) -> dsl_nodes.BaseNode:
         # if len(prog_str_list) == 0:
         #     return EmptyStatement()
+        closes = _match_parentheses(prog_str_list)
+        return self._parse_tokens(prog_str_list, closes, 0, len(prog_str_list))
+
+    def _parse_tokens(self, tokens: list[str], closes: list[int], start: int, end: int) -> dsl_nodes.BaseNode:
+        # Parses tokens[start:end], a sequence of statements is read left to right and nested
+        # as right-leaning Concatenate nodes
+        if start >= end:
+            raise IndexError('Invalid program')
+        node, start = self._parse_node(tokens, closes, start, end)
+        if start >= end:
+            return node
+        nodes = [node]
+        while start < end:
+            node, start = self._parse_node(tokens, closes, start, end)
+            nodes.append(node)
+        node = nodes.pop()
+        while len(nodes) > 0:
+            node = dsl_nodes.Concatenate.new(nodes.pop(), node)
+        return node
+
+    def _parse_node(self, tokens: list[str], closes: list[int], start: int,
+                    end: int) -> tuple[dsl_nodes.BaseNode, int]:
+        # Parses the node starting at tokens[start], returns it with the index where the rest of
+        # the sequence starts (end if the node takes all the remaining tokens)
+        token = tokens[start]
+
+        if token in self.actions:
+            return dsl_nodes.Action(token), start + 1
         
-        if prog_str_list[0] in self.actions:
-            if len(prog_str_list) > 1:
-                s1 = dsl_nodes.Action(prog_str_list[0])
-                s2 = self.parse_str_list_to_node(prog_str_list[1:])
-                return dsl_nodes.Concatenate.new(s1, s2)
-            return dsl_nodes.Action(prog_str_list[0])
-        
-        if prog_str_list[0] in self.bool_features:
-            if len(prog_str_list) > 1:
-                s1 = dsl_nodes.BoolFeature(prog_str_list[0])
-                s2 = self.parse_str_list_to_node(prog_str_list[1:])
-                return dsl_nodes.Concatenate.new(s1, s2)
-            return dsl_nodes.BoolFeature(prog_str_list[0])
+        if token in self.bool_features:
+            return self._parse_bool_feature(tokens, closes, start, end)
         
-        if prog_str_list[0] in self.int_features:
-            if len(prog_str_list) > 1:
-                s1 = dsl_nodes.IntFeature(prog_str_list[0])
-                s2 = self.parse_str_list_to_node(prog_str_list[1:])
-                return dsl_nodes.Concatenate.new(s1, s2)
-            return dsl_nodes.IntFeature(prog_str_list[0])
+        if token in self.int_features:
+            return dsl_nodes.IntFeature(token), start + 1
         
-        if prog_str_list[0] == '<HOLE>':
-            if len(prog_str_list) > 1:
-                s1 = None
-                s2 = self.parse_str_list_to_node(prog_str_list[1:])
-                return dsl_nodes.Concatenate.new(s1, s2)
-            return None
+        if token == '<HOLE>':
+            return None, start + 1
         
-        if prog_str_list[0] == 'DEF':
-            assert prog_str_list[1] == 'run', 'Invalid program'
-            assert prog_str_list[2] == 'm(', 'Invalid program'
-            assert prog_str_list[-1] == 'm)', 'Invalid program'
-            m = self.parse_str_list_to_node(prog_str_list[3:-1])
-            return dsl_nodes.Program.new(m)
+        if token == 'DEF':
+            assert _get_token(tokens, start + 1, end) == 'run', 'Invalid program'
+            assert _get_token(tokens, start + 2, end) == 'm(', 'Invalid program'
+            assert tokens[end-1] == 'm)', 'Invalid program'
+            m = self._parse_tokens(tokens, closes, start+3, end-1)
+            return dsl_nodes.Program.new(m), end
         
-        elif prog_str_list[0] == 'IF':
-            c_end = _find_close_token(prog_str_list, 'c', 1)
-            i_end = _find_close_token(prog_str_list, 'i', c_end+1)
-            c = self.parse_str_list_to_node(prog_str_list[2:c_end])
-            i = self.parse_str_list_to_node(prog_str_list[c_end+2:i_end])
-            if i_end == len(prog_str_list) - 1: 
-                return dsl_nodes.If.new(c, i)
-            else:
-                return dsl_nodes.Concatenate.new(
-                    dsl_nodes.If.new(c, i), 
-                    self.parse_str_list_to_node(prog_str_list[i_end+1:])
-                )
-        elif prog_str_list[0] == 'IFELSE':
-            c_end = _find_close_token(prog_str_list, 'c', 1)
-            i_end = _find_close_token(prog_str_list, 'i', c_end+1)
-            assert prog_str_list[i_end+1] == 'ELSE', 'Invalid program'
-            e_end = _find_close_token(prog_str_list, 'e', i_end+2)
-            c = self.parse_str_list_to_node(prog_str_list[2:c_end])
-            i = self.parse_str_list_to_node(prog_str_list[c_end+2:i_end])
-            e = self.parse_str_list_to_node(prog_str_list[i_end+3:e_end])
-            if e_end == len(prog_str_list) - 1: 
-                return dsl_nodes.ITE.new(c, i, e)
-            else:
-                return dsl_nodes.Concatenate.new(
-                    dsl_nodes.ITE.new(c, i, e),
-                    self.parse_str_list_to_node(prog_str_list[e_end+1:])
-                )
-        elif prog_str_list[0] == 'WHILE':
-            c_end = _find_close_token(prog_str_list, 'c', 1)
-            w_end = _find_close_token(prog_str_list, 'w', c_end+1)
-            c = self.parse_str_list_to_node(prog_str_list[2:c_end])
-            w = self.parse_str_list_to_node(prog_str_list[c_end+2:w_end])
-            if w_end == len(prog_str_list) - 1: 
-                return dsl_nodes.While.new(c, w)
-            else:
-                return dsl_nodes.Concatenate.new(
-                    dsl_nodes.While.new(c, w),
-                    self.parse_str_list_to_node(prog_str_list[w_end+1:])
-                )
-        elif prog_str_list[0] == 'REPEAT':
-            n = self.parse_str_list_to_node([prog_str_list[1]])
-            r_end = _find_close_token(prog_str_list, 'r', 2)
-            r = self.parse_str_list_to_node(prog_str_list[3:r_end])
-            if r_end == len(prog_str_list) - 1: 
-                return dsl_nodes.Repeat.new(n, r)
-            else:
-                return dsl_nodes.Concatenate.new(
-                    dsl_nodes.Repeat.new(n, r),
-                    self.parse_str_list_to_node(prog_str_list[r_end+1:])
-                )
+        elif token == 'IF':
+            c_end = _find_close_token(tokens, closes, 'c', start+1, end)
+            i_end = _find_close_token(tokens, closes, 'i', c_end+1, end)
+            c = self._parse_tokens(tokens, closes, start+2, c_end)
+            i = self._parse_tokens(tokens, closes, c_end+2, i_end)
+            return dsl_nodes.If.new(c, i), i_end+1
+        elif token == 'IFELSE':
+            c_end = _find_close_token(tokens, closes, 'c', start+1, end)
+            i_end = _find_close_token(tokens, closes, 'i', c_end+1, end)
+            assert _get_token(tokens, i_end+1, end) == 'ELSE', 'Invalid program'
+            e_end = _find_close_token(tokens, closes, 'e', i_end+2, end)
+            c = self._parse_tokens(tokens, closes, start+2, c_end)
+            i = self._parse_tokens(tokens, closes, c_end+2, i_end)
+            e = self._parse_tokens(tokens, closes, i_end+3, e_end)
+            return dsl_nodes.ITE.new(c, i, e), e_end+1
+        elif token == 'WHILE':
+            c_end = _find_close_token(tokens, closes, 'c', start+1, end)
+            w_end = _find_close_token(tokens, closes, 'w', c_end+1, end)
+            c = self._parse_tokens(tokens, closes, start+2, c_end)
+            w = self._parse_tokens(tokens, closes, c_end+2, w_end)
+            return dsl_nodes.While.new(c, w), w_end+1
+        elif token == 'REPEAT':
+            _get_token(tokens, start + 1, end)
+            n = self._parse_tokens(tokens, closes, start+1, start+2)
+            r_end = _find_close_token(tokens, closes, 'r', start+2, end)
+            r = self._parse_tokens(tokens, closes, start+3, r_end)
+            return dsl_nodes.Repeat.new(n, r), r_end+1
         
-        elif prog_str_list[0] == 'not':
-            assert prog_str_list[1] == 'c(', 'Invalid program'
-            assert prog_str_list[-1] == 'c)', 'Invalid program'
-            c = self.parse_str_list_to_node(prog_str_list[2:-1])
-            return dsl_nodes.Not.new(c)
-        elif prog_str_list[0] == 'and':
-            c1_end = _find_close_token(prog_str_list, 'c', 1)
-            assert prog_str_list[c1_end+1] == 'c(', 'Invalid program'
-            assert prog_str_list[-1] == 'c)', 'Invalid program'
-            c1 = self.parse_str_list_to_node(prog_str_list[2:c1_end])
-            c2 = self.parse_str_list_to_node(prog_str_list[c1_end+2:-1])
-            return dsl_nodes.And.new(c1, c2)
-        elif prog_str_list[0] == 'or':
-            c1_end = _find_close_token(prog_str_list, 'c', 1)
-            assert prog_str_list[c1_end+1] == 'c(', 'Invalid program'
-            assert prog_str_list[-1] == 'c)', 'Invalid program'
-            c1 = self.parse_str_list_to_node(prog_str_list[2:c1_end])
-            c2 = self.parse_str_list_to_node(prog_str_list[c1_end+2:-1])
-            return dsl_nodes.Or.new(c1, c2)
-
-        elif prog_str_list[0].startswith('R='):
-            num = int(prog_str_list[0].replace('R=', ''))
+        elif token == 'not':
+            assert _get_token(tokens, start + 1, end) == 'c(', 'Invalid program'
+            assert tokens[end-1] == 'c)', 'Invalid program'
+            c = self._parse_tokens(tokens, closes, start+2, end-1)
+            return dsl_nodes.Not.new(c), end
+        elif token == 'and' or token == 'or':
+            c1_end = _find_close_token(tokens, closes, 'c', start+1, end)
+            assert _get_token(tokens, c1_end+1, end) == 'c(', 'Invalid program'
+            assert tokens[end-1] == 'c)', 'Invalid program'
+            c1 = self._parse_tokens(tokens, closes, start+2, c1_end)
+            c2 = self._parse_tokens(tokens, closes, c1_end+2, end-1)
+            if token == 'and':
+                return dsl_nodes.And.new(c1, c2), end
+            return dsl_nodes.Or.new(c1, c2), end
+
+        # Constants ignore the tokens that follow them
+        elif token.startswith('R='):
+            num = int(token.replace('R=', ''))
             assert num is not None
-            return dsl_nodes.ConstInt(num)
-        elif prog_str_list[0] in ['True', 'False']:
-            return dsl_nodes.ConstBool(prog_str_list[0] == 'True')
+            return dsl_nodes.ConstInt(num), end
+        elif token in ['True', 'False']:
+            return dsl_nodes.ConstBool(token == 'True'), end
         else:
-            raise Exception(f'Unrecognized token: {prog_str_list[0]}.')
-    
+            raise Exception(f'Unrecognized token: {token}.')
+
+    def _parse_bool_feature(self, tokens: list[str], closes: list[int], start: int,
+                            end: int) -> tuple[dsl_nodes.BaseNode, int]:
+        return dsl_nodes.BoolFeature(tokens[start]), start + 1
+
+    def _parse_token_lists(self, token_lists: list[list[str]]) -> list[Union[dsl_nodes.BaseNode, None]]:
+        # Programs with the same tokens share their matched parentheses, and a program that failed
+        # to parse is not parsed again. Each program still gets its own nodes
+        closes_cache: dict[tuple[str, ...], list[int]] = {}
+        invalid: set[tuple[str, ...]] = set()
+        nodes = []
+        for tokens in token_lists:
+            key = tuple(tokens)
+            if key in invalid:
+                nodes.append(None)
+                continue
+            try:
+                closes = closes_cache.get(key)
+                if closes is None:
+                    closes = closes_cache[key] = _match_parentheses(tokens)
+                nodes.append(self._parse_tokens(tokens, closes, 0, len(tokens)))
+            except Exception:
+                invalid.add(key)
+                nodes.append(None)
+        return nodes
+
+    def parse_str_batch_to_nodes(self, prog_strs: list[str]) -> list[Union[dsl_nodes.BaseNode, None]]:
+        """Parses a batch of programs, repeated programs are tokenized and matched once. An invalid
+        program is returned as None without stopping the batch
+
+        Args:
+            prog_strs (list[str]): Programs as strings
+
+        Returns:
+            list[Union[dsl_nodes.BaseNode, None]]: Parsed programs
+        """
+        token_lists = {}
+        return self._parse_token_lists(
+            [token_lists.setdefault(prog_str, prog_str.split(' ')) for prog_str in prog_strs]
+        )
+
+    def parse_int_batch_to_nodes(self, prog_tokens: np.ndarray, prog_lens: np.ndarray = None,
+                                 i2t: dict[int, str] = None) -> list[Union[dsl_nodes.BaseNode, None]]:
+        """Parses a batch of programs given as padded token ids. The ids of the whole batch are
+        mapped to tokens at once, an invalid program is returned as None without stopping the batch
+
+        Args:
+            prog_tokens (np.ndarray): Token ids, one program per row
+            prog_lens (np.ndarray, optional): Number of tokens of each program. Defaults to None (up
+            to the first <pad> token).
+            i2t (dict[int, str], optional): Token of each id. Defaults to None (tokens of this DSL).
+
+        Returns:
+            list[Union[dsl_nodes.BaseNode, None]]: Parsed programs
+        """
+        prog_tokens = np.asarray(prog_tokens, dtype=np.int64).reshape(len(prog_tokens), -1)
+        i2t = self.i2t if i2t is None else i2t
+        if prog_lens is None:
+            is_pad = prog_tokens == self.t2i['<pad>']
+            prog_lens = np.where(is_pad.any(axis=1), is_pad.argmax(axis=1), prog_tokens.shape[1])
+        prog_lens = np.asarray(prog_lens).reshape(-1)
+        in_program = np.arange(prog_tokens.shape[1])[None, :] < prog_lens[:, None]
+        # Each distinct id is looked up once, ids without a token make their program invalid
+        ids, inverse = np.unique(np.where(in_program, prog_tokens, -1), return_inverse=True)
+        vocabulary = np.array([i2t.get(int(i)) for i in ids], dtype=object)
+        token_matrix = vocabulary[inverse.reshape(prog_tokens.shape)]
+        valid = ~(in_program & (token_matrix == None)).any(axis=1)
+        # Invalid rows are parsed as empty programs, which fail
+        return self._parse_token_lists(
+            [row[:length].tolist() if is_valid else []
+             for row, length, is_valid in zip(token_matrix, prog_lens, valid)]
+        )
+
     # The following methods should not be overridden even if using a different formatting logic
     def parse_str_to_node(self, prog_str: str) -> dsl_nodes.BaseNode:
         prog_str_list = prog_str.split(' ')
@@ -320,8 +509,7 @@ class BaseDSL(ABC):
         return self.parse_str_to_int(prog_str)
     
     def parse_int_to_node(self, prog_tokens: list[int]) -> dsl_nodes.BaseNode:
-        prog_str = self.parse_int_to_str(prog_tokens)
-        return self.parse_str_to_node(prog_str)
+        return self.parse_str_list_to_node([self.i2t[i] for i in prog_tokens])
     
     def parse_int_to_str(self, prog_tokens: list[int]) -> str:
         token_list = [self.i2t[i] for i in prog_tokens]
@@ -1,53 +1,149 @@
 from __future__ import annotations
-from typing import Generator, Union
+from typing import Generator, Hashable, NamedTuple, Union
 
 from ..environment import BaseEnvironment
 
+
+class SubtreeStats(NamedTuple):
+    num_nodes: int # Nodes in the subtree, as in get_all_nodes
+    size: int # As in get_size
+    height: int # As in get_depth
+    sequence_run: int # Chain of sequence nodes (Concatenate) starting at the root of the subtree
+    max_sequence_run: int # Longest chain of sequence nodes in the subtree
+
+
+# Attributes of BaseNode computed from the subtree, see clear_caches
+_CACHE_SLOTS = ('subtree_stats', 'all_nodes', 'num_tokens', 'program_str', 'subtree_id')
+# Attributes of BaseNode that do not change what a node computes, see get_label
+_STRUCTURE_SLOTS = ('children', 'parent', 'current')
+
+
+class ExecutionFrame:
+    """State of a program execution by the nodes (run, run_generator, record_run_generator), kept
+    out of the nodes"""
+
+    __slots__ = ('loop_states',)
+
+    def __init__(self):
+        # States seen by each While node, to detect infinite loops
+        self.loop_states: dict[int, set[Hashable]] = {}
+
+    def get_loop_states(self, node: BaseNode) -> set[Hashable]:
+        loop_states = self.loop_states.get(id(node))
+        if loop_states is None:
+            loop_states = self.loop_states[id(node)] = set()
+        return loop_states
+
+
 class BaseNode:
 
+    # Nodes only have these attributes, subclasses declare empty __slots__ or their extra attributes
+    __slots__ = ('children', 'parent', 'value', 'current', 'name',
+                 'subtree_stats', 'all_nodes', 'num_tokens', 'program_str', 'subtree_id')
+
     node_size: int = 1
     node_depth: int = 0
+    node_sequence: int = 0
     children_types: list[type[BaseNode]] = []
 
     def __init__(self, name: Union[str, None] = None):
-        self.children: list[Union[BaseNode, None]] = [None for _ in range(self.get_number_children())]
+        # Terminal nodes share an empty tuple
+        number_children = self.get_number_children()
+        self.children: list[Union[BaseNode, None]] = [None] * number_children if number_children > 0 else ()
         self.parent: Union[BaseNode, None] = None
         self.value: Union[None, bool, int] = None
         self.current = False
+        # Caches of get_subtree_stats, get_all_nodes, BaseDSL.get_num_tokens, BaseDSL.parse_node_to_str
+        # and SubtreeTable.get_id, cleared along the parent chain by set_child
+        self.subtree_stats: Union[SubtreeStats, None] = None
+        self.all_nodes: Union[tuple[BaseNode, ...], None] = None
+        self.num_tokens: Union[int, None] = None
+        self.program_str: Union[str, None] = None
+        self.subtree_id: Union[int, None] = None
         if name is not None:
             self.name = name
         else:
             self.name = type(self).__name__
     
-    # Some nodes might use an internal state to keep track of program execution. This function
-    # will be called by the program when running in a new environment
-    def reset_state(self):
-        pass
-    
-    # In this implementation, get_size is run recursively in a program, so we do not need to worry
-    # about updating each node size as we grow them
+    # Sum of the node sizes of the subtree, cached with the subtree statistics
     def get_size(self) -> int:
-        size = self.node_size
-        for child in self.children:
-            if child is not None:
-                size += child.get_size()
-        return size
+        return self.get_subtree_stats().size
     
-    # recursively calculate the node depth (number of levels from root)
+    # Node depth of the subtree (number of levels from root), cached with the subtree statistics
     def get_depth(self) -> int:
-        depth = 0
-        for child in self.children:
-            if child is not None:
-                depth = max(depth, child.get_depth())
-        return depth + self.node_depth
+        return self.get_subtree_stats().height
+    
+    # Statistics of the subtree, computed once and cleared by set_child. Programs that share subtrees
+    # are changed by copying the path to the modified node instead (see shallow_copy)
+    def get_subtree_stats(self) -> SubtreeStats:
+        if self.subtree_stats is None:
+            num_nodes, size, height, sequence_run, max_sequence_run = 1, self.node_size, 0, 0, 0
+            for child in self.children:
+                if child is not None:
+                    child_num_nodes, child_size, child_height, child_run, child_max_run = child.get_subtree_stats()
+                    num_nodes += child_num_nodes
+                    size += child_size
+                    if child_height > height:
+                        height = child_height
+                    if child_run > sequence_run:
+                        sequence_run = child_run
+                    if child_max_run > max_sequence_run:
+                        max_sequence_run = child_max_run
+            sequence_run = sequence_run + self.node_sequence if self.node_sequence > 0 else 0
+            self.subtree_stats = SubtreeStats(num_nodes, size, height + self.node_depth, sequence_run,
+                                              max(max_sequence_run, sequence_run))
+        return self.subtree_stats
+    
+    def has_caches(self) -> bool:
+        return self.subtree_stats is not None or self.all_nodes is not None \
+            or self.num_tokens is not None or self.program_str is not None or self.subtree_id is not None
     
-    # Recursively get all nodes in the tree
+    def clear_caches(self) -> None:
+        self.subtree_stats = None
+        self.all_nodes = None
+        self.num_tokens = None
+        self.program_str = None
+        self.subtree_id = None
+    
+    def set_child(self, index: int, child: Union[BaseNode, None]) -> None:
+        """Replaces a child of the node, clearing the caches of the node and its ancestors
+
+        Args:
+            index (int): Index of the child
+            child (Union[BaseNode, None]): New child
+        """
+        self.children[index] = child
+        if child is not None:
+            child.parent = self
+        # Caches are computed from the ones of the children, so the ancestors of a node without
+        # caches have none either
+        node = self
+        while node is not None and node.has_caches():
+            node.clear_caches()
+            node = node.parent
+    
+    # Copy of the node that shares its children, the caches are cleared as the copy is meant to be modified
+    def shallow_copy(self) -> BaseNode:
+        node = object.__new__(type(self))
+        for name in self.get_slots():
+            setattr(node, name, getattr(self, name))
+        if len(self.children) > 0:
+            node.children = list(self.children)
+        node.clear_caches()
+        return node
+    
+    # Recursively get all nodes in the tree, cached as a tuple
     def get_all_nodes(self) -> list[BaseNode]:
-        nodes = [self]
-        for child in self.children:
-            if child is not None:
-                nodes += child.get_all_nodes()
-        return nodes
+        return list(self._get_all_nodes())
+    
+    def _get_all_nodes(self) -> tuple[BaseNode, ...]:
+        if self.all_nodes is None:
+            nodes = [self]
+            for child in self.children:
+                if child is not None:
+                    nodes.extend(child._get_all_nodes())
+            self.all_nodes = tuple(nodes)
+        return self.all_nodes
     
     def is_complete(self) -> bool:
         for child in self.children:
@@ -57,6 +153,40 @@ class BaseNode:
                 return False
         return True
     
+    # Pickled and deep copied without the caches
+    def __getstate__(self) -> tuple:
+        return tuple(getattr(self, name) for name in self.get_state_slots())
+    
+    def __setstate__(self, state: tuple) -> None:
+        for name, value in zip(self.get_state_slots(), state):
+            setattr(self, name, value)
+        self.clear_caches()
+    
+    @classmethod
+    def get_slots(cls) -> tuple[str, ...]:
+        """Names of the attributes of the node type"""
+        if '_slots' not in cls.__dict__:
+            cls._slots = tuple(name for base in reversed(cls.__mro__) for name in base.__dict__.get('__slots__', ()))
+        return cls._slots
+    
+    @classmethod
+    def get_state_slots(cls) -> tuple[str, ...]:
+        """Names of the attributes of the node type that are not caches"""
+        if '_state_slots' not in cls.__dict__:
+            cls._state_slots = tuple(name for name in cls.get_slots() if name not in _CACHE_SLOTS)
+        return cls._state_slots
+    
+    @classmethod
+    def get_label_slots(cls) -> tuple[str, ...]:
+        """Names of the attributes of the node type that define what the node itself computes"""
+        if '_label_slots' not in cls.__dict__:
+            cls._label_slots = tuple(name for name in cls.get_state_slots() if name not in _STRUCTURE_SLOTS)
+        return cls._label_slots
+    
+    # Node type and attributes, equal for two nodes that compute the same given equal children
+    def get_label(self) -> tuple:
+        return (type(self),) + tuple(getattr(self, name) for name in self.get_label_slots())
+    
     @classmethod
     def get_number_children(cls) -> int:
         return len(cls.children_types)
@@ -80,24 +210,24 @@ class BaseNode:
         for i, arg in enumerate(args):
             if arg is not None:
                 assert issubclass(type(arg), children_types[i])
-                inst.children[i] = arg
-                arg.parent = inst
+                inst.set_child(i, arg)
         return inst
     
     # interpret is used by nodes that return a value (IntNode, BoolNode)
     def interpret(self, env: BaseEnvironment) -> Union[bool, int]:
         raise Exception('Unimplemented method: interpret')
 
-    # run and run_generator are used by nodes that affect env (StatementNode)
-    def run(self, env: BaseEnvironment) -> None:
+    # run and run_generator are used by nodes that affect env (StatementNode), the execution state
+    # is kept in frame, created by Program
+    def run(self, env: BaseEnvironment, frame: ExecutionFrame = None) -> None:
         raise Exception('Unimplemented method: run')
 
-    def run_generator(self, env: BaseEnvironment) -> Generator[BaseNode, None, None]:
+    def run_generator(self, env: BaseEnvironment, frame: ExecutionFrame = None) -> Generator[BaseNode, None, None]:
         raise Exception('Unimplemented method: run_generator')
     
     # For record
     def record_interpret(self, env: BaseEnvironment) -> Union[bool, int]:
         raise Exception('Unimplemented method: interpret')
 
-    def record_run_generator(self, env: BaseEnvironment) -> Generator[BaseNode, None, None]:
+    def record_run_generator(self, env: BaseEnvironment, frame: ExecutionFrame = None) -> Generator[BaseNode, None, None]:
         raise Exception('Unimplemented method: run_generator')
\ No newline at end of file
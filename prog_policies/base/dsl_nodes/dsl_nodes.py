@@ -1,7 +1,5 @@
-import copy
-from typing import Union
 from ..environment import BaseEnvironment
-from .base_node import BaseNode
+from .base_node import BaseNode, ExecutionFrame
 
 
 # Node types, for inheritance to other classes
@@ -10,32 +8,41 @@ from .base_node import BaseNode
 # Statement: expression or terminal action functions (no return)
 class IntNode(BaseNode):
 
+    __slots__ = ()
+
     def interpret(self, env: BaseEnvironment) -> int:
         raise Exception("Unimplemented method: interpret")
 
 
 class BoolNode(BaseNode):
 
+    __slots__ = ()
+
     def interpret(self, env: BaseEnvironment) -> bool:
         raise Exception("Unimplemented method: interpret")
 
 
 class StatementNode(BaseNode):
-    pass
+
+    __slots__ = ()
 
 
 # Terminal/Non-Terminal types, for inheritance to other classes
 class TerminalNode(BaseNode):
-    pass
+
+    __slots__ = ()
 
 
 class OperationNode(BaseNode):
-    pass
+
+    __slots__ = ()
 
 
 # Constants
 class ConstBool(BoolNode, TerminalNode):
 
+    __slots__ = ()
+
     def __init__(self, value: bool = False):
         super().__init__()
         self.value = value
@@ -46,6 +53,8 @@ class ConstBool(BoolNode, TerminalNode):
 
 class ConstInt(IntNode, TerminalNode):
 
+    __slots__ = ()
+
     def __init__(self, value: int = 0):
         super().__init__()
         self.value = value
@@ -60,156 +69,171 @@ class ConstInt(IntNode, TerminalNode):
 # Program as an arbitrary node with a single StatementNode child
 class Program(BaseNode):
 
+    __slots__ = ()
+
     node_size = 0
     node_depth = 1
     children_types = [StatementNode]
 
-    def run(self, env: BaseEnvironment) -> None:
+    def run(self, env: BaseEnvironment, frame: ExecutionFrame = None) -> None:
         assert self.is_complete(), "Incomplete Program"
-        self.children[0].run(env)
+        self.children[0].run(env, ExecutionFrame())
 
-    def run_generator(self, env: BaseEnvironment):
+    def run_generator(self, env: BaseEnvironment, frame: ExecutionFrame = None):
         assert self.is_complete(), "Incomplete Program"
-        for node in self.get_all_nodes():
-            node.reset_state()
-        yield from self.children[0].run_generator(env)
+        yield from self.children[0].run_generator(env, ExecutionFrame())
 
-    def record_run_generator(self, env: BaseEnvironment):
+    def record_run_generator(self, env: BaseEnvironment, frame: ExecutionFrame = None):
         assert self.is_complete(), "Incomplete Program"
-        for node in self.get_all_nodes():
-            node.reset_state()
-        yield from self.children[0].record_run_generator(env)
+        yield from self.children[0].record_run_generator(env, ExecutionFrame())
 
 
 # Expressions
 class While(StatementNode, OperationNode):
 
+    __slots__ = ()
+
     node_depth = 1
     children_types = [BoolNode, StatementNode]
 
-    def reset_state(self):
-        self.previous_envs: list[BaseEnvironment] = []
-        self.previous_env_hashes: list[str] = []
-
-    def run(self, env: BaseEnvironment) -> None:
+    def run(self, env: BaseEnvironment, frame: ExecutionFrame = None) -> None:
+        if frame is None:
+            frame = ExecutionFrame()
+        previous_states = frame.get_loop_states(self)
         while self.children[0].interpret(env):
             # If we have seen this state previously, we're in an infinite loop
-            for previous_env in self.previous_envs:
-                if env == previous_env:
-                    env.crash()
-            self.previous_envs.append(copy.deepcopy(env))
+            state = env.state_fingerprint()
+            if state in previous_states:
+                env.crash()
+            previous_states.add(state)
             if env.is_crashed():
                 return  # To avoid infinite loops
-            self.children[1].run(env)
+            self.children[1].run(env, frame)
 
-    def run_generator(self, env: BaseEnvironment):
+    def run_generator(self, env: BaseEnvironment, frame: ExecutionFrame = None):
+        if frame is None:
+            frame = ExecutionFrame()
+        previous_states = frame.get_loop_states(self)
         while self.children[0].interpret(env):
             # If we have seen this state previously, we're in an infinite loop
-            env_hash = env.hash()
-            for previous_env_hash in self.previous_env_hashes:
-                if env_hash == previous_env_hash:
-                    env.crash()
-            self.previous_env_hashes.append(env_hash)
+            state = env.state_fingerprint()
+            if state in previous_states:
+                env.crash()
+            previous_states.add(state)
             if env.is_crashed():
                 return  # To avoid infinite loops
-            yield from self.children[1].run_generator(env)
+            yield from self.children[1].run_generator(env, frame)
 
-    def record_run_generator(self, env: BaseEnvironment):
+    def record_run_generator(self, env: BaseEnvironment, frame: ExecutionFrame = None):
+        if frame is None:
+            frame = ExecutionFrame()
+        previous_states = frame.get_loop_states(self)
         while self.children[0].record_interpret(env):
             yield self.children[0]
             # If we have seen this state previously, we're in an infinite loop
-            for previous_env in self.previous_envs:
-                if env == previous_env:
-                    env.crash()
-            self.previous_envs.append(copy.deepcopy(env))
+            state = env.state_fingerprint()
+            if state in previous_states:
+                env.crash()
+            previous_states.add(state)
             if env.is_crashed():
                 return  # To avoid infinite loops
-            yield from self.children[1].record_run_generator(env)
+            yield from self.children[1].record_run_generator(env, frame)
 
 
 class Repeat(StatementNode, OperationNode):
 
+    __slots__ = ()
+
     node_depth = 1
     children_types = [IntNode, StatementNode]
 
-    def run(self, env: BaseEnvironment) -> None:
+    def run(self, env: BaseEnvironment, frame: ExecutionFrame = None) -> None:
         for _ in range(self.children[0].interpret(env)):
-            self.children[1].run(env)
+            self.children[1].run(env, frame)
 
-    def run_generator(self, env: BaseEnvironment):
+    def run_generator(self, env: BaseEnvironment, frame: ExecutionFrame = None):
         for _ in range(self.children[0].interpret(env)):
-            yield from self.children[1].run_generator(env)
+            yield from self.children[1].run_generator(env, frame)
 
-    def record_run_generator(self, env: BaseEnvironment):
+    def record_run_generator(self, env: BaseEnvironment, frame: ExecutionFrame = None):
         for _ in range(self.children[0].record_interpret(env)):
-            yield from self.children[1].record_run_generator(env)
+            yield from self.children[1].record_run_generator(env, frame)
 
 
 class If(StatementNode, OperationNode):
 
+    __slots__ = ()
+
     node_depth = 1
     children_types = [BoolNode, StatementNode]
 
-    def run(self, env: BaseEnvironment) -> None:
+    def run(self, env: BaseEnvironment, frame: ExecutionFrame = None) -> None:
         if self.children[0].interpret(env):
-            self.children[1].run(env)
+            self.children[1].run(env, frame)
 
-    def run_generator(self, env: BaseEnvironment):
+    def run_generator(self, env: BaseEnvironment, frame: ExecutionFrame = None):
         if self.children[0].interpret(env):
-            yield from self.children[1].run_generator(env)
+            yield from self.children[1].run_generator(env, frame)
 
-    def record_run_generator(self, env: BaseEnvironment):
+    def record_run_generator(self, env: BaseEnvironment, frame: ExecutionFrame = None):
         yield self.children[0]
         if self.children[0].record_interpret(env):
-            yield from self.children[1].record_run_generator(env)
+            yield from self.children[1].record_run_generator(env, frame)
 
 
 class ITE(StatementNode, OperationNode):
 
+    __slots__ = ()
+
     node_depth = 1
     children_types = [BoolNode, StatementNode, StatementNode]
 
-    def run(self, env: BaseEnvironment) -> None:
+    def run(self, env: BaseEnvironment, frame: ExecutionFrame = None) -> None:
         if self.children[0].interpret(env):
-            self.children[1].run(env)
+            self.children[1].run(env, frame)
         else:
-            self.children[2].run(env)
+            self.children[2].run(env, frame)
 
-    def run_generator(self, env: BaseEnvironment):
+    def run_generator(self, env: BaseEnvironment, frame: ExecutionFrame = None):
         if self.children[0].interpret(env):
-            yield from self.children[1].run_generator(env)
+            yield from self.children[1].run_generator(env, frame)
         else:
-            yield from self.children[2].run_generator(env)
+            yield from self.children[2].run_generator(env, frame)
 
-    def record_run_generator(self, env: BaseEnvironment):
+    def record_run_generator(self, env: BaseEnvironment, frame: ExecutionFrame = None):
         yield self.children[0]
         if self.children[0].record_interpret(env):
-            yield from self.children[1].record_run_generator(env)
+            yield from self.children[1].record_run_generator(env, frame)
         else:
-            yield from self.children[2].record_run_generator(env)
+            yield from self.children[2].record_run_generator(env, frame)
 
 
 class Concatenate(StatementNode, OperationNode):
 
+    __slots__ = ()
+
     node_size = 0
+    node_sequence = 1
     children_types = [StatementNode, StatementNode]
 
-    def run(self, env: BaseEnvironment) -> None:
-        self.children[0].run(env)
-        self.children[1].run(env)
+    def run(self, env: BaseEnvironment, frame: ExecutionFrame = None) -> None:
+        self.children[0].run(env, frame)
+        self.children[1].run(env, frame)
 
-    def run_generator(self, env: BaseEnvironment):
-        yield from self.children[0].run_generator(env)
-        yield from self.children[1].run_generator(env)
+    def run_generator(self, env: BaseEnvironment, frame: ExecutionFrame = None):
+        yield from self.children[0].run_generator(env, frame)
+        yield from self.children[1].run_generator(env, frame)
 
-    def record_run_generator(self, env: BaseEnvironment):
-        yield from self.children[0].record_run_generator(env)
-        yield from self.children[1].record_run_generator(env)
+    def record_run_generator(self, env: BaseEnvironment, frame: ExecutionFrame = None):
+        yield from self.children[0].record_run_generator(env, frame)
+        yield from self.children[1].record_run_generator(env, frame)
 
 
 # Boolean operations
 class Not(BoolNode, OperationNode):
 
+    __slots__ = ()
+
     children_types = [BoolNode]
 
     def interpret(self, env: BaseEnvironment) -> bool:
@@ -222,6 +246,8 @@ class Not(BoolNode, OperationNode):
 # Note: And and Or are defined here but are not used in Karel
 class And(BoolNode, OperationNode):
 
+    __slots__ = ()
+
     children_types = [BoolNode, BoolNode]
 
     def interpret(self, env: BaseEnvironment) -> bool:
@@ -230,6 +256,8 @@ class And(BoolNode, OperationNode):
 
 class Or(BoolNode, OperationNode):
 
+    __slots__ = ()
+
     children_types = [BoolNode, BoolNode]
 
     def interpret(self, env: BaseEnvironment) -> bool:
@@ -239,16 +267,18 @@ class Or(BoolNode, OperationNode):
 # For actions available in environment
 class Action(StatementNode, TerminalNode):
 
-    def run(self, env: BaseEnvironment) -> None:
+    __slots__ = ()
+
+    def run(self, env: BaseEnvironment, frame: ExecutionFrame = None) -> None:
         if not env.is_crashed():
             env.run_action(self.name)
 
-    def run_generator(self, env: BaseEnvironment):
+    def run_generator(self, env: BaseEnvironment, frame: ExecutionFrame = None):
         if not env.is_crashed():
             env.run_action(self.name)
             yield self
 
-    def record_run_generator(self, env: BaseEnvironment):
+    def record_run_generator(self, env: BaseEnvironment, frame: ExecutionFrame = None):
         if not env.is_crashed():
             env.run_action(self.name)
             yield self
@@ -257,6 +287,8 @@ class Action(StatementNode, TerminalNode):
 # For features available in environment
 class BoolFeature(BoolNode, TerminalNode):
 
+    __slots__ = ()
+
     def interpret(self, env: BaseEnvironment) -> bool:
         return env.get_bool_feature(self.name)
 
@@ -266,5 +298,7 @@ class BoolFeature(BoolNode, TerminalNode):
 
 class IntFeature(BoolNode, TerminalNode):
 
+    __slots__ = ()
+
     def interpret(self, env: BaseEnvironment) -> int:
         return env.get_int_feature(self.name)
@@ -1,9 +1,18 @@
 from __future__ import annotations
 from abc import ABC, abstractmethod
-from typing import Any, Union, Callable
+import copy
+from typing import Any, Hashable, Union, Callable
 
 import numpy as np
 
+
+class EnvironmentListener:
+    """Base class of the objects notified of the state changes of an environment as they happen
+    (see BaseEnvironment.add_listener). The events depend on the environment, e.g.
+    KarelEnvironmentListener."""
+    pass
+
+
 class BaseEnvironment(ABC):
     
     def __init__(self, actions: dict[str, Callable], bool_features: dict[str, Callable],
@@ -19,11 +28,15 @@ class BaseEnvironment(ABC):
         self.state_shape = state_shape
         self.num_calls: int = 0
         self.crashed: bool = False
+        self.listeners: list[EnvironmentListener] = []
         if initial_state is not None:
             self.set_state(initial_state)
         else:
             self.set_state(self.default_state())
 
+    def add_listener(self, listener: EnvironmentListener) -> None:
+        self.listeners.append(listener)
+
     def is_crashed(self) -> bool:
         return self.crashed
     
@@ -54,6 +67,21 @@ class BaseEnvironment(ABC):
             self.crashed = True
         self.actions_list[action_index]()
 
+    # snapshot and restore are used to reset an environment in place; subclasses with mutable
+    # buffers should override them to copy into the existing arrays instead of reallocating
+    def snapshot(self) -> Any:
+        return copy.deepcopy(self.get_state()), self.num_calls, self.crashed
+
+    def restore(self, snapshot: Any) -> None:
+        state, self.num_calls, self.crashed = snapshot
+        self.set_state(copy.deepcopy(state))
+
+    # Environments that can run several copies in lockstep return a batched environment here (see
+    # CompiledProgram.run_batch), None means batched execution is not supported
+    @classmethod
+    def stack(cls, environments: list[BaseEnvironment]) -> Any:
+        return None
+
     @abstractmethod
     def default_state(self):
         pass
@@ -70,6 +98,11 @@ class BaseEnvironment(ABC):
     def __eq__(self, other: BaseEnvironment) -> bool:
         pass
 
+    # Hashable summary of the state, used by While loops to detect revisited states. Environments
+    # that can maintain it incrementally should override this instead of hashing the whole state
+    def state_fingerprint(self) -> Hashable:
+        return self.hash()
+
     @classmethod
     @abstractmethod
     def from_string(cls, state_str: str):
@@ -0,0 +1,183 @@
+from __future__ import annotations
+from typing import Union
+
+from .dsl import BaseDSL
+from . import dsl_nodes
+
+
+class ProgramNormalizer:
+    """Rewrites programs into a canonical form with the same episodes, so that trivially equivalent
+    programs share their evaluation (e.g. in an EvaluationCache).
+
+    The default rewrites are exact: the rewritten program runs the same actions, queries the same
+    number of features (so max_calls crashes happen at the same point) and detects the same loops.
+    - REPEAT R=0 is removed from sequences, REPEAT R=1 is replaced by its body and nested REPEATs
+      are merged if the product is a constant of the DSL
+    - not c( not c( b c) c) becomes b and not c( b c) the complementary feature of b if any
+      (DSL.complementary_features, e.g. noMarkersPresent and markersPresent in Karel)
+    - IFELSE conditions lose their not (swapping the branches) and use the first of two
+      complementary features
+    - Sequences are flattened and concatenated from the right, like the parser does
+
+    With change_calls, rewrites that change the number of calls or of actions are also applied:
+    - IFELSE with equal branches (without WHILE, whose visited states are kept per node) becomes
+      its branch, and IF c( b c) i( IF c( b c) i( s i) i) becomes IF c( b c) i( s i)
+    - Consecutive rotations (DSL.rotation_actions, e.g. turnLeft turnLeft turnLeft in Karel) are
+      merged into their net rotation
+
+    Unchanged subtrees are shared with the input program, which is not modified (see copy_path).
+    """
+
+    def __init__(self, dsl: BaseDSL, change_calls: bool = False):
+        """
+        Args:
+            dsl (BaseDSL): DSL of the programs
+            change_calls (bool, optional): Whether to also apply rewrites that change the number of
+            calls to the environment. Defaults to False.
+        """
+        self.dsl = dsl
+        self.change_calls = change_calls
+        self.complementary_features = dsl.complementary_features
+        self.rotation_actions = dsl.rotation_actions
+        self.int_values = set(node.value for node in dsl.nodes_list if isinstance(node, dsl_nodes.ConstInt))
+
+    def normalize(self, program: dsl_nodes.Program) -> dsl_nodes.Program:
+        """Canonical form of a program, the program itself if no rewrite applies"""
+        if not isinstance(program, dsl_nodes.Program) or not program.is_complete():
+            return program
+        return self._normalize(program)
+
+    def _normalize(self, node: dsl_nodes.BaseNode) -> dsl_nodes.BaseNode:
+        # Returns node if unchanged, otherwise a new node without parent
+        if isinstance(node, dsl_nodes.Concatenate):
+            return self._normalize_sequence(node)
+        children = [self._normalize(child) for child in node.children]
+        if isinstance(node, dsl_nodes.Not):
+            return self._normalize_not(node, children[0])
+        if isinstance(node, dsl_nodes.Repeat):
+            return self._normalize_repeat(node, children[0], children[1])
+        if isinstance(node, dsl_nodes.ITE):
+            return self._normalize_ite(node, children[0], children[1], children[2])
+        if isinstance(node, dsl_nodes.If) and self.change_calls:
+            body = children[1]
+            if isinstance(body, dsl_nodes.If) and self._equals(children[0], body.children[0]):
+                children[1] = body.children[1]
+        return self._rebuild(node, children)
+
+    def _normalize_not(self, node: dsl_nodes.Not, child: dsl_nodes.BaseNode) -> dsl_nodes.BaseNode:
+        if isinstance(child, dsl_nodes.Not):
+            return child.children[0]
+        if type(child) == dsl_nodes.BoolFeature and child.name in self.complementary_features:
+            return dsl_nodes.BoolFeature(self.complementary_features[child.name])
+        return self._rebuild(node, [child])
+
+    def _normalize_repeat(self, node: dsl_nodes.Repeat, times: dsl_nodes.BaseNode,
+                          body: dsl_nodes.BaseNode) -> dsl_nodes.BaseNode:
+        if not isinstance(times, dsl_nodes.ConstInt):
+            return self._rebuild(node, [times, body])
+        if times.value == 1:
+            return body
+        if isinstance(body, dsl_nodes.Repeat) and isinstance(body.children[0], dsl_nodes.ConstInt) \
+                and times.value * body.children[0].value in self.int_values:
+            return self._rebuild(node, [dsl_nodes.ConstInt(times.value * body.children[0].value), body.children[1]])
+        return self._rebuild(node, [times, body])
+
+    def _normalize_ite(self, node: dsl_nodes.ITE, condition: dsl_nodes.BaseNode,
+                       then_body: dsl_nodes.BaseNode, else_body: dsl_nodes.BaseNode) -> dsl_nodes.BaseNode:
+        if isinstance(condition, dsl_nodes.Not):
+            condition, then_body, else_body = condition.children[0], else_body, then_body
+        if type(condition) == dsl_nodes.BoolFeature and condition.name in self.complementary_features \
+                and self.complementary_features[condition.name] < condition.name:
+            condition = dsl_nodes.BoolFeature(self.complementary_features[condition.name])
+            then_body, else_body = else_body, then_body
+        if self.change_calls and self._equals(then_body, else_body) and not self._has_loop(then_body):
+            return then_body
+        return self._rebuild(node, [condition, then_body, else_body])
+
+    def _normalize_sequence(self, node: dsl_nodes.Concatenate) -> dsl_nodes.BaseNode:
+        statements = self._get_statements(node)
+        normalized = []
+        for statement in statements:
+            normalized.extend(self._get_statements(self._normalize(statement)))
+        # A REPEAT R=0 does nothing, but the sequence can not be empty
+        normalized = [statement for statement in normalized if not self._is_empty_repeat(statement)] \
+            or normalized[:1]
+        if self.change_calls and self.rotation_actions is not None:
+            normalized = self._merge_rotations(normalized)
+        if len(normalized) == len(statements) and all(new is old for new, old in zip(normalized, statements)) \
+                and self._is_right_folded(node):
+            return node
+        sequence = self._place(normalized[-1])
+        for statement in reversed(normalized[:-1]):
+            sequence = dsl_nodes.Concatenate.new(self._place(statement), sequence)
+        return sequence
+
+    def _merge_rotations(self, statements: list[dsl_nodes.BaseNode]) -> list[dsl_nodes.BaseNode]:
+        left, right = self.rotation_actions
+        merged = []
+        index = 0
+        while index < len(statements):
+            end = index
+            rotation = 0
+            while end < len(statements) and type(statements[end]) == dsl_nodes.Action \
+                    and statements[end].name in self.rotation_actions:
+                rotation += 1 if statements[end].name == right else -1
+                end += 1
+            if end == index:
+                merged.append(statements[index])
+                index += 1
+                continue
+            names = {0: [], 1: [right], 2: [right, right], 3: [left]}[rotation % 4]
+            if names == [statement.name for statement in statements[index:end]]:
+                merged.extend(statements[index:end])
+            else:
+                merged.extend(dsl_nodes.Action(name) for name in names)
+            index = end
+        # Rotations that cancel out are kept if they are the whole sequence
+        return merged if len(merged) > 0 else statements
+
+    def _rebuild(self, node: dsl_nodes.BaseNode, children: list[dsl_nodes.BaseNode]) -> dsl_nodes.BaseNode:
+        if all(child is old_child for child, old_child in zip(children, node.children)):
+            return node
+        copied = node.shallow_copy()
+        copied.parent = None
+        for i, (child, old_child) in enumerate(zip(children, node.children)):
+            if child is not old_child:
+                copied.set_child(i, self._place(child))
+        return copied
+
+    # New nodes are placed as they are, nodes of the input program are copied to keep their parent
+    @staticmethod
+    def _place(node: dsl_nodes.BaseNode) -> dsl_nodes.BaseNode:
+        if node.parent is None:
+            return node
+        copied = node.shallow_copy()
+        copied.parent = None
+        return copied
+
+    @staticmethod
+    def _get_statements(node: dsl_nodes.BaseNode) -> list[dsl_nodes.BaseNode]:
+        if isinstance(node, dsl_nodes.Concatenate):
+            return ProgramNormalizer._get_statements(node.children[0]) \
+                + ProgramNormalizer._get_statements(node.children[1])
+        return [node]
+
+    @staticmethod
+    def _is_right_folded(node: dsl_nodes.Concatenate) -> bool:
+        while isinstance(node, dsl_nodes.Concatenate):
+            if isinstance(node.children[0], dsl_nodes.Concatenate):
+                return False
+            node = node.children[1]
+        return True
+
+    @staticmethod
+    def _is_empty_repeat(node: dsl_nodes.BaseNode) -> bool:
+        return isinstance(node, dsl_nodes.Repeat) and isinstance(node.children[0], dsl_nodes.ConstInt) \
+            and node.children[0].value == 0
+
+    @staticmethod
+    def _has_loop(node: dsl_nodes.BaseNode) -> bool:
+        return any(isinstance(child, dsl_nodes.While) for child in node.get_all_nodes())
+
+    def _equals(self, node: Union[dsl_nodes.BaseNode, None], other: Union[dsl_nodes.BaseNode, None]) -> bool:
+        return self.dsl.parse_node_to_str(node) == self.dsl.parse_node_to_str(other)
@@ -0,0 +1,298 @@
+from __future__ import annotations
+from typing import Callable, Union
+
+import numpy as np
+
+from .dsl import BaseDSL
+from . import dsl_nodes
+
+
+def _sample_index(probs: np.ndarray, rng: np.random.RandomState) -> int:
+    # Same draw as rng.choice(len(probs), p=probs), without validating probs
+    cdf = np.cumsum(probs)
+    cdf /= cdf[-1]
+    return int(cdf.searchsorted(rng.random_sample(), side='right'))
+
+
+class _Option:
+    """Node type that can be drawn for a child slot, with the distribution of the cost of its subtree"""
+
+    def __init__(self, node_type: type[dsl_nodes.BaseNode], prob: float, cost: int,
+                 state: Union[tuple, None], cost_dist: np.ndarray):
+        self.node_type = node_type
+        self.prob = prob
+        self.cost = cost
+        self.state = state
+        self.cost_dist = cost_dist
+
+
+class ProgramSampler:
+    """Samples programs from the probabilistic DSL conditioned on the program being valid, without
+    rejection.
+
+    The generative process is the one of ProgrammaticSpace._fill_children: each child type is drawn
+    from the DSL probabilities, restricted by the production rules, without nodes of positive depth
+    once max_height is reached and without Concatenate once max_sequence is reached. A program is
+    valid if its height is at most max_height, its maximum Concatenate sequence (get_max_sequence)
+    is at most max_sequence and its total cost (sum of node_cost over its nodes) is at most max_cost.
+
+    For every sampling state, a dynamic program computes the distribution of the cost of the valid
+    subtrees. Each choice is then drawn with its probability reweighted by the probability of being
+    completed into a valid program, so the sampled programs follow the same distribution as sampling
+    with the generative process until a valid program is found.
+    """
+
+    def __init__(self, dsl: BaseDSL, max_height: int = 4, max_sequence: int = 6,
+                 max_cost: Union[int, None] = None,
+                 node_cost: Callable[[dsl_nodes.BaseNode], int] = None):
+        """
+        Args:
+            dsl (BaseDSL): DSL with production rules and node probabilities
+            max_height (int, optional): Maximum program height. Defaults to 4.
+            max_sequence (int, optional): Maximum Concatenate sequence. Defaults to 6.
+            max_cost (Union[int, None], optional): Maximum program cost, None for no limit. Defaults to None.
+            node_cost (Callable[[dsl_nodes.BaseNode], int], optional): Cost of a node excluding its
+            children, it must only depend on the node type. Defaults to dsl.get_node_num_tokens.
+        """
+        self.dsl = dsl
+        self.max_height = max_height
+        self.max_sequence = max_sequence
+        self.max_cost = max_cost
+        self.node_cost = node_cost if node_cost is not None else dsl.get_node_num_tokens
+        # Without a cost limit every cost is 0, distributions have a single entry
+        self.num_costs = max_cost + 1 if max_cost is not None else 1
+        self.type_costs: dict[type[dsl_nodes.BaseNode], int] = {}
+        self.children_dists: dict[tuple, tuple[list[list[_Option]], list[np.ndarray]]] = {}
+
+    def get_cost(self, node_type: type[dsl_nodes.BaseNode]) -> int:
+        if self.max_cost is None:
+            return 0
+        if node_type not in self.type_costs:
+            self.type_costs[node_type] = self.node_cost(node_type())
+        return self.type_costs[node_type]
+
+    def _delta(self, cost: int) -> np.ndarray:
+        dist = np.zeros(self.num_costs)
+        if cost < self.num_costs:
+            dist[cost] = 1.
+        return dist
+
+    def _shift(self, dist: np.ndarray, cost: int) -> np.ndarray:
+        shifted = np.zeros(self.num_costs)
+        if cost < self.num_costs:
+            shifted[cost:] = dist[:self.num_costs - cost]
+        return shifted
+
+    def _convolve(self, dist: np.ndarray, other: np.ndarray) -> np.ndarray:
+        return np.convolve(dist, other)[:self.num_costs]
+
+    def _get_option(self, node_type: type[dsl_nodes.BaseNode], prob: float, height: int, sequence: int,
+                    room: int, chain: int) -> Union[_Option, None]:
+        # room is the height left above the option in the program, chain the Concatenate sequence
+        # ending at the option, both already account for the option itself
+        if room < 0 or chain > self.max_sequence - 1:
+            return None
+        cost = self.get_cost(node_type)
+        if node_type.get_number_children() == 0:
+            return _Option(node_type, prob, cost, None, self._delta(cost))
+        state = (node_type, height, sequence, room, chain)
+        _, suffix_dists = self._get_children_dists(*state)
+        return _Option(node_type, prob, cost, state, self._shift(suffix_dists[0], cost))
+
+    def _get_children_dists(self, node_type: type[dsl_nodes.BaseNode], height: int, sequence: int,
+                            room: int, chain: int) -> tuple[list[list[_Option]], list[np.ndarray]]:
+        # Options of each child slot, and the cost distribution of the valid subtrees of the slots
+        # from each index to the last one
+        state = (node_type, height, sequence, room, chain)
+        if state in self.children_dists:
+            return self.children_dists[state]
+        is_sequence = issubclass(node_type, dsl_nodes.Concatenate)
+        slots_options = []
+        for i in range(node_type.get_number_children()):
+            child_table = self.dsl.get_children_table(node_type, i, height >= self.max_height,
+                                                      is_sequence and sequence + 1 >= self.max_sequence)
+            options = []
+            for child_type, prob in zip(child_table.values, child_table.probs):
+                if prob == 0.:
+                    continue
+                if issubclass(child_type, dsl_nodes.Concatenate):
+                    child_chain = chain + 1 if is_sequence else 1
+                else:
+                    child_chain = 0
+                option = self._get_option(child_type, prob, height + child_type.get_node_depth(),
+                                          sequence + 1 if is_sequence else 1,
+                                          room - child_type.get_node_depth(), child_chain)
+                if option is not None:
+                    options.append(option)
+            slots_options.append(options)
+        suffix_dists = [self._delta(0)]
+        for options in reversed(slots_options):
+            slot_dist = np.zeros(self.num_costs)
+            for option in options:
+                slot_dist += option.prob * option.cost_dist
+            suffix_dists.insert(0, self._convolve(slot_dist, suffix_dists[0]))
+        self.children_dists[state] = (slots_options, suffix_dists)
+        return self.children_dists[state]
+
+    def _choose(self, options: list[_Option], rest_dist: np.ndarray, cost: Union[int, None],
+                rng: np.random.RandomState) -> tuple[_Option, int]:
+        # Draws an option and the cost of its subtree, given that the slot and the rest of the slots
+        # cost exactly cost (or at most max_cost if cost is None)
+        weights = []
+        for option in options:
+            if cost is None:
+                weights.append(option.prob * option.cost_dist)
+            else:
+                weights.append(option.prob * option.cost_dist[:cost + 1] * rest_dist[cost::-1])
+        weights = np.concatenate(weights)
+        index = _sample_index(weights / np.sum(weights), rng)
+        num_costs = len(weights) // len(options)
+        return options[index // num_costs], index % num_costs
+
+    def _fill_terminal(self, node: dsl_nodes.BaseNode, rng: np.random.RandomState) -> None:
+        if isinstance(node, dsl_nodes.Action):
+            node.name = self.dsl.get_terminal_table('action_probs').sample(rng)
+        elif isinstance(node, dsl_nodes.BoolFeature):
+            node.name = self.dsl.get_terminal_table('bool_feat_probs').sample(rng)
+        elif isinstance(node, dsl_nodes.ConstInt):
+            node.value = self.dsl.get_terminal_table('const_int_probs').sample(rng)
+
+    def _build(self, option: _Option, cost: int, rng: np.random.RandomState) -> dsl_nodes.BaseNode:
+        node = option.node_type()
+        if option.state is None:
+            self._fill_terminal(node, rng)
+        else:
+            self._sample_children(node, option.state, cost - option.cost, rng)
+        return node
+
+    def _sample_children(self, node: dsl_nodes.BaseNode, state: tuple, cost: int,
+                         rng: np.random.RandomState) -> None:
+        slots_options, suffix_dists = self._get_children_dists(*state)
+        for i, options in enumerate(slots_options):
+            option, option_cost = self._choose(options, suffix_dists[i + 1], cost, rng)
+            child = self._build(option, option_cost, rng)
+            node.set_child(i, child)
+            cost -= option_cost
+
+    def fill_children(self, node: dsl_nodes.BaseNode, rng: np.random.RandomState,
+                      current_height: int = 1, current_sequence: int = 0) -> None:
+        """Fills the children of the root node of a program, like ProgrammaticSpace._fill_children
+        until the program is valid
+
+        Args:
+            node (dsl_nodes.BaseNode): Root node, usually a dsl_nodes.Program
+            rng (np.random.RandomState): RNG to sample from
+            current_height (int, optional): Height of the root node. Defaults to 1.
+            current_sequence (int, optional): Sequence of the root node. Defaults to 0.
+        """
+        chain = 1 if isinstance(node, dsl_nodes.Concatenate) else 0
+        state = (type(node), current_height, current_sequence, self.max_height - current_height, chain)
+        _, suffix_dists = self._get_children_dists(*state)
+        budget = self.num_costs - 1 - self.get_cost(type(node))
+        if budget < 0 or np.sum(suffix_dists[0][:budget + 1]) == 0.:
+            raise Exception(f'No valid program can be sampled from {type(node).__name__}')
+        cost = _sample_index(suffix_dists[0][:budget + 1] / np.sum(suffix_dists[0][:budget + 1]), rng)
+        self._sample_children(node, state, cost, rng)
+
+    def get_mutations(self, program: dsl_nodes.Program) -> tuple[np.ndarray, list]:
+        """Computes, for each node of a program, the probability that replacing it like
+        ProgrammaticSpace._mutate_node gives a valid program
+
+        Args:
+            program (dsl_nodes.Program): Program to mutate
+
+        Returns:
+            np.ndarray: Probability of choosing each node of program.get_all_nodes()[1:], proportional
+            to its probability of a valid mutation
+            list: Options and cost budget of each node, used by sample_mutation
+        """
+        node_costs = {}
+        def get_subtree_cost(node):
+            cost = self.get_cost(type(node))
+            for child in node.children:
+                if child is not None:
+                    cost += get_subtree_cost(child)
+            node_costs[id(node)] = cost
+            return cost
+        total_cost = get_subtree_cost(program)
+        weights, mutations = [], []
+
+        # height is the height of node in the program, chain the Concatenate sequence ending at node
+        # and valid whether the program without the subtrees of the children of node is valid
+        def visit(node, height, chain, valid):
+            for i, child in enumerate(node.children):
+                if child is None:
+                    continue
+                rest_valid = valid
+                for other in node.children:
+                    if other is None or other is child:
+                        continue
+                    stats = other.get_subtree_stats()
+                    other_chain = chain + stats.sequence_run if isinstance(node, dsl_nodes.Concatenate) else 0
+                    if height + stats.height > self.max_height \
+                            or max(stats.max_sequence_run, other_chain) > self.max_sequence - 1:
+                        rest_valid = False
+                budget = self.num_costs - 1 - (total_cost - node_costs[id(child)])
+                options = self._get_mutation_options(node, i, child, height, chain) \
+                    if rest_valid and budget >= 0 else []
+                weight = 0.
+                for option in options:
+                    weight += option.prob * np.sum(option.cost_dist[:budget + 1])
+                weights.append(weight)
+                mutations.append((options, budget))
+                if isinstance(child, dsl_nodes.Concatenate):
+                    child_chain = chain + 1 if isinstance(node, dsl_nodes.Concatenate) else 1
+                else:
+                    child_chain = 0
+                child_valid = rest_valid and height + child.node_depth <= self.max_height \
+                    and child_chain <= self.max_sequence - 1
+                visit(child, height + child.node_depth, child_chain, child_valid)
+
+        visit(program, program.node_depth, 0, program.node_depth <= self.max_height)
+        weights = np.array(weights)
+        if len(weights) == 0 or np.sum(weights) == 0.:
+            raise Exception('No valid mutation of the program can be sampled')
+        return weights / np.sum(weights), mutations
+
+    def _get_mutation_options(self, parent: dsl_nodes.BaseNode, index: int, node: dsl_nodes.BaseNode,
+                              parent_height: int, parent_chain: int) -> list[_Option]:
+        # The new node is drawn without height or sequence restrictions, then its children are
+        # filled counting the height of the replaced node, restarting the sequence (as _mutate_node)
+        child_table = self.dsl.get_children_table(type(parent), index)
+        options = []
+        for child_type, prob in zip(child_table.values, child_table.probs):
+            if prob == 0.:
+                continue
+            if issubclass(child_type, dsl_nodes.Concatenate):
+                chain = parent_chain + 1
+            else:
+                chain = 0
+            option = self._get_option(child_type, prob,
+                                      parent_height + node.node_depth + child_type.get_node_depth(), 1,
+                                      self.max_height - parent_height - child_type.get_node_depth(), chain)
+            if option is not None:
+                options.append(option)
+        return options
+
+    def sample_mutation(self, mutations: tuple[np.ndarray, list],
+                        rng: np.random.RandomState) -> tuple[int, dsl_nodes.BaseNode]:
+        """Samples a valid mutation of a program
+
+        Args:
+            mutations (tuple[np.ndarray, list]): Output of get_mutations for the program
+            rng (np.random.RandomState): RNG to sample from
+
+        Returns:
+            int: Index of the node to replace in program.get_all_nodes()
+            dsl_nodes.BaseNode: New subtree
+        """
+        probs, node_mutations = mutations
+        index = _sample_index(probs, rng)
+        options, budget = node_mutations[index]
+        option, cost = self._choose([self._truncated(option, budget) for option in options], None, None, rng)
+        return index + 1, self._build(option, cost, rng)
+
+    def _truncated(self, option: _Option, budget: int) -> _Option:
+        cost_dist = np.zeros(self.num_costs)
+        cost_dist[:budget + 1] = option.cost_dist[:budget + 1]
+        return _Option(option.node_type, option.prob, option.cost, option.state, cost_dist)
@@ -0,0 +1,70 @@
+from __future__ import annotations
+import itertools
+from typing import Union
+
+from .dsl_nodes import BaseNode
+
+# Ids are unique across all tables, so an id cached on a node by another (or a cleared) table is
+# never mistaken for one of this table
+_subtree_ids = itertools.count()
+
+
+class SubtreeTable:
+    """Hash-consing table giving every distinct subtree a canonical integer id.
+
+    A subtree is identified by the label of its root (node type and attributes, see
+    BaseNode.get_label) and the ids of its children, so two subtrees get the same id if and only if
+    they are structurally equal. Ids are cached on the nodes and cleared by set_child like the other
+    node caches: subtrees shared between programs (see BaseNode.shallow_copy) are only hashed once,
+    after which comparing programs or looking up results per subtree (e.g. evaluation caches) takes
+    constant time. Nodes are not made immutable or shared by the table, programs stay trees.
+
+    The table is cleared once it holds max_size subtrees. Ids given before are never given again, so
+    subtrees hashed before and after a clear are only compared as different (a slower comparison,
+    never a wrong one).
+    """
+
+    def __init__(self, max_size: int = 1000000):
+        """
+        Args:
+            max_size (int, optional): Maximum number of subtrees. Defaults to 1000000.
+        """
+        self.max_size = max_size
+        self.ids: dict[tuple, int] = {}
+        self.keys: dict[int, tuple] = {}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def clear(self) -> None:
+        self.ids = {}
+        self.keys = {}
+
+    def get_id(self, node: Union[BaseNode, None]) -> Union[int, None]:
+        """Canonical id of the subtree of node (None for an empty hole)"""
+        # Only cleared between calls, so the ids of the children of a subtree are always in the table
+        if len(self.ids) >= self.max_size:
+            self.clear()
+        return self._get_id(node)
+
+    def _get_id(self, node: Union[BaseNode, None]) -> Union[int, None]:
+        if node is None:
+            return None
+        subtree_id = node.subtree_id
+        if subtree_id is not None and subtree_id in self.keys:
+            return subtree_id
+        key = node.get_label() + tuple(self._get_id(child) for child in node.children)
+        subtree_id = self.ids.get(key)
+        if subtree_id is None:
+            subtree_id = next(_subtree_ids)
+            self.ids[key] = subtree_id
+            self.keys[subtree_id] = key
+        node.subtree_id = subtree_id
+        return subtree_id
+
+    def get_key(self, subtree_id: int) -> tuple:
+        """Label of the root of the subtree followed by the ids of its children"""
+        return self.keys[subtree_id]
+
+    def equals(self, node: Union[BaseNode, None], other: Union[BaseNode, None]) -> bool:
+        return node is other or self.get_id(node) == self.get_id(other)
@@ -5,8 +5,9 @@ import copy
 
 import numpy as np
 
-from .environment import BaseEnvironment
+from .environment import BaseEnvironment, EnvironmentListener
 from . import dsl_nodes
+from .compiler import CompiledProgram, compile_program
 from PIL import Image
 
 from ..utils.indent import node_to_indent_python, record_node_to_indent_python
@@ -15,27 +16,43 @@ class TerminateException(Exception):
     pass
 
 class BaseTask(ABC):
-    
+
+    # Attributes of the task updated by get_reward during an episode, saved in checkpoints
+    episode_attributes: tuple[str, ...] = ()
+    # Tasks whose get_reward draws from self.rng cannot resume an episode from a checkpoint
+    checkpointable: bool = True
+    # Maximum episodic return in one environment, bounds the mean return of partial evaluations
+    max_return: float = 1.0
+
     def __init__(self, env_args: dict = {}, seed: Union[int, None] = None):
         if seed is not None:
             self.rng = np.random.RandomState(seed)
         else:
             self.rng = np.random.RandomState()
         self.seed = seed
+        # RNG state right after seeding, restored on every reset instead of re-seeding
+        self.initial_rng_state = np.random.RandomState(seed).get_state() if seed is not None else None
         self.crash_penalty = -1.
         self.initial_environment = self.generate_initial_environment(env_args)
+        self.initial_snapshot = self.initial_environment.snapshot()
+        self.environment = copy.deepcopy(self.initial_environment)
+        # Tasks with incremental rewards keep running statistics updated by the environment events,
+        # reset_environment has to reset them
+        if isinstance(self, EnvironmentListener):
+            self.environment.add_listener(self)
         self.reset_environment()
         self.program_num = 0
+        self.batch_environment_cache = None
     
     def get_environment(self) -> BaseEnvironment:
         return self.environment
     
     def reset_environment(self) -> None:
         if self.seed is not None:
-            self.rng = np.random.RandomState(self.seed)
+            self.rng.set_state(self.initial_rng_state)
         else:
             self.rng = np.random.RandomState()
-        self.environment = copy.deepcopy(self.initial_environment)
+        self.environment.restore(self.initial_snapshot)
     
     @abstractmethod
     def generate_initial_environment(self, env_args: dict) -> BaseEnvironment:
@@ -65,7 +82,14 @@ class BaseTask(ABC):
         action_nodes = [node for node in all_nodes if isinstance(node, dsl_nodes.Action)]
         action_scores = {node: 0. for node in action_nodes}
         action_counts = {node: 0 for node in action_nodes}
-        for action in program.run_generator(self.environment):
+        # Neighbors share subtrees with the program they were built from, so the parent links of
+        # those nodes point into the other program. The parents are taken from this program instead
+        parents = {}
+        for node in all_nodes:
+            for child in node.children:
+                if child is not None:
+                    parents[child] = node
+        for action in compile_program(program).run_generator(self.environment):
             terminated, instant_reward = self.get_reward(self.environment)
             if self.environment.is_crashed():
                 instant_reward += self.crash_penalty
@@ -79,20 +103,166 @@ class BaseTask(ABC):
             while not issubclass(type(current_node), dsl_nodes.Program):
                 node_score[current_node] += action_scores[action]
                 node_count[current_node] += action_counts[action]
-                current_node = current_node.parent
+                current_node = parents[current_node]
         return reward, node_score, node_count
     
-    def evaluate_program(self, program: dsl_nodes.Program) -> float:
+    def evaluate_program(self, program: Union[dsl_nodes.Program, CompiledProgram]) -> float:
         self.program_num += 1
         self.reset_environment()
         reward = 0.
-        for _ in program.run_generator(self.environment):
+        for _ in compile_program(program).run_generator(self.environment):
+            terminated, instant_reward = self.get_reward(self.environment)
+            reward += instant_reward
+            if terminated or self.environment.is_crashed():
+                break
+        return reward
+
+    def evaluate_program_trace(self, program: Union[dsl_nodes.Program, CompiledProgram]) -> tuple[float, int]:
+        """Evaluates a program like evaluate_program, also fingerprinting the actions it runs
+
+        Args:
+            program (Union[dsl_nodes.Program, CompiledProgram]): Input program
+
+        Returns:
+            float: Episodic return
+            int: Hash of the sequence of actions, whether the episode crashed (including running out
+            of max_calls) and the return. With a seed, programs that run the same actions have the
+            same episode, so the same return
+        """
+        self.program_num += 1
+        self.reset_environment()
+        reward = 0.
+        trace = []
+        for action in compile_program(program).run_generator(self.environment):
+            trace.append(action.name)
+            terminated, instant_reward = self.get_reward(self.environment)
+            reward += instant_reward
+            if terminated or self.environment.is_crashed():
+                break
+        return reward, hash((tuple(trace), self.environment.is_crashed(), reward))
+
+    def get_episode_state(self) -> tuple:
+        return tuple(getattr(self, name) for name in self.episode_attributes)
+
+    def set_episode_state(self, episode_state: tuple) -> None:
+        for name, value in zip(self.episode_attributes, episode_state):
+            setattr(self, name, value)
+
+    # Checkpoints: the episode of a program is recorded once, then programs that only differ from it
+    # in one subtree (e.g. hill climbing neighbors) resume from the first time that subtree is reached
+    def record_checkpoints(self, program: Union[dsl_nodes.Program, CompiledProgram]) -> dict:
+        """Runs the program like evaluate_program (without counting it), saving the episode state the
+        first time each statement is reached
+
+        Args:
+            program (Union[dsl_nodes.Program, CompiledProgram]): Program, compiled with
+            record_checkpoints if already compiled
+
+        Returns:
+            dict: "reward" is the episodic return, "checkpoints" maps each reached statement path to
+            (environment snapshot, episode state, return so far, While visited states, Repeat counters)
+        """
+        assert self.checkpointable, f"{type(self).__name__} does not support checkpoints"
+        if not isinstance(program, CompiledProgram):
+            program = CompiledProgram(program, record_checkpoints=True)
+        assert program.record_checkpoints, "Program must be compiled with record_checkpoints"
+        checkpoints = {}
+        reward = 0.
+
+        def save_checkpoint(paths, counters, seen_hashes):
+            if paths[0] in checkpoints:
+                return
+            checkpoint = (
+                self.environment.snapshot(),
+                self.get_episode_state(),
+                reward,
+                {path: set(hashes) for path, hashes in zip(program.loop_paths, seen_hashes) if len(hashes) > 0},
+                dict(zip(program.repeat_paths, counters)),
+            )
+            for path in paths:
+                checkpoints[path] = checkpoint
+
+        self.reset_environment()
+        for _ in program.run_generator(self.environment, recorder=save_checkpoint):
+            terminated, instant_reward = self.get_reward(self.environment)
+            reward += instant_reward
+            if terminated or self.environment.is_crashed():
+                break
+        return {"reward": reward, "checkpoints": checkpoints}
+
+    def evaluate_program_from_checkpoint(self, program: Union[dsl_nodes.Program, CompiledProgram],
+                                         record: dict, path: tuple[int, ...]) -> float:
+        """Evaluates a program that executes like the recorded one until the statement at path is
+        reached, resuming from the checkpoint of that statement
+
+        Args:
+            program (Union[dsl_nodes.Program, CompiledProgram]): Program to evaluate
+            record (dict): Output of record_checkpoints for the reference program
+            path (tuple[int, ...]): Path of the first statement where the programs differ
+
+        Returns:
+            float: Episodic return, the same as evaluate_program
+        """
+        self.program_num += 1
+        # The recorded episode never reached the statement, so it is also the episode of this program
+        if path not in record["checkpoints"]:
+            return record["reward"]
+        environment_snapshot, episode_state, reward, loop_states, repeat_counters = record["checkpoints"][path]
+        self.reset_environment()
+        self.environment.restore(environment_snapshot)
+        self.set_episode_state(episode_state)
+        program = compile_program(program)
+        frame = program.get_frame(path, loop_states, repeat_counters)
+        for _ in program.run_generator(self.environment, frame=frame):
             terminated, instant_reward = self.get_reward(self.environment)
             reward += instant_reward
             if terminated or self.environment.is_crashed():
                 break
         return reward
 
+    # Batched evaluation: tasks that implement reset_batch and get_batch_reward can score a program
+    # on all their seeds at once through CompiledProgram.run_batch
+    @classmethod
+    def reset_batch(cls, tasks: list[BaseTask]) -> Union[dict[str, np.ndarray], None]:
+        """Builds the stacked episode state (one entry per task) used by get_batch_reward, or None if
+        the task has no vectorized reward"""
+        return None
+
+    @classmethod
+    def get_batch_reward(cls, episode: dict[str, np.ndarray], environment,
+                         lanes: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        raise Exception('Unimplemented method: get_batch_reward')
+
+    @classmethod
+    def evaluate_program_batch(cls, program: Union[dsl_nodes.Program, CompiledProgram],
+                               tasks: list[BaseTask]) -> Union[list[float], None]:
+        """Evaluates a program in all tasks at once, returns None if batched evaluation is not
+        supported for this task, environment or program"""
+        if len(tasks) == 0:
+            return []
+        program = compile_program(program)
+        if not program.supports_batch() or any(type(task) != cls for task in tasks):
+            return None
+        episode = cls.reset_batch(tasks)
+        if episode is None:
+            return None
+        # The stacked initial environments are kept by the first task and restored on later calls
+        key = tuple(id(task) for task in tasks)
+        if tasks[0].batch_environment_cache is None or tasks[0].batch_environment_cache[0] != key:
+            environment = type(tasks[0].initial_environment).stack([task.initial_environment for task in tasks])
+            if environment is None:
+                return None
+            tasks[0].batch_environment_cache = (key, environment, environment.snapshot())
+        else:
+            _, environment, initial_snapshot = tasks[0].batch_environment_cache
+            environment.restore(initial_snapshot)
+        for task in tasks:
+            task.program_num += 1
+        returns = program.run_batch(
+            environment, lambda env, lanes: cls.get_batch_reward(episode, env, lanes)
+        )
+        return returns.tolist()
+
     def record_evaluate_program(self, program: dsl_nodes.Program) -> tuple[float, list[list[dict[str, str]]]]:
         self.program_num += 1
         self.reset_environment()
@@ -126,7 +296,7 @@ class BaseTask(ABC):
         self.reset_environment()
         im = Image.fromarray(self.environment.to_image(root_dir=root_dir))
         im_list = []
-        for _ in program.run_generator(self.environment):
+        for _ in compile_program(program).run_generator(self.environment):
             terminated, _ = self.get_reward(self.environment)
             im_list.append(Image.fromarray(self.environment.to_image(root_dir=root_dir)))
             if len(im_list) > max_steps or terminated or self.environment.is_crashed():
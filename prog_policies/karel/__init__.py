@@ -1,3 +1,3 @@
 from .dsl import KarelDSL
-from .environment import KarelEnvironment
+from .environment import KarelEnvironment, KarelEnvironmentListener, CompactKarelEnvironment, make_karel_environment
 from .generator import KarelProgramGenerator, KarelStateGenerator
\ No newline at end of file
@@ -59,3 +59,14 @@ class KarelDSL(BaseDSL):
         return {
             i: 1 / 20 for i in range(20)
         }
+    
+    @property
+    def complementary_features(self):
+        return {
+            'markersPresent': 'noMarkersPresent',
+            'noMarkersPresent': 'markersPresent'
+        }
+    
+    @property
+    def rotation_actions(self):
+        return ('turnLeft', 'turnRight')
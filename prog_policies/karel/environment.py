@@ -7,7 +7,7 @@ from typing import Union
 import numpy as np
 import hashlib
 
-from prog_policies.base import BaseEnvironment
+from prog_policies.base import BaseEnvironment, EnvironmentListener
 
 MAX_API_CALLS = 10000
 MAX_MARKERS_PER_SQUARE = 10
@@ -31,6 +31,53 @@ STATE_TABLE = {
     15: '10 markers'
 }
 
+class ZobristTable:
+    """Random 63-bit keys for every (cell, direction) hero placement and every (cell, count) marker
+    value, shared by all environments of the same size. A state fingerprint is the XOR of the keys
+    of its hero and markers, so actions update it with one or two XORs.
+    """
+
+    tables: dict[tuple[int, int], ZobristTable] = {}
+
+    def __init__(self, env_height: int, env_width: int):
+        rng = np.random.default_rng(env_height * 1000 + env_width)
+        self.hero = rng.integers(1, 2 ** 63, size=(env_height, env_width, 4), dtype=np.int64).tolist()
+        markers = rng.integers(1, 2 ** 63, size=(env_height, env_width, MAX_MARKERS_PER_SQUARE + 1), dtype=np.int64)
+        # Empty cells contribute nothing, so only cells with markers are needed to build a fingerprint
+        markers[:, :, 0] = 0
+        self.markers_array = markers
+        self.markers = markers.tolist()
+
+    @classmethod
+    def get(cls, env_height: int, env_width: int) -> ZobristTable:
+        if (env_height, env_width) not in cls.tables:
+            cls.tables[(env_height, env_width)] = cls(env_height, env_width)
+        return cls.tables[(env_height, env_width)]
+
+    def markers_fingerprint(self, markers_grid: np.ndarray) -> int:
+        keys = np.take_along_axis(self.markers_array, markers_grid[:, :, None].astype(np.intp), axis=2)
+        return int(np.bitwise_xor.reduce(keys, axis=None))
+
+    # Tables are immutable and shared, copying an environment keeps the reference
+    def __copy__(self) -> ZobristTable:
+        return self
+
+    def __deepcopy__(self, memo: dict) -> ZobristTable:
+        return self
+
+
+class KarelEnvironmentListener(EnvironmentListener):
+    """Events of a KarelEnvironment, sent after every change of the markers or of the hero cell.
+    Tasks implementing them can keep running totals instead of scanning the grid after each action.
+    """
+
+    def on_marker_change(self, r: int, c: int, previous: int, current: int) -> None:
+        pass
+
+    def on_hero_move(self, r: int, c: int) -> None:
+        pass
+
+
 class KarelEnvironment(BaseEnvironment):
 
     def __init__(self, env_height=8, env_width=8, crashable=True, leaps_behaviour=False,
@@ -70,6 +117,8 @@ class KarelEnvironment(BaseEnvironment):
         d, r, c = np.where(self.state[:4, :, :] > 0)
         self.hero_pos = [r[0], c[0], d[0]]
         self.markers_grid = self.state[5:, :, :].argmax(axis=0)
+        self.zobrist = ZobristTable.get(state.shape[1], state.shape[2])
+        self.markers_fingerprint = self.zobrist.markers_fingerprint(self.markers_grid)
         
         
     @classmethod
@@ -174,6 +223,16 @@ class KarelEnvironment(BaseEnvironment):
     
     def get_state(self):
         return self.state
+
+    def snapshot(self) -> tuple:
+        return self.state.copy(), self.markers_grid.copy(), list(self.hero_pos), self.markers_fingerprint, \
+            self.num_calls, self.crashed
+
+    def restore(self, snapshot: tuple) -> None:
+        state, markers_grid, hero_pos, self.markers_fingerprint, self.num_calls, self.crashed = snapshot
+        np.copyto(self.state, state)
+        np.copyto(self.markers_grid, markers_grid)
+        self.hero_pos = list(hero_pos)
     
     def __eq__(self, other: "KarelEnvironment"):
         this_r, this_c, this_d = self.get_hero_pos()
@@ -194,6 +253,10 @@ class KarelEnvironment(BaseEnvironment):
         # Return the hexadecimal digest truncated to the specified size
         return sample_hash.hexdigest()[:size]
     
+    def state_fingerprint(self) -> int:
+        r, c, d = self.hero_pos
+        return self.markers_fingerprint ^ self.zobrist.hero[r][c][d]
+
     def get_hero_pos(self):
         return self.hero_pos
     
@@ -212,6 +275,16 @@ class KarelEnvironment(BaseEnvironment):
             return False
         return not self.state[4, r, c]
 
+    def set_wall(self, r: int, c: int, value: bool = True) -> None:
+        self.state[4, r, c] = value
+
+    def get_walls_grid(self) -> np.ndarray:
+        return self.state[4].copy()
+
+    @classmethod
+    def stack(cls, environments: list[KarelEnvironment]) -> BatchKarelEnvironment:
+        return BatchKarelEnvironment(environments)
+
     def front_is_clear(self) -> bool:
         row, col, d = self.hero_pos
         if d == 0:
@@ -275,6 +348,8 @@ class KarelEnvironment(BaseEnvironment):
             self.state[d, r, c] = False
             self.state[d, new_r, new_c] = True
             self.hero_pos = [new_r, new_c, d]
+            for listener in self.listeners:
+                listener.on_hero_move(new_r, new_c)
         elif self.leaps_behaviour:
             self.turn_left()
             self.turn_left()
@@ -303,6 +378,10 @@ class KarelEnvironment(BaseEnvironment):
             self.state[5 + num_marker, r, c] = False
             self.state[4 + num_marker, r, c] = True
             self.markers_grid[r, c] -= 1
+            cell_keys = self.zobrist.markers[r][c]
+            self.markers_fingerprint ^= cell_keys[num_marker] ^ cell_keys[num_marker - 1]
+            for listener in self.listeners:
+                listener.on_marker_change(r, c, int(num_marker), int(num_marker) - 1)
     
     def pick_marker_env(self, r: int, c: int) -> None:
         num_marker = self.markers_grid[r, c]
@@ -313,6 +392,10 @@ class KarelEnvironment(BaseEnvironment):
             self.state[5 + num_marker, r, c] = False
             self.state[4 + num_marker, r, c] = True
             self.markers_grid[r, c] -= 1
+            cell_keys = self.zobrist.markers[r][c]
+            self.markers_fingerprint ^= cell_keys[num_marker] ^ cell_keys[num_marker - 1]
+            for listener in self.listeners:
+                listener.on_marker_change(r, c, int(num_marker), int(num_marker) - 1)
     
     def put_marker(self) -> None:
         r, c, _ = self.hero_pos
@@ -324,6 +407,10 @@ class KarelEnvironment(BaseEnvironment):
             self.state[5 + num_marker, r, c] = False
             self.state[6 + num_marker, r, c] = True
             self.markers_grid[r, c] += 1
+            cell_keys = self.zobrist.markers[r][c]
+            self.markers_fingerprint ^= cell_keys[num_marker] ^ cell_keys[num_marker + 1]
+            for listener in self.listeners:
+                listener.on_marker_change(r, c, int(num_marker), int(num_marker) + 1)
             
     def put_marker_env(self, r: int, c: int) -> None:
         num_marker = self.markers_grid[r, c]
@@ -334,6 +421,10 @@ class KarelEnvironment(BaseEnvironment):
             self.state[5 + num_marker, r, c] = False
             self.state[6 + num_marker, r, c] = True
             self.markers_grid[r, c] += 1
+            cell_keys = self.zobrist.markers[r][c]
+            self.markers_fingerprint ^= cell_keys[num_marker] ^ cell_keys[num_marker + 1]
+            for listener in self.listeners:
+                listener.on_marker_change(r, c, int(num_marker), int(num_marker) + 1)
 
 
     # Cannot support non-self state right now
@@ -403,4 +494,283 @@ class KarelEnvironment(BaseEnvironment):
                     rowStr += "\t"
             worldStr += rowStr
             if(r != rows-1): worldStr += '\n'
-        return worldStr
\ No newline at end of file
+        return worldStr
+
+
+class CompactKarelEnvironment(KarelEnvironment):
+    """Karel environment storing walls as an integer bitmask, markers as an int8 grid and the hero
+    as plain ints. The one-hot state tensor is only built when requested (e.g. get_state, to_image)
+    and should be treated as read-only: walls are changed through set_wall.
+    """
+
+    def set_state(self, state: np.ndarray):
+        _, self.env_height, self.env_width = state.shape
+        # Bit r * env_width + c of the mask is the wall at (r, c)
+        self.walls = int.from_bytes(np.packbits(state[4].ravel(), bitorder='little').tobytes(), 'little')
+        d, r, c = np.where(state[:4, :, :] > 0)
+        self.hero_pos = [int(r[0]), int(c[0]), int(d[0])]
+        self.markers_grid = state[5:, :, :].argmax(axis=0).astype(np.int8)
+        self.zobrist = ZobristTable.get(self.env_height, self.env_width)
+        self.markers_fingerprint = self.zobrist.markers_fingerprint(self.markers_grid)
+        self._state = None
+
+    @property
+    def state(self) -> np.ndarray:
+        if self._state is None:
+            state = np.zeros(self.state_shape, dtype=bool)
+            state[4, :, :] = self.get_walls_grid()
+            state[5:, :, :] = self.markers_grid[None, :, :] == np.arange(MAX_MARKERS_PER_SQUARE + 1)[:, None, None]
+            r, c, d = self.hero_pos
+            state[d, r, c] = True
+            self._state = state
+        return self._state
+
+    def get_state(self):
+        return self.state
+
+    def snapshot(self) -> tuple:
+        return self.walls, self.markers_grid.copy(), list(self.hero_pos), self.markers_fingerprint, \
+            self.num_calls, self.crashed
+
+    def restore(self, snapshot: tuple) -> None:
+        self.walls, markers_grid, hero_pos, self.markers_fingerprint, self.num_calls, self.crashed = snapshot
+        np.copyto(self.markers_grid, markers_grid)
+        self.hero_pos = list(hero_pos)
+        self._state = None
+
+    def get_walls_grid(self) -> np.ndarray:
+        num_cells = self.env_height * self.env_width
+        walls_bytes = np.frombuffer(self.walls.to_bytes((num_cells + 7) // 8, 'little'), dtype=np.uint8)
+        walls_grid = np.unpackbits(walls_bytes, count=num_cells, bitorder='little')
+        return walls_grid.astype(bool).reshape(self.env_height, self.env_width)
+
+    def is_clear(self, r: int, c: int) -> bool:
+        if r < 0 or c < 0 or r >= self.env_height or c >= self.env_width:
+            return False
+        return not (self.walls >> (r * self.env_width + c)) & 1
+
+    def set_wall(self, r: int, c: int, value: bool = True) -> None:
+        if value:
+            self.walls |= 1 << (r * self.env_width + c)
+        else:
+            self.walls &= ~(1 << (r * self.env_width + c))
+        self._state = None
+
+    def front_is_clear(self) -> bool:
+        row, col, d = self.hero_pos
+        delta_r, delta_c = self.direction_map[d]
+        return self.is_clear(row + delta_r, col + delta_c)
+
+    def left_is_clear(self) -> bool:
+        row, col, d = self.hero_pos
+        delta_r, delta_c = self.direction_map[(d - 1) % 4]
+        return self.is_clear(row + delta_r, col + delta_c)
+
+    def right_is_clear(self) -> bool:
+        row, col, d = self.hero_pos
+        delta_r, delta_c = self.direction_map[(d + 1) % 4]
+        return self.is_clear(row + delta_r, col + delta_c)
+
+    def move(self):
+        r, c, d = self.hero_pos
+
+        delta_r, delta_c = self.direction_map[d]
+        new_r, new_c = r + delta_r, c + delta_c
+
+        is_clear = self.is_clear(new_r, new_c)
+
+        if not is_clear and self.crashable:
+            self.crashed = True
+
+        if not self.crashed and is_clear:
+            self.hero_pos = [new_r, new_c, d]
+            self._state = None
+            for listener in self.listeners:
+                listener.on_hero_move(new_r, new_c)
+        elif self.leaps_behaviour:
+            self.hero_pos = [r, c, (d + 2) % 4]
+            self._state = None
+
+    def turn_left(self) -> None:
+        r, c, d = self.hero_pos
+        self.hero_pos = [r, c, (d - 1) % 4]
+        self._state = None
+
+    def turn_right(self) -> None:
+        r, c, d = self.hero_pos
+        self.hero_pos = [r, c, (d + 1) % 4]
+        self._state = None
+
+    def pick_marker(self) -> None:
+        r, c, _ = self.hero_pos
+        self.pick_marker_env(r, c)
+
+    def pick_marker_env(self, r: int, c: int) -> None:
+        num_marker = int(self.markers_grid[r, c])
+        if num_marker == 0:
+            if self.crashable:
+                self.crashed = True
+        else:
+            self.markers_grid[r, c] = num_marker - 1
+            cell_keys = self.zobrist.markers[r][c]
+            self.markers_fingerprint ^= cell_keys[num_marker] ^ cell_keys[num_marker - 1]
+            for listener in self.listeners:
+                listener.on_marker_change(r, c, int(num_marker), int(num_marker) - 1)
+            self._state = None
+
+    def put_marker(self) -> None:
+        r, c, _ = self.hero_pos
+        self.put_marker_env(r, c)
+
+    def put_marker_env(self, r: int, c: int) -> None:
+        num_marker = int(self.markers_grid[r, c])
+        if num_marker == MAX_MARKERS_PER_SQUARE:
+            if self.crashable:
+                self.crashed = True
+        else:
+            self.markers_grid[r, c] = num_marker + 1
+            cell_keys = self.zobrist.markers[r][c]
+            self.markers_fingerprint ^= cell_keys[num_marker] ^ cell_keys[num_marker + 1]
+            for listener in self.listeners:
+                listener.on_marker_change(r, c, int(num_marker), int(num_marker) + 1)
+            self._state = None
+
+
+class BatchKarelEnvironment:
+    """Several Karel environments of the same size executed in lockstep. Every per-environment
+    quantity is stacked along the first axis (lanes) and actions/features take the array of lanes
+    they apply to, so one numpy operation advances all of them.
+    """
+
+    # Row and column offsets indexed by direction
+    delta_r = np.array([-1, 0, 1, 0])
+    delta_c = np.array([0, 1, 0, -1])
+
+    def __init__(self, environments: list[KarelEnvironment]):
+        reference = environments[0]
+        for env in environments:
+            assert env.state_shape == reference.state_shape, "Environments must share the same shape"
+            assert env.crashable == reference.crashable and env.leaps_behaviour == reference.leaps_behaviour
+            assert env.max_calls == reference.max_calls
+        _, self.env_height, self.env_width = reference.state_shape
+        self.num_lanes = len(environments)
+        self.crashable = reference.crashable
+        self.leaps_behaviour = reference.leaps_behaviour
+        self.max_calls = reference.max_calls
+        self.walls_grid = np.stack([env.get_walls_grid() for env in environments])
+        self.markers_grid = np.stack([env.markers_grid for env in environments]).astype(np.int64)
+        # Running total of markers per lane, updated by pick_marker and put_marker
+        self.num_markers = self.markers_grid.sum(axis=(1, 2))
+        self.hero_pos = np.array([env.hero_pos for env in environments], dtype=np.int64)
+        self.num_calls = np.array([env.num_calls for env in environments], dtype=np.int64)
+        self.crashed = np.array([env.crashed for env in environments], dtype=bool)
+        self.actions = {
+            "move": self.move,
+            "turnLeft": self.turn_left,
+            "turnRight": self.turn_right,
+            "pickMarker": self.pick_marker,
+            "putMarker": self.put_marker
+        }
+        self.bool_features = {
+            "frontIsClear": self.front_is_clear,
+            "leftIsClear": self.left_is_clear,
+            "rightIsClear": self.right_is_clear,
+            "markersPresent": self.markers_present,
+            "noMarkersPresent": self.no_markers_present
+        }
+
+    def snapshot(self) -> tuple:
+        return self.walls_grid.copy(), self.markers_grid.copy(), self.num_markers.copy(), \
+            self.hero_pos.copy(), self.num_calls.copy(), self.crashed.copy()
+
+    def restore(self, snapshot: tuple) -> None:
+        for buffer, saved in zip((self.walls_grid, self.markers_grid, self.num_markers, self.hero_pos,
+                                  self.num_calls, self.crashed), snapshot):
+            np.copyto(buffer, saved)
+
+    def count_calls(self, lanes: np.ndarray) -> None:
+        self.num_calls[lanes] += 1
+        self.crashed[lanes] |= self.num_calls[lanes] > self.max_calls
+
+    def run_action(self, action: str, lanes: np.ndarray) -> None:
+        self.count_calls(lanes)
+        self.actions[action](lanes)
+
+    def get_bool_feature(self, feature: str, lanes: np.ndarray) -> np.ndarray:
+        self.count_calls(lanes)
+        return self.bool_features[feature](lanes)
+
+    # Equivalent of KarelEnvironment.hash for a single lane: hero position and markers
+    def state_key(self, lane: int) -> tuple:
+        r, c, d = self.hero_pos[lane]
+        return int(r), int(c), int(d), self.markers_grid[lane].tobytes()
+
+    def is_clear(self, lanes: np.ndarray, r: np.ndarray, c: np.ndarray) -> np.ndarray:
+        inside = (r >= 0) & (c >= 0) & (r < self.env_height) & (c < self.env_width)
+        return inside & ~self.walls_grid[lanes, r.clip(0, self.env_height - 1), c.clip(0, self.env_width - 1)]
+
+    def direction_is_clear(self, lanes: np.ndarray, direction: np.ndarray) -> np.ndarray:
+        r, c = self.hero_pos[lanes, 0], self.hero_pos[lanes, 1]
+        return self.is_clear(lanes, r + self.delta_r[direction], c + self.delta_c[direction])
+
+    def front_is_clear(self, lanes: np.ndarray) -> np.ndarray:
+        return self.direction_is_clear(lanes, self.hero_pos[lanes, 2])
+
+    def left_is_clear(self, lanes: np.ndarray) -> np.ndarray:
+        return self.direction_is_clear(lanes, (self.hero_pos[lanes, 2] - 1) % 4)
+
+    def right_is_clear(self, lanes: np.ndarray) -> np.ndarray:
+        return self.direction_is_clear(lanes, (self.hero_pos[lanes, 2] + 1) % 4)
+
+    def markers_present(self, lanes: np.ndarray) -> np.ndarray:
+        return self.markers_grid[lanes, self.hero_pos[lanes, 0], self.hero_pos[lanes, 1]] > 0
+
+    def no_markers_present(self, lanes: np.ndarray) -> np.ndarray:
+        return self.markers_grid[lanes, self.hero_pos[lanes, 0], self.hero_pos[lanes, 1]] == 0
+
+    def move(self, lanes: np.ndarray) -> None:
+        r, c, d = self.hero_pos[lanes, 0], self.hero_pos[lanes, 1], self.hero_pos[lanes, 2]
+        new_r, new_c = r + self.delta_r[d], c + self.delta_c[d]
+        is_clear = self.is_clear(lanes, new_r, new_c)
+        if self.crashable:
+            self.crashed[lanes] |= ~is_clear
+        moving = is_clear & ~self.crashed[lanes]
+        self.hero_pos[lanes[moving], 0] = new_r[moving]
+        self.hero_pos[lanes[moving], 1] = new_c[moving]
+        if self.leaps_behaviour:
+            turning = lanes[~moving]
+            self.hero_pos[turning, 2] = (self.hero_pos[turning, 2] + 2) % 4
+
+    def turn_left(self, lanes: np.ndarray) -> None:
+        self.hero_pos[lanes, 2] = (self.hero_pos[lanes, 2] - 1) % 4
+
+    def turn_right(self, lanes: np.ndarray) -> None:
+        self.hero_pos[lanes, 2] = (self.hero_pos[lanes, 2] + 1) % 4
+
+    def pick_marker(self, lanes: np.ndarray) -> None:
+        r, c = self.hero_pos[lanes, 0], self.hero_pos[lanes, 1]
+        empty = self.markers_grid[lanes, r, c] == 0
+        if self.crashable:
+            self.crashed[lanes] |= empty
+        self.markers_grid[lanes[~empty], r[~empty], c[~empty]] -= 1
+        self.num_markers[lanes[~empty]] -= 1
+
+    def put_marker(self, lanes: np.ndarray) -> None:
+        r, c = self.hero_pos[lanes, 0], self.hero_pos[lanes, 1]
+        full = self.markers_grid[lanes, r, c] == MAX_MARKERS_PER_SQUARE
+        if self.crashable:
+            self.crashed[lanes] |= full
+        self.markers_grid[lanes[~full], r[~full], c[~full]] += 1
+        self.num_markers[lanes[~full]] += 1
+
+
+KAREL_BACKENDS = {
+    "onehot": KarelEnvironment,
+    "compact": CompactKarelEnvironment,
+}
+
+
+def make_karel_environment(backend: str = "onehot", **env_args) -> KarelEnvironment:
+    """Builds a Karel environment with the requested state backend ("onehot" or "compact")."""
+    assert backend in KAREL_BACKENDS, f"Unknown Karel backend: {backend}"
+    return KAREL_BACKENDS[backend](**env_args)
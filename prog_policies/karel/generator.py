@@ -2,15 +2,16 @@ from __future__ import annotations
 import numpy as np
 
 from ..base.dsl import BaseDSL, dsl_nodes
+from ..base.sampler import ProgramSampler
 
-from .environment import KarelEnvironment
+from .environment import KarelEnvironment, make_karel_environment
 
 
 class KarelStateGenerator:
     
     def __init__(self, env_args: dict, random_seed = 1) -> None:
         self.env_args = env_args
-        env = KarelEnvironment(**self.env_args)
+        env = make_karel_environment(**self.env_args)
         self.state_shape = env.state_shape
         self.h = self.state_shape[1]
         self.w = self.state_shape[2]
@@ -35,7 +36,7 @@ class KarelStateGenerator:
         # Marker: num of max marker == 1 for now TODO: this is the setting for LEAPS - do we keep it?
         s[6, :, :] = (self.np_rng.rand(self.h, self.w) > 1 - marker_prob) * (s[4, :, :] == False) > 0
         s[5, :, :] = np.sum(s[6:, :, :], axis=0) == 0
-        return KarelEnvironment(initial_state=s, **self.env_args)
+        return make_karel_environment(initial_state=s, **self.env_args)
 
 
 class KarelProgramGenerator:
@@ -44,50 +45,24 @@ class KarelProgramGenerator:
         self.dsl = dsl
         self.np_rng = np.random.RandomState(random_seed)
         self.a2i = {action: i for i, action in enumerate(self.dsl.actions + [None])}
+        self.samplers: dict[tuple, ProgramSampler] = {}
+
+    def get_sampler(self, max_depth: int, max_sequence: int, max_program_size: int = None) -> ProgramSampler:
+        key = (max_depth, max_sequence, max_program_size)
+        if key not in self.samplers:
+            self.samplers[key] = ProgramSampler(self.dsl, max_height=max_depth, max_sequence=max_sequence,
+                                                max_cost=max_program_size, node_cost=lambda node: node.node_size)
+        return self.samplers[key]
 
     def fill_children_of_node(self, node: dsl_nodes.BaseNode,
                               current_depth: int = 1, current_sequence: int = 0,
                               max_depth: int = 4, max_sequence: int = 6) -> None:
-        node_prod_rules = self.dsl.prod_rules[type(node)]
-        for i, child_type in enumerate(node.get_children_types()):
-            child_probs = self.dsl.get_dsl_nodes_probs(child_type)
-            for child_type in child_probs:
-                if child_type not in node_prod_rules[i]:
-                    child_probs[child_type] = 0.
-                if current_depth >= max_depth and child_type.get_node_depth() > 0:
-                    child_probs[child_type] = 0.
-            if issubclass(type(node), dsl_nodes.Concatenate) and current_sequence + 1 >= max_sequence:
-                if dsl_nodes.Concatenate in child_probs:
-                    child_probs[dsl_nodes.Concatenate] = 0.
-            
-            p_list = list(child_probs.values()) / np.sum(list(child_probs.values()))
-            child = self.np_rng.choice(list(child_probs.keys()), p=p_list)
-            child_instance = child()
-            if child.get_number_children() > 0:
-                if issubclass(type(node), dsl_nodes.Concatenate):
-                    self.fill_children_of_node(child_instance, current_depth + child.get_node_depth(),
-                                                current_sequence + 1, max_depth, max_sequence)
-                else:
-                    self.fill_children_of_node(child_instance, current_depth + child.get_node_depth(),
-                                                1, max_depth, max_sequence)
-            
-            elif isinstance(child_instance, dsl_nodes.Action):
-                child_instance.name = self.np_rng.choice(list(self.dsl.action_probs.keys()),
-                                                            p=list(self.dsl.action_probs.values()))
-            elif isinstance(child_instance, dsl_nodes.BoolFeature):
-                child_instance.name = self.np_rng.choice(list(self.dsl.bool_feat_probs.keys()),
-                                                            p=list(self.dsl.bool_feat_probs.values()))
-            elif isinstance(child_instance, dsl_nodes.ConstInt):
-                child_instance.value = self.np_rng.choice(list(self.dsl.const_int_probs.keys()),
-                                                            p=list(self.dsl.const_int_probs.values()))
-            node.children[i] = child_instance
+        self.get_sampler(max_depth, max_sequence).fill_children(node, self.np_rng, current_depth, current_sequence)
 
     def generate_program(self, max_depth, max_program_size, max_sequence) -> dsl_nodes.Program:
-        while True:
-            program = dsl_nodes.Program()
-            self.fill_children_of_node(program, max_depth=max_depth, max_sequence=max_sequence)
-            if program.get_size() <= max_program_size:
-                break
+        # Programs are drawn directly among the ones of at most max_program_size nodes
+        program = dsl_nodes.Program()
+        self.get_sampler(max_depth, max_sequence, max_program_size).fill_children(program, self.np_rng)
         return program
         
     def generate_demos(self, prog: dsl_nodes.Program, state_generator: KarelStateGenerator,
@@ -1,10 +1,12 @@
 import numpy as np
 
 from prog_policies.base import BaseTask
-from prog_policies.karel import KarelEnvironment
+from prog_policies.karel import KarelEnvironment, make_karel_environment
 
 
 class CleanHouse(BaseTask):
+
+    episode_attributes = ("previous_number_of_markers",)
         
     def generate_initial_environment(self, env_args):
         
@@ -25,7 +27,7 @@ class CleanHouse(BaseTask):
             ['-', '-', '-', '-', '-', '-', '-', '-', '-', '-', '-', '-', '-', '-', '-', '-', '-', '-', '-', '-', '-', '-'],
         ]
         
-        reference_env = KarelEnvironment(**env_args)
+        reference_env = make_karel_environment(**env_args)
         
         env_height = reference_env.state_shape[1]
         env_width = reference_env.state_shape[2]        
@@ -67,7 +69,7 @@ class CleanHouse(BaseTask):
         
         self.initial_number_of_markers = state[6, :, :].sum()
         
-        return KarelEnvironment(initial_state=state, **env_args)
+        return make_karel_environment(initial_state=state, **env_args)
     
     def reset_environment(self):
         super().reset_environment()
@@ -91,6 +93,29 @@ class CleanHouse(BaseTask):
         
         return terminated, reward
 
+    @classmethod
+    def reset_batch(cls, tasks):
+        return {
+            "crash_penalty": np.array([task.crash_penalty for task in tasks]),
+            "initial_number_of_markers": np.array([task.initial_number_of_markers for task in tasks]),
+            "previous_number_of_markers": np.array([task.initial_number_of_markers for task in tasks]),
+        }
+
+    @classmethod
+    def get_batch_reward(cls, episode, env, lanes):
+        num_markers = env.markers_grid[lanes].sum(axis=(1, 2))
+        previous_number_of_markers = episode["previous_number_of_markers"][lanes]
+
+        reward = (previous_number_of_markers - num_markers) / episode["initial_number_of_markers"][lanes]
+
+        crashed = num_markers > previous_number_of_markers
+        reward = np.where(crashed, episode["crash_penalty"][lanes], reward)
+        terminated = crashed | (num_markers == 0)
+
+        episode["previous_number_of_markers"][lanes] = num_markers
+
+        return terminated, reward
+
 
 class CleanHouseSparse(CleanHouse):
     
@@ -108,4 +133,14 @@ class CleanHouseSparse(CleanHouse):
             reward = 1.
             terminated = True
         
-        return terminated, reward
\ No newline at end of file
+        return terminated, reward
+
+    @classmethod
+    def get_batch_reward(cls, episode, env, lanes):
+        num_markers = env.markers_grid[lanes].sum(axis=(1, 2))
+
+        crashed = num_markers > episode["previous_number_of_markers"][lanes]
+        solved = ~crashed & (num_markers == 0)
+        reward = np.where(crashed, episode["crash_penalty"][lanes], np.where(solved, 1., 0.))
+
+        return crashed | solved, reward
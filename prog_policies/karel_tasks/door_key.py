@@ -2,14 +2,16 @@ from math import ceil
 import numpy as np
 
 from prog_policies.base import BaseTask
-from prog_policies.karel import KarelEnvironment
+from prog_policies.karel import KarelEnvironment, KarelEnvironmentListener, make_karel_environment
 
 
-class DoorKey(BaseTask):
+class DoorKey(BaseTask, KarelEnvironmentListener):
+
+    episode_attributes = ("door_locked", "number_of_markers")
         
     def generate_initial_environment(self, env_args):
         
-        reference_env = KarelEnvironment(**env_args)
+        reference_env = make_karel_environment(**env_args)
         
         env_height = reference_env.state_shape[1]
         env_width = reference_env.state_shape[2]        
@@ -44,16 +46,21 @@ class DoorKey(BaseTask):
         self.door_cells = [(2, wall_column), (3, wall_column)]
         self.door_locked = True
         
-        return KarelEnvironment(initial_state=state, **env_args)
+        return make_karel_environment(initial_state=state, **env_args)
     
     def reset_environment(self):
         super().reset_environment()
         self.door_locked = True
+        # The key and the end marker
+        self.number_of_markers = 2
+
+    def on_marker_change(self, r, c, previous, current):
+        self.number_of_markers += current - previous
 
     def get_reward(self, env: KarelEnvironment):
         terminated = False
         reward = 0.
-        num_markers = env.markers_grid.sum()
+        num_markers = self.number_of_markers
         
         if self.door_locked:
             if num_markers > 2:
@@ -63,7 +70,7 @@ class DoorKey(BaseTask):
             elif env.markers_grid[self.key_cell[0], self.key_cell[1]] == 0:
                 self.door_locked = False
                 for door_cell in self.door_cells:
-                    env.state[4, door_cell[0], door_cell[1]] = False
+                    env.set_wall(door_cell[0], door_cell[1], False)
                 reward = 0.5
         else:
             if num_markers > 1:
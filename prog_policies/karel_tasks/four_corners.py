@@ -1,14 +1,16 @@
 import numpy as np
 
 from prog_policies.base import BaseTask
-from prog_policies.karel import KarelEnvironment
+from prog_policies.karel import KarelEnvironment, make_karel_environment
 
 
 class FourCorners(BaseTask):
+
+    episode_attributes = ("num_previous_correct_markers",)
         
     def generate_initial_environment(self, env_args):
         
-        reference_env = KarelEnvironment(**env_args)
+        reference_env = make_karel_environment(**env_args)
         
         env_height = reference_env.state_shape[1]
         env_width = reference_env.state_shape[2]        
@@ -32,7 +34,7 @@ class FourCorners(BaseTask):
             [env_height - 2, env_width - 2]
         ]
         
-        return KarelEnvironment(initial_state=state, **env_args)
+        return make_karel_environment(initial_state=state, **env_args)
     
     def reset_environment(self):
         super().reset_environment()
@@ -61,6 +63,38 @@ class FourCorners(BaseTask):
         
         return terminated, reward
 
+    @classmethod
+    def reset_batch(cls, tasks):
+        _, env_height, env_width = tasks[0].initial_environment.state_shape
+        goal_markers = np.zeros((len(tasks), env_height, env_width), dtype=bool)
+        for i, task in enumerate(tasks):
+            for marker in task.goal_markers:
+                goal_markers[i, marker[0], marker[1]] = True
+        return {
+            "crash_penalty": np.array([task.crash_penalty for task in tasks]),
+            "goal_markers": goal_markers,
+            "num_goal_markers": np.array([len(task.goal_markers) for task in tasks]),
+            "num_previous_correct_markers": np.zeros(len(tasks), dtype=np.int64),
+        }
+
+    @classmethod
+    def get_batch_reward(cls, episode, env, lanes):
+        markers_grid = env.markers_grid[lanes]
+        num_goal_markers = episode["num_goal_markers"][lanes]
+
+        num_placed_markers = markers_grid.sum(axis=(1, 2))
+        num_correct_markers = ((markers_grid > 0) & episode["goal_markers"][lanes]).sum(axis=(1, 2))
+
+        reward = (num_correct_markers - episode["num_previous_correct_markers"][lanes]) / num_goal_markers
+
+        crashed = num_placed_markers > num_correct_markers
+        reward = np.where(crashed, episode["crash_penalty"][lanes], reward)
+        terminated = crashed | (num_correct_markers == num_goal_markers)
+
+        episode["num_previous_correct_markers"][lanes] = num_correct_markers
+
+        return terminated, reward
+
 
 class FourCornersSparse(FourCorners):
     
@@ -83,4 +117,17 @@ class FourCornersSparse(FourCorners):
             terminated = True
             reward = 1.
         
-        return terminated, reward
\ No newline at end of file
+        return terminated, reward
+
+    @classmethod
+    def get_batch_reward(cls, episode, env, lanes):
+        markers_grid = env.markers_grid[lanes]
+
+        num_placed_markers = markers_grid.sum(axis=(1, 2))
+        num_correct_markers = ((markers_grid > 0) & episode["goal_markers"][lanes]).sum(axis=(1, 2))
+
+        crashed = num_placed_markers > num_correct_markers
+        solved = ~crashed & (num_correct_markers == episode["num_goal_markers"][lanes])
+        reward = np.where(crashed, episode["crash_penalty"][lanes], np.where(solved, 1., 0.))
+
+        return crashed | solved, reward
@@ -1,14 +1,16 @@
 import numpy as np
 
 from prog_policies.base import BaseTask
-from prog_policies.karel import KarelEnvironment
+from prog_policies.karel import KarelEnvironment, KarelEnvironmentListener, make_karel_environment
 
 
-class Harvester(BaseTask):
+class Harvester(BaseTask, KarelEnvironmentListener):
+
+    episode_attributes = ("previous_number_of_markers", "number_of_markers")
         
     def generate_initial_environment(self, env_args):
         
-        reference_env = KarelEnvironment(**env_args)
+        reference_env = make_karel_environment(**env_args)
         
         env_height = reference_env.state_shape[1]
         env_width = reference_env.state_shape[2]        
@@ -29,16 +31,20 @@ class Harvester(BaseTask):
         
         self.initial_number_of_markers = (env_height - 2) * (env_width - 2)
         
-        return KarelEnvironment(initial_state=state, **env_args)
+        return make_karel_environment(initial_state=state, **env_args)
     
     def reset_environment(self):
         super().reset_environment()
         self.previous_number_of_markers = self.initial_number_of_markers
+        self.number_of_markers = self.initial_number_of_markers
+
+    def on_marker_change(self, r, c, previous, current):
+        self.number_of_markers += current - previous
 
     def get_reward(self, env: KarelEnvironment):
         terminated = False
         
-        num_markers = env.markers_grid.sum()
+        num_markers = self.number_of_markers
         
         reward = (self.previous_number_of_markers - num_markers) / self.initial_number_of_markers
         
@@ -53,6 +59,29 @@ class Harvester(BaseTask):
         
         return terminated, reward
 
+    @classmethod
+    def reset_batch(cls, tasks):
+        return {
+            "crash_penalty": np.array([task.crash_penalty for task in tasks]),
+            "initial_number_of_markers": np.array([task.initial_number_of_markers for task in tasks]),
+            "previous_number_of_markers": np.array([task.initial_number_of_markers for task in tasks]),
+        }
+
+    @classmethod
+    def get_batch_reward(cls, episode, env, lanes):
+        num_markers = env.num_markers[lanes]
+        previous_number_of_markers = episode["previous_number_of_markers"][lanes]
+
+        reward = (previous_number_of_markers - num_markers) / episode["initial_number_of_markers"][lanes]
+
+        crashed = num_markers > previous_number_of_markers
+        reward = np.where(crashed, episode["crash_penalty"][lanes], reward)
+        terminated = crashed | (num_markers == 0)
+
+        episode["previous_number_of_markers"][lanes] = num_markers
+
+        return terminated, reward
+
 
 class HarvesterSparse(Harvester):
     
@@ -60,7 +89,7 @@ class HarvesterSparse(Harvester):
         terminated = False
         reward = 0.
 
-        num_markers = env.markers_grid.sum()
+        num_markers = self.number_of_markers
         
         if num_markers > self.previous_number_of_markers:
             reward = self.crash_penalty
@@ -70,4 +99,14 @@ class HarvesterSparse(Harvester):
             reward = 1.
             terminated = True
         
-        return terminated, reward
\ No newline at end of file
+        return terminated, reward
+
+    @classmethod
+    def get_batch_reward(cls, episode, env, lanes):
+        num_markers = env.num_markers[lanes]
+
+        crashed = num_markers > episode["previous_number_of_markers"][lanes]
+        solved = ~crashed & (num_markers == 0)
+        reward = np.where(crashed, episode["crash_penalty"][lanes], np.where(solved, 1., 0.))
+
+        return crashed | solved, reward
@@ -1,14 +1,16 @@
 import numpy as np
 
 from prog_policies.base import BaseTask
-from prog_policies.karel import KarelEnvironment
+from prog_policies.karel import KarelEnvironment, make_karel_environment
 
 
 class Maze(BaseTask):
+
+    episode_attributes = ("previous_distance",)
         
     def generate_initial_environment(self, env_args):
         
-        reference_env = KarelEnvironment(**env_args)
+        reference_env = make_karel_environment(**env_args)
         
         env_height = reference_env.state_shape[1]
         env_width = reference_env.state_shape[2]        
@@ -60,7 +62,7 @@ class Maze(BaseTask):
         self.initial_distance = abs(init_pos[0] - self.marker_position[0]) \
             + abs(init_pos[1] - self.marker_position[1])
         
-        return KarelEnvironment(initial_state=state, **env_args)
+        return make_karel_environment(initial_state=state, **env_args)
     
     def reset_environment(self):
         super().reset_environment()
@@ -85,6 +87,28 @@ class Maze(BaseTask):
         
         return terminated, reward
 
+    @classmethod
+    def reset_batch(cls, tasks):
+        return {
+            "marker_position": np.array([task.marker_position for task in tasks]),
+            "initial_distance": np.array([task.initial_distance for task in tasks]),
+            "previous_distance": np.array([task.initial_distance for task in tasks]),
+        }
+
+    @classmethod
+    def get_batch_reward(cls, episode, env, lanes):
+        karel_r, karel_c = env.hero_pos[lanes, 0], env.hero_pos[lanes, 1]
+        marker_position = episode["marker_position"][lanes]
+
+        current_distance = np.abs(karel_r - marker_position[:, 0]) + np.abs(karel_c - marker_position[:, 1])
+
+        # Reward is how much closer Karel is to the marker, normalized by the initial distance
+        reward = (episode["previous_distance"][lanes] - current_distance) / episode["initial_distance"][lanes]
+
+        episode["previous_distance"][lanes] = current_distance
+
+        return current_distance == 0, reward
+
 
 class MazeSparse(Maze):
     
@@ -98,4 +122,10 @@ class MazeSparse(Maze):
             terminated = True
             reward = 1.
         
-        return terminated, reward
\ No newline at end of file
+        return terminated, reward
+
+    @classmethod
+    def get_batch_reward(cls, episode, env, lanes):
+        marker_position = episode["marker_position"][lanes]
+        solved = (env.hero_pos[lanes, 0] == marker_position[:, 0]) & (env.hero_pos[lanes, 1] == marker_position[:, 1])
+        return solved, np.where(solved, 1., 0.)
@@ -1,14 +1,16 @@
 import numpy as np
 
 from prog_policies.base import BaseTask
-from prog_policies.karel import KarelEnvironment
+from prog_policies.karel import KarelEnvironment, make_karel_environment
 
 # TODO: make trail of visited cells be markers instead of walls
 class OneStroke(BaseTask):
+
+    episode_attributes = ("prev_agent_x", "prev_agent_y", "number_cells_visited")
         
     def generate_initial_environment(self, env_args):
         
-        reference_env = KarelEnvironment(**env_args)
+        reference_env = make_karel_environment(**env_args)
         
         env_height = reference_env.state_shape[1]
         env_width = reference_env.state_shape[2]        
@@ -29,7 +31,7 @@ class OneStroke(BaseTask):
         
         self.max_number_cells = (env_width - 2) * (env_height - 2) - 1
         
-        return KarelEnvironment(initial_state=state, **env_args)
+        return make_karel_environment(initial_state=state, **env_args)
     
     def reset_environment(self):
         super().reset_environment()
@@ -48,7 +50,7 @@ class OneStroke(BaseTask):
             self.number_cells_visited += 1
             reward = 1. / self.max_number_cells
             # Place a wall where the agent was
-            env.state[4, self.prev_agent_y, self.prev_agent_x] = True
+            env.set_wall(self.prev_agent_y, self.prev_agent_x, True)
 
         if self.number_cells_visited == self.max_number_cells:
             terminated = True
@@ -2,16 +2,18 @@ from __future__ import annotations
 import numpy as np
 
 from prog_policies.base import BaseTask
-from prog_policies.karel import KarelEnvironment
+from prog_policies.karel import KarelEnvironment, KarelEnvironmentListener, make_karel_environment
 
-class PathFollow(BaseTask):
+class PathFollow(BaseTask, KarelEnvironmentListener):
+
+    episode_attributes = ("previous_number_of_markers", "number_of_markers")
     
     def pos_to_id(self, y: int, x: int, env_height: int) -> int:
         return y*env_height + x
     
     def generate_initial_environment(self, env_args):
         
-        reference_env = KarelEnvironment(**env_args)
+        reference_env = make_karel_environment(**env_args)
         
         env_height = reference_env.state_shape[1]
         env_width = reference_env.state_shape[2]
@@ -57,17 +59,21 @@ class PathFollow(BaseTask):
             
         self.initial_number_of_markers = env_height + env_width - 5
         
-        return KarelEnvironment(initial_state=state, **env_args)
+        return make_karel_environment(initial_state=state, **env_args)
     
     
     
     def reset_environment(self):
         super().reset_environment()
         self.previous_number_of_markers = self.initial_number_of_markers
+        self.number_of_markers = self.initial_number_of_markers
+
+    def on_marker_change(self, r, c, previous, current):
+        self.number_of_markers += current - previous
     
     def get_reward(self, env: KarelEnvironment):
         terminated = False
-        num_markers = env.markers_grid.sum()
+        num_markers = self.number_of_markers
         
         _, env_height, env_width = env.state_shape
         
@@ -88,5 +94,33 @@ class PathFollow(BaseTask):
         
         self.previous_number_of_markers = num_markers
         
-        return terminated, reward            
-        
\ No newline at end of file
+        return terminated, reward
+
+    @classmethod
+    def reset_batch(cls, tasks):
+        _, env_height, env_width = tasks[0].initial_environment.state_shape
+        legal_pos = np.zeros((len(tasks), env_height * env_height + env_width), dtype=bool)
+        for i, task in enumerate(tasks):
+            legal_pos[i, list(task.legal_pos)] = True
+        return {
+            "crash_penalty": np.array([task.crash_penalty for task in tasks]),
+            "legal_pos": legal_pos,
+            "initial_number_of_markers": np.array([task.initial_number_of_markers for task in tasks]),
+            "previous_number_of_markers": np.array([task.initial_number_of_markers for task in tasks]),
+        }
+
+    @classmethod
+    def get_batch_reward(cls, episode, env, lanes):
+        num_markers = env.num_markers[lanes]
+        previous_number_of_markers = episode["previous_number_of_markers"][lanes]
+
+        reward = (previous_number_of_markers - num_markers) / episode["initial_number_of_markers"][lanes]
+
+        agent_id = env.hero_pos[lanes, 0] * env.env_height + env.hero_pos[lanes, 1]
+        crashed = (num_markers > previous_number_of_markers) | ~episode["legal_pos"][lanes, agent_id]
+        reward = np.where(crashed, episode["crash_penalty"][lanes], reward)
+        terminated = crashed | (num_markers == 0)
+
+        episode["previous_number_of_markers"][lanes] = num_markers
+
+        return terminated, reward
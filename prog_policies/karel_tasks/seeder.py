@@ -1,14 +1,16 @@
 import numpy as np
 
 from prog_policies.base import BaseTask
-from prog_policies.karel import KarelEnvironment
+from prog_policies.karel import KarelEnvironment, KarelEnvironmentListener, make_karel_environment
 
 
-class Seeder(BaseTask):
+class Seeder(BaseTask, KarelEnvironmentListener):
+
+    episode_attributes = ("previous_number_of_markers", "number_of_markers", "number_of_stacked_cells")
         
     def generate_initial_environment(self, env_args):
         
-        reference_env = KarelEnvironment(**env_args)
+        reference_env = make_karel_environment(**env_args)
         
         env_height = reference_env.state_shape[1]
         env_width = reference_env.state_shape[2]        
@@ -29,20 +31,27 @@ class Seeder(BaseTask):
         
         self.max_number_of_markers = (env_width - 2) * (env_height - 2)
         
-        return KarelEnvironment(initial_state=state, **env_args)
+        return make_karel_environment(initial_state=state, **env_args)
     
     def reset_environment(self):
         super().reset_environment()
         self.previous_number_of_markers = 0
+        self.number_of_markers = 0
+        # Number of cells with more than one marker
+        self.number_of_stacked_cells = 0
+
+    def on_marker_change(self, r, c, previous, current):
+        self.number_of_markers += current - previous
+        self.number_of_stacked_cells += (current > 1) - (previous > 1)
 
     def get_reward(self, env: KarelEnvironment):
         terminated = False
         
-        num_markers = env.markers_grid.sum()
+        num_markers = self.number_of_markers
         
         reward = (num_markers - self.previous_number_of_markers) / self.max_number_of_markers
         
-        if (env.markers_grid > 1).any():
+        if self.number_of_stacked_cells > 0:
             reward = self.crash_penalty
             terminated = True
         
@@ -56,3 +65,30 @@ class Seeder(BaseTask):
         self.previous_number_of_markers = num_markers
         
         return terminated, reward
+
+    @classmethod
+    def reset_batch(cls, tasks):
+        return {
+            "crash_penalty": np.array([task.crash_penalty for task in tasks]),
+            "max_number_of_markers": np.array([task.max_number_of_markers for task in tasks]),
+            "previous_number_of_markers": np.zeros(len(tasks), dtype=np.int64),
+        }
+
+    @classmethod
+    def get_batch_reward(cls, episode, env, lanes):
+        num_markers = env.num_markers[lanes]
+        previous_number_of_markers = episode["previous_number_of_markers"][lanes]
+        max_number_of_markers = episode["max_number_of_markers"][lanes]
+
+        reward = (num_markers - previous_number_of_markers) / max_number_of_markers
+
+        # The grid starts without stacked markers and the episode ends on the first one, so only the
+        # cell under the hero (the only one an action can change) has to be checked
+        stacked = env.markers_grid[lanes, env.hero_pos[lanes, 0], env.hero_pos[lanes, 1]] > 1
+        crashed = stacked | (num_markers < previous_number_of_markers)
+        reward = np.where(crashed, episode["crash_penalty"][lanes], reward)
+        terminated = crashed | (num_markers == max_number_of_markers)
+
+        episode["previous_number_of_markers"][lanes] = num_markers
+
+        return terminated, reward
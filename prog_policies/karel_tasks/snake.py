@@ -1,14 +1,17 @@
 import numpy as np
 
 from prog_policies.base import BaseTask
-from prog_policies.karel import KarelEnvironment
+from prog_policies.karel import KarelEnvironment, make_karel_environment
 
 
 class Snake(BaseTask):
 
+    # get_reward places new markers with self.rng
+    checkpointable = False
+
     def generate_initial_environment(self, env_args):
 
-        reference_env = KarelEnvironment(**env_args)
+        reference_env = make_karel_environment(**env_args)
 
         env_height = reference_env.state_shape[1]
         env_width = reference_env.state_shape[2]
@@ -39,7 +42,7 @@ class Snake(BaseTask):
                 state[5, ym, xm] = False
                 self.initial_marker_position = [ym, xm]
 
-        return KarelEnvironment(initial_state=state, **env_args)
+        return make_karel_environment(initial_state=state, **env_args)
 
     def reset_environment(self):
         super().reset_environment()
@@ -68,7 +71,7 @@ class Snake(BaseTask):
                 while not valid_loc:
                     ym = self.rng.randint(1, env.state_shape[1] - 1)
                     xm = self.rng.randint(1, env.state_shape[2] - 1)
-                    if np.sum(env.state[:5, ym, xm]) <= 0 and ((ym, xm) not in self.body_list):
+                    if env.is_clear(ym, xm) and not env.hero_at_pos(ym, xm) and ((ym, xm) not in self.body_list):
                         valid_loc = True
                         # env.state[6, ym, xm] = True
                         # env.state[5, ym, xm] = False
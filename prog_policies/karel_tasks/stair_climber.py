@@ -1,13 +1,15 @@
 import numpy as np
 
 from prog_policies.base import BaseTask
-from prog_policies.karel import KarelEnvironment
+from prog_policies.karel import KarelEnvironment, make_karel_environment
 
 class StairClimber(BaseTask):
+
+    episode_attributes = ("previous_distance",)
     
     def generate_initial_environment(self, env_args):
         
-        reference_env = KarelEnvironment(**env_args)
+        reference_env = make_karel_environment(**env_args)
         
         env_height = reference_env.state_shape[1]
         env_width = reference_env.state_shape[2]
@@ -33,6 +35,7 @@ class StairClimber(BaseTask):
         
         # One cell above the stairs
         self.valid_positions = on_stair_positions + one_block_above_stair_positions
+        self.valid_cells = set(map(tuple, self.valid_positions))
         
         # Initial position has to be on stair but cannot be on last step
         initial_position_index = self.rng.randint(0, len(on_stair_positions) - 1)
@@ -51,7 +54,7 @@ class StairClimber(BaseTask):
         self.initial_distance = abs(self.initial_position[0] - self.marker_position[0]) \
             + abs(self.initial_position[1] - self.marker_position[1])
         
-        return KarelEnvironment(initial_state=state, **env_args)
+        return make_karel_environment(initial_state=state, **env_args)
     
     def reset_environment(self):
         super().reset_environment()
@@ -69,7 +72,7 @@ class StairClimber(BaseTask):
         # Reward is how much closer Karel is to the marker, normalized by the initial distance
         reward = (self.previous_distance - current_distance) / self.initial_distance
         
-        if [karel_pos[0], karel_pos[1]] not in self.valid_positions:
+        if (karel_pos[0], karel_pos[1]) not in self.valid_cells:
             reward = self.crash_penalty
             terminated = True
             
@@ -80,6 +83,39 @@ class StairClimber(BaseTask):
         
         return terminated, reward
 
+    @classmethod
+    def reset_batch(cls, tasks):
+        _, env_height, env_width = tasks[0].initial_environment.state_shape
+        valid_positions = np.zeros((len(tasks), env_height, env_width), dtype=bool)
+        for i, task in enumerate(tasks):
+            for position in task.valid_positions:
+                valid_positions[i, position[0], position[1]] = True
+        return {
+            "crash_penalty": np.array([task.crash_penalty for task in tasks]),
+            "valid_positions": valid_positions,
+            "marker_position": np.array([task.marker_position for task in tasks]),
+            "initial_distance": np.array([task.initial_distance for task in tasks]),
+            "previous_distance": np.array([task.initial_distance for task in tasks]),
+        }
+
+    @classmethod
+    def get_batch_reward(cls, episode, env, lanes):
+        karel_r, karel_c = env.hero_pos[lanes, 0], env.hero_pos[lanes, 1]
+        marker_position = episode["marker_position"][lanes]
+
+        current_distance = np.abs(karel_r - marker_position[:, 0]) + np.abs(karel_c - marker_position[:, 1])
+
+        # Reward is how much closer Karel is to the marker, normalized by the initial distance
+        reward = (episode["previous_distance"][lanes] - current_distance) / episode["initial_distance"][lanes]
+
+        invalid = ~episode["valid_positions"][lanes, karel_r, karel_c]
+        reward = np.where(invalid, episode["crash_penalty"][lanes], reward)
+        terminated = invalid | (current_distance == 0)
+
+        episode["previous_distance"][lanes] = current_distance
+
+        return terminated, reward
+
 
 class StairClimberSparse(StairClimber):
     
@@ -92,8 +128,19 @@ class StairClimberSparse(StairClimber):
         if karel_pos[0] == self.marker_position[0] and karel_pos[1] == self.marker_position[1]:
             reward = 1.
             terminated = True
-        elif [karel_pos[0], karel_pos[1]] not in self.valid_positions:
+        elif (karel_pos[0], karel_pos[1]) not in self.valid_cells:
             reward = self.crash_penalty
             terminated = True
         
-        return terminated, reward
\ No newline at end of file
+        return terminated, reward
+
+    @classmethod
+    def get_batch_reward(cls, episode, env, lanes):
+        karel_r, karel_c = env.hero_pos[lanes, 0], env.hero_pos[lanes, 1]
+        marker_position = episode["marker_position"][lanes]
+
+        solved = (karel_r == marker_position[:, 0]) & (karel_c == marker_position[:, 1])
+        invalid = ~solved & ~episode["valid_positions"][lanes, karel_r, karel_c]
+        reward = np.where(solved, 1., np.where(invalid, episode["crash_penalty"][lanes], 0.))
+
+        return solved | invalid, reward
@@ -1,14 +1,16 @@
 import numpy as np
 
 from prog_policies.base import BaseTask
-from prog_policies.karel import KarelEnvironment
+from prog_policies.karel import KarelEnvironment, make_karel_environment
 
 
 class TopOff(BaseTask):
+
+    episode_attributes = ("num_previous_correct_markers",)
         
     def generate_initial_environment(self, env_args):
         
-        reference_env = KarelEnvironment(**env_args)
+        reference_env = make_karel_environment(**env_args)
         
         env_height = reference_env.state_shape[1]
         env_width = reference_env.state_shape[2]        
@@ -34,7 +36,7 @@ class TopOff(BaseTask):
         for marker in self.markers:
             state[6, marker[0], marker[1]] = True
         
-        return KarelEnvironment(initial_state=state, **env_args)
+        return make_karel_environment(initial_state=state, **env_args)
     
     def reset_environment(self):
         super().reset_environment()
@@ -65,6 +67,44 @@ class TopOff(BaseTask):
         
         return terminated, reward
 
+    @classmethod
+    def reset_batch(cls, tasks):
+        _, env_height, env_width = tasks[0].initial_environment.state_shape
+        goal_markers = np.zeros((len(tasks), env_height, env_width), dtype=bool)
+        for i, task in enumerate(tasks):
+            for marker in task.markers:
+                goal_markers[i, marker[0], marker[1]] = True
+        return {
+            "crash_penalty": np.array([task.crash_penalty for task in tasks]),
+            "goal_markers": goal_markers,
+            "num_goal_markers": np.array([len(task.markers) for task in tasks]),
+            "num_previous_correct_markers": np.zeros(len(tasks), dtype=np.int64),
+        }
+
+    @classmethod
+    def get_batch_reward(cls, episode, env, lanes):
+        markers_grid = env.markers_grid[lanes]
+        goal_markers = episode["goal_markers"][lanes]
+        num_goal_markers = episode["num_goal_markers"][lanes]
+        crash_penalty = episode["crash_penalty"][lanes]
+
+        num_markers = markers_grid.sum(axis=(1, 2))
+        num_correct_markers = ((markers_grid == 2) & goal_markers).sum(axis=(1, 2))
+        missing_marker = ((markers_grid == 0) & goal_markers).any(axis=(1, 2))
+
+        reward = (num_correct_markers - episode["num_previous_correct_markers"][lanes]) / num_goal_markers
+
+        extra_markers = num_markers > num_correct_markers + num_goal_markers
+        reward = np.where(extra_markers, crash_penalty, reward)
+        terminated = extra_markers | (num_correct_markers == num_goal_markers)
+
+        # A goal cell without markers ends the episode before updating the counter
+        reward = np.where(missing_marker, crash_penalty, reward)
+        terminated |= missing_marker
+        episode["num_previous_correct_markers"][lanes[~missing_marker]] = num_correct_markers[~missing_marker]
+
+        return terminated, reward
+
 
 class TopOffSparse(TopOff):
     
@@ -88,4 +128,25 @@ class TopOffSparse(TopOff):
             terminated = True
             reward = 1.
         
-        return terminated, reward
\ No newline at end of file
+        return terminated, reward
+
+    @classmethod
+    def get_batch_reward(cls, episode, env, lanes):
+        markers_grid = env.markers_grid[lanes]
+        goal_markers = episode["goal_markers"][lanes]
+        num_goal_markers = episode["num_goal_markers"][lanes]
+        crash_penalty = episode["crash_penalty"][lanes]
+
+        num_markers = markers_grid.sum(axis=(1, 2))
+        num_correct_markers = ((markers_grid == 2) & goal_markers).sum(axis=(1, 2))
+        missing_marker = ((markers_grid == 0) & goal_markers).any(axis=(1, 2))
+
+        extra_markers = num_markers > num_correct_markers + num_goal_markers
+        solved = num_correct_markers == num_goal_markers
+        reward = np.where(solved, 1., np.where(extra_markers, crash_penalty, 0.))
+        terminated = extra_markers | solved
+
+        reward = np.where(missing_marker, crash_penalty, reward)
+        terminated |= missing_marker
+
+        return terminated, reward
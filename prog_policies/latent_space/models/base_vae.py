@@ -9,7 +9,7 @@ import wandb
 from prog_policies.base import BaseDSL, BaseEnvironment
 
 from ..utils import init, init_gru, EnvironmentBatch
-from ..syntax_checker import SyntaxChecker
+from ..syntax_checker import SyntaxChecker, BatchCheckerState
 
 
 class ModelReturn(NamedTuple):
@@ -66,16 +66,8 @@ class ProgramSequenceDecoder(nn.Module):
         self.max_program_length = max_program_length
         init_gru(self.gru)
         
-    def get_syntax_mask(self, batch_size: int, current_tokens: torch.Tensor, grammar_state: list):
-        out_of_syntax_list = []
-        out_of_syntax_mask = torch.zeros((batch_size, self.num_program_tokens), dtype=torch.bool, device=self.device)
-
-        for program_idx, inp_token in enumerate(current_tokens):
-            inp_dsl_token = inp_token.detach().cpu().numpy().item()
-            out_of_syntax_list.append(self.syntax_checker.get_sequence_mask(grammar_state[program_idx],
-                                                                            [inp_dsl_token]).to(self.device))
-        torch.cat(out_of_syntax_list, 0, out=out_of_syntax_mask)
-        out_of_syntax_mask = out_of_syntax_mask.squeeze()
+    def get_syntax_mask(self, batch_size: int, current_tokens: torch.Tensor, grammar_state: BatchCheckerState):
+        out_of_syntax_mask = self.syntax_checker.get_batch_mask(grammar_state, current_tokens.detach().view(batch_size))
         syntax_mask = torch.where(out_of_syntax_mask,
                                   -torch.finfo(torch.float32).max * torch.ones_like(out_of_syntax_mask).float(),
                                   torch.zeros_like(out_of_syntax_mask).float())
@@ -97,8 +89,7 @@ class ProgramSequenceDecoder(nn.Module):
         # Initialize tokens as DEFs
         current_tokens = torch.zeros((batch_size), dtype=torch.long, device=self.device)
         
-        grammar_state = [self.syntax_checker.get_initial_checker_state()
-                         for _ in range(batch_size)]
+        grammar_state = self.syntax_checker.get_initial_batch_state(batch_size)
         
         pred_progs = []
         pred_progs_logits = []
@@ -86,6 +86,30 @@ class CheckerState(object):
         self.state = STATE_CSTE_NEXT
 
 
+# Transitions that are resolved from the stacks / condition depth in SyntaxChecker.forward_batch
+STATE_RESOLVE_COND_CLOSE = 6
+STATE_RESOLVE_IF_CLOSE = 7
+
+
+class BatchCheckerState(object):
+    """Grammar state of a batch of programs as tensors, one row per program. Same fields as
+    CheckerState; empty stack positions are -1 and unset tokens are -1."""
+
+    def __init__(self, batch_size: int, next_mandatory: int, device: torch.device, stack_size: int = 128):
+        self.rows = torch.arange(batch_size, device=device)
+        self.state = torch.full((batch_size,), STATE_MANDATORY_NEXT, dtype=torch.long, device=device)
+        self.next_mandatory = torch.full((batch_size,), next_mandatory, dtype=torch.long, device=device)
+        self.next_actblock_open = torch.full((batch_size,), -1, dtype=torch.long, device=device)
+        self.c_deep = torch.zeros((batch_size,), dtype=torch.long, device=device)
+        self.i_need_else_stack = torch.zeros((batch_size, stack_size), dtype=torch.bool, device=device)
+        self.i_need_else_stack_pos = torch.full((batch_size,), -1, dtype=torch.long, device=device)
+        self.to_close_stack = torch.zeros((batch_size, stack_size), dtype=torch.long, device=device)
+        self.to_close_stack_pos = torch.full((batch_size,), -1, dtype=torch.long, device=device)
+
+    def paren_to_close(self) -> torch.Tensor:
+        return self.to_close_stack[self.rows, self.to_close_stack_pos.clamp(min=0)]
+
+
 class SyntaxVocabulary(object):
 
     def __init__(self, def_tkn, run_tkn,
@@ -202,6 +226,105 @@ class SyntaxChecker(object):
             mask[0,0,tkn] = 0
             self.postcond_open_paren_masks[tkn] = mask
 
+        self._build_batch_tables()
+
+    def _build_batch_tables(self):
+        # Tables indexed by [state, token] with the effect of forward on each field (-1 keeps the
+        # current value, next state -1 marks an invalid token), used by forward_batch
+        n_states = STATE_POSTCOND_OPEN_PAREN + 1
+        v = self.vocab
+        next_state = torch.full((n_states, self.vocab_size), -1, dtype=torch.long)
+        next_mandatory = torch.full((n_states, self.vocab_size), -1, dtype=torch.long)
+        next_actblock = torch.full((n_states, self.vocab_size), -1, dtype=torch.long)
+        c_deep_delta = torch.zeros((n_states, self.vocab_size), dtype=torch.long)
+        push_else = torch.full((n_states, self.vocab_size), -1, dtype=torch.long)
+
+        mandatory_next = {v.def_tkn: v.run_tkn, v.run_tkn: v.m_open_tkn, v.else_tkn: v.e_open_tkn}
+        for tkn, mandatory in mandatory_next.items():
+            next_state[STATE_MANDATORY_NEXT, tkn] = STATE_MANDATORY_NEXT
+            next_mandatory[STATE_MANDATORY_NEXT, tkn] = mandatory
+        for tkn in self.open_parens:
+            if tkn == v.c_open_tkn:
+                next_state[STATE_MANDATORY_NEXT, tkn] = STATE_BOOL_NEXT
+                c_deep_delta[STATE_MANDATORY_NEXT, tkn] = 1
+            else:
+                next_state[STATE_MANDATORY_NEXT, tkn] = STATE_ACT_NEXT
+        next_state[STATE_MANDATORY_NEXT, v.c_close_tkn] = STATE_RESOLVE_COND_CLOSE
+        c_deep_delta[STATE_MANDATORY_NEXT, v.c_close_tkn] = -1
+        next_state[STATE_MANDATORY_NEXT, v.pad_tkn] = STATE_MANDATORY_NEXT
+
+        for state in [STATE_ACT_NEXT, STATE_ACT_OR_CLOSE_NEXT]:
+            for tkn in self.act_acceptable:
+                if tkn in self.flow_needs_bool:
+                    next_state[state, tkn] = STATE_MANDATORY_NEXT
+                    next_mandatory[state, tkn] = v.c_open_tkn
+                    if tkn in self.if_statements:
+                        push_else[state, tkn] = int(self.need_else[tkn])
+                        next_actblock[state, tkn] = v.i_open_tkn
+                    elif tkn == v.while_tkn:
+                        next_actblock[state, tkn] = v.w_open_tkn
+                elif tkn == v.repeat_tkn:
+                    next_state[state, tkn] = STATE_CSTE_NEXT
+                elif tkn in self.effect_acts:
+                    next_state[state, tkn] = STATE_ACT_OR_CLOSE_NEXT
+        for tkn in self.close_parens:
+            if tkn == v.i_close_tkn:
+                next_state[STATE_ACT_OR_CLOSE_NEXT, tkn] = STATE_RESOLVE_IF_CLOSE
+            elif tkn == v.m_close_tkn:
+                next_state[STATE_ACT_OR_CLOSE_NEXT, tkn] = STATE_MANDATORY_NEXT
+                next_mandatory[STATE_ACT_OR_CLOSE_NEXT, tkn] = v.pad_tkn
+            else:
+                next_state[STATE_ACT_OR_CLOSE_NEXT, tkn] = STATE_ACT_OR_CLOSE_NEXT
+
+        for tkn in self.range_cste:
+            next_state[STATE_CSTE_NEXT, tkn] = STATE_MANDATORY_NEXT
+            next_mandatory[STATE_CSTE_NEXT, tkn] = v.r_open_tkn
+
+        for tkn in self.bool_checks:
+            next_state[STATE_BOOL_NEXT, tkn] = STATE_MANDATORY_NEXT
+            next_mandatory[STATE_BOOL_NEXT, tkn] = v.c_close_tkn
+        if v.not_tkn not in self.bool_checks:
+            next_state[STATE_BOOL_NEXT, v.not_tkn] = STATE_MANDATORY_NEXT
+            next_mandatory[STATE_BOOL_NEXT, v.not_tkn] = v.c_open_tkn
+
+        for tkn in self.postcond_open_paren:
+            next_state[STATE_POSTCOND_OPEN_PAREN, tkn] = STATE_ACT_NEXT
+
+        is_open = torch.zeros(self.vocab_size, dtype=torch.bool)
+        is_close = torch.zeros(self.vocab_size, dtype=torch.bool)
+        open_to_close = torch.zeros(self.vocab_size, dtype=torch.long)
+        for op, cl in self.op2cl.items():
+            is_open[op] = True
+            open_to_close[op] = cl
+        for cl in self.close_parens:
+            is_close[cl] = True
+
+        # Masks of all states stacked in one table: rows [0, V) are the mandatory masks of each
+        # token, [V, 2V) the act-or-close masks of each closing paren, then the act, constant and
+        # bool masks and [2V + 3, 3V + 3) the post-condition masks of each opening paren
+        mask_table = torch.ones((3 * self.vocab_size + 3, self.vocab_size), dtype=torch.bool)
+        for tkn in range(self.vocab_size):
+            mask_table[tkn, tkn] = False
+            mask_table[self.vocab_size + tkn, tkn] = False
+            mask_table[self.vocab_size + tkn, list(self.effect_acts | self.flow_lead)] = False
+            mask_table[2 * self.vocab_size + 3 + tkn, tkn] = False
+        mask_table[2 * self.vocab_size] = self.act_next_mask.view(-1).cpu()
+        mask_table[2 * self.vocab_size + 1] = self.range_mask.view(-1).cpu()
+        mask_table[2 * self.vocab_size + 2] = self.boolnext_mask.view(-1).cpu()
+        mask_row_offset = torch.tensor([0, 2 * self.vocab_size, self.vocab_size, 2 * self.vocab_size + 1,
+                                        2 * self.vocab_size + 2, 2 * self.vocab_size + 3], dtype=torch.long)
+
+        self.batch_next_state = next_state.to(self.device)
+        self.batch_next_mandatory = next_mandatory.to(self.device)
+        self.batch_next_actblock = next_actblock.to(self.device)
+        self.batch_c_deep_delta = c_deep_delta.to(self.device)
+        self.batch_push_else = push_else.to(self.device)
+        self.batch_is_open = is_open.to(self.device)
+        self.batch_is_close = is_close.to(self.device)
+        self.batch_open_to_close = open_to_close.to(self.device)
+        self.batch_mask_table = mask_table.to(self.device)
+        self.batch_mask_row_offset = mask_row_offset.to(self.device)
+
     def forward(self, state: CheckerState, new_idx: int):
         # Whatever happens, if we open a paren, it needs to be closed
         if new_idx in self.open_parens:
@@ -334,6 +457,63 @@ class SyntaxChecker(object):
             torch.cat(mask_infeasible_list, 1, out=mask_infeasible)
             return mask_infeasible
 
+    def forward_batch(self, state: BatchCheckerState, new_idx: torch.Tensor):
+        # Same transitions as forward, for every program of the batch at once
+        rows = state.rows
+        opening = self.batch_is_open[new_idx]
+        state.to_close_stack_pos += opening.long()
+        state.to_close_stack[rows[opening], state.to_close_stack_pos[opening]] = self.batch_open_to_close[new_idx[opening]]
+        closing = self.batch_is_close[new_idx]
+        assert bool((~closing | (state.paren_to_close() == new_idx) & (state.to_close_stack_pos >= 0)).all())
+        state.to_close_stack_pos -= closing.long()
+
+        current_state = state.state
+        next_state = self.batch_next_state[current_state, new_idx]
+        valid = (next_state >= 0) \
+            & ((current_state != STATE_MANDATORY_NEXT) | (new_idx == state.next_mandatory)) \
+            & ((current_state != STATE_POSTCOND_OPEN_PAREN) | (new_idx == state.next_actblock_open))
+        assert bool(valid.all())
+
+        next_mandatory = self.batch_next_mandatory[current_state, new_idx]
+        state.next_mandatory = torch.where(next_mandatory >= 0, next_mandatory, state.next_mandatory)
+        next_actblock = self.batch_next_actblock[current_state, new_idx]
+        state.next_actblock_open = torch.where(next_actblock >= 0, next_actblock, state.next_actblock_open)
+        state.c_deep += self.batch_c_deep_delta[current_state, new_idx]
+
+        push_else = self.batch_push_else[current_state, new_idx]
+        pushing = push_else >= 0
+        state.i_need_else_stack_pos += pushing.long()
+        state.i_need_else_stack[rows[pushing], state.i_need_else_stack_pos[pushing]] = push_else[pushing] == 1
+
+        cond_close = next_state == STATE_RESOLVE_COND_CLOSE
+        next_state = torch.where(cond_close & (state.c_deep == 0), STATE_POSTCOND_OPEN_PAREN, next_state)
+        next_state = torch.where(cond_close & (state.c_deep != 0), STATE_MANDATORY_NEXT, next_state)
+
+        if_close = next_state == STATE_RESOLVE_IF_CLOSE
+        need_else = if_close & state.i_need_else_stack[rows, state.i_need_else_stack_pos.clamp(min=0)]
+        state.i_need_else_stack_pos -= if_close.long()
+        next_state = torch.where(need_else, STATE_MANDATORY_NEXT, next_state)
+        next_state = torch.where(if_close & ~need_else, STATE_ACT_OR_CLOSE_NEXT, next_state)
+        state.next_mandatory = torch.where(need_else, self.vocab.else_tkn, state.next_mandatory)
+
+        state.state = next_state
+
+    def allowed_tokens_batch(self, state: BatchCheckerState) -> torch.Tensor:
+        # Row of the mask table of each program, see _build_batch_tables
+        token = torch.where(state.state == STATE_MANDATORY_NEXT, state.next_mandatory,
+                torch.where(state.state == STATE_ACT_OR_CLOSE_NEXT, state.paren_to_close(),
+                torch.where(state.state == STATE_POSTCOND_OPEN_PAREN, state.next_actblock_open.clamp(min=0), 0)))
+        return self.batch_mask_table[self.batch_mask_row_offset[state.state] + token]
+
+    def get_batch_mask(self, state: BatchCheckerState, inp_tokens: torch.Tensor) -> torch.Tensor:
+        """Advances every program of the batch by one token and returns the (batch, vocab) mask of
+        tokens that are not allowed next"""
+        self.forward_batch(state, inp_tokens.to(self.device))
+        return self.allowed_tokens_batch(state)
+
+    def get_initial_batch_state(self, batch_size: int) -> BatchCheckerState:
+        return BatchCheckerState(batch_size, self.vocab.def_tkn, self.device)
+
     def get_initial_checker_state(self):
         return CheckerState(STATE_MANDATORY_NEXT, self.vocab.def_tkn,
                             -1, -1, 0, -1)
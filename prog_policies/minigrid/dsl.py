@@ -1,7 +1,6 @@
 from typing import Union
 
 from prog_policies.base import BaseDSL, dsl_nodes
-from prog_policies.base.dsl import _find_close_token
 
 from .minigrid_node import MinigridColorFeatureNode, MinigridObjectFeatureNode
 
@@ -136,10 +135,7 @@ class MinigridDSL(BaseDSL):
         tokens_list = list(dict.fromkeys(tokens_list))
         return tokens_list
 
-    def parse_node_to_str(self, node: dsl_nodes.BaseNode) -> str:
-        if node is None:
-            return "<HOLE>"
-
+    def _node_to_str(self, node: dsl_nodes.BaseNode) -> str:
         if isinstance(node, dsl_nodes.ConstInt):
             return "R=" + str(node.value)
         if isinstance(node, dsl_nodes.ConstBool):
@@ -195,130 +191,26 @@ class MinigridDSL(BaseDSL):
 
         raise Exception(f"Unknown node type: {type(node)}")
 
-    def parse_str_list_to_node(self, prog_str_list: list[str]) -> dsl_nodes.BaseNode:
-
-        if prog_str_list[0] in self.actions:
-            if len(prog_str_list) > 1:
-                s1 = dsl_nodes.Action(prog_str_list[0])
-                s2 = self.parse_str_list_to_node(prog_str_list[1:])
-                return dsl_nodes.Concatenate.new(s1, s2)
-            return dsl_nodes.Action(prog_str_list[0])
-
-        if prog_str_list[0] in self.bool_features:
-            if len(prog_str_list) > 1:
-                assert prog_str_list[1] == "h(", "Invalid program"
-                assert prog_str_list[-1] == "h)", "Invalid program"
-                s1 = prog_str_list[0]
-                assert s1 in [
-                    "front_object_type",
-                    "front_object_color",
-                ], "Invalid program"
-                assert len(prog_str_list) == 4, "Invalid program"
-                s2 = prog_str_list[2]
-                if s1 == "front_object_type":
-                    return MinigridObjectFeatureNode.new(s1, s2)
-                elif s1 == "front_object_color":
-                    return MinigridColorFeatureNode.new(s1, s2)
-
-            return dsl_nodes.BoolFeature(prog_str_list[0])
-
-        if prog_str_list[0] in self.int_features:
-            if len(prog_str_list) > 1:
-                s1 = dsl_nodes.IntFeature(prog_str_list[0])
-                s2 = self.parse_str_list_to_node(prog_str_list[1:])
-                return dsl_nodes.Concatenate.new(s1, s2)
-            return dsl_nodes.IntFeature(prog_str_list[0])
-
-        if prog_str_list[0] == "<HOLE>":
-            if len(prog_str_list) > 1:
-                s1 = None
-                s2 = self.parse_str_list_to_node(prog_str_list[1:])
-                return dsl_nodes.Concatenate.new(s1, s2)
-            return None
-
-        if prog_str_list[0] == "DEF":
-            assert prog_str_list[1] == "run", "Invalid program"
-            assert prog_str_list[2] == "m(", "Invalid program"
-            assert prog_str_list[-1] == "m)", "Invalid program"
-            m = self.parse_str_list_to_node(prog_str_list[3:-1])
-            return dsl_nodes.Program.new(m)
-
-        elif prog_str_list[0] == "IF":
-            c_end = _find_close_token(prog_str_list, "c", 1)
-            i_end = _find_close_token(prog_str_list, "i", c_end + 1)
-            c = self.parse_str_list_to_node(prog_str_list[2:c_end])
-            i = self.parse_str_list_to_node(prog_str_list[c_end + 2 : i_end])
-            if i_end == len(prog_str_list) - 1:
-                return dsl_nodes.If.new(c, i)
-            else:
-                return dsl_nodes.Concatenate.new(
-                    dsl_nodes.If.new(c, i),
-                    self.parse_str_list_to_node(prog_str_list[i_end + 1 :]),
-                )
-        elif prog_str_list[0] == "IFELSE":
-            c_end = _find_close_token(prog_str_list, "c", 1)
-            i_end = _find_close_token(prog_str_list, "i", c_end + 1)
-            assert prog_str_list[i_end + 1] == "ELSE", "Invalid program"
-            e_end = _find_close_token(prog_str_list, "e", i_end + 2)
-            c = self.parse_str_list_to_node(prog_str_list[2:c_end])
-            i = self.parse_str_list_to_node(prog_str_list[c_end + 2 : i_end])
-            e = self.parse_str_list_to_node(prog_str_list[i_end + 3 : e_end])
-            if e_end == len(prog_str_list) - 1:
-                return dsl_nodes.ITE.new(c, i, e)
-            else:
-                return dsl_nodes.Concatenate.new(
-                    dsl_nodes.ITE.new(c, i, e),
-                    self.parse_str_list_to_node(prog_str_list[e_end + 1 :]),
-                )
-        elif prog_str_list[0] == "WHILE":
-            c_end = _find_close_token(prog_str_list, "c", 1)
-            w_end = _find_close_token(prog_str_list, "w", c_end + 1)
-            c = self.parse_str_list_to_node(prog_str_list[2:c_end])
-            w = self.parse_str_list_to_node(prog_str_list[c_end + 2 : w_end])
-            if w_end == len(prog_str_list) - 1:
-                return dsl_nodes.While.new(c, w)
-            else:
-                return dsl_nodes.Concatenate.new(
-                    dsl_nodes.While.new(c, w),
-                    self.parse_str_list_to_node(prog_str_list[w_end + 1 :]),
-                )
-        elif prog_str_list[0] == "REPEAT":
-            n = self.parse_str_list_to_node([prog_str_list[1]])
-            r_end = _find_close_token(prog_str_list, "r", 2)
-            r = self.parse_str_list_to_node(prog_str_list[3:r_end])
-            if r_end == len(prog_str_list) - 1:
-                return dsl_nodes.Repeat.new(n, r)
-            else:
-                return dsl_nodes.Concatenate.new(
-                    dsl_nodes.Repeat.new(n, r),
-                    self.parse_str_list_to_node(prog_str_list[r_end + 1 :]),
-                )
-
-        elif prog_str_list[0] == "not":
-            assert prog_str_list[1] == "c(", "Invalid program"
-            assert prog_str_list[-1] == "c)", "Invalid program"
-            c = self.parse_str_list_to_node(prog_str_list[2:-1])
-            return dsl_nodes.Not.new(c)
-        elif prog_str_list[0] == "and":
-            c1_end = _find_close_token(prog_str_list, "c", 1)
-            assert prog_str_list[c1_end + 1] == "c(", "Invalid program"
-            assert prog_str_list[-1] == "c)", "Invalid program"
-            c1 = self.parse_str_list_to_node(prog_str_list[2:c1_end])
-            c2 = self.parse_str_list_to_node(prog_str_list[c1_end + 2 : -1])
-            return dsl_nodes.And.new(c1, c2)
-        elif prog_str_list[0] == "or":
-            c1_end = _find_close_token(prog_str_list, "c", 1)
-            assert prog_str_list[c1_end + 1] == "c(", "Invalid program"
-            assert prog_str_list[-1] == "c)", "Invalid program"
-            c1 = self.parse_str_list_to_node(prog_str_list[2:c1_end])
-            c2 = self.parse_str_list_to_node(prog_str_list[c1_end + 2 : -1])
-            return dsl_nodes.Or.new(c1, c2)
-
-        elif prog_str_list[0].startswith("R="):
-            num = int(prog_str_list[0].replace("R=", ""))
-            assert num is not None
-            return dsl_nodes.ConstInt(num)
-        elif prog_str_list[0] in ["True", "False"]:
-            return dsl_nodes.ConstBool(prog_str_list[0] == "True")
-        else:
-            raise Exception(f"Unrecognized token: {prog_str_list[0]}.")
+    def get_node_num_tokens(self, node: dsl_nodes.BaseNode) -> int:
+        if isinstance(node, MinigridObjectFeatureNode) or isinstance(node, MinigridColorFeatureNode):
+            return 4
+        return super().get_node_num_tokens(node)
+
+    def _parse_bool_feature(self, tokens, closes, start, end):
+        # Object and color features take their argument between h( and h), and end the sequence
+        if end - start > 1:
+            assert tokens[start + 1] == "h(", "Invalid program"
+            assert tokens[end - 1] == "h)", "Invalid program"
+            s1 = tokens[start]
+            assert s1 in [
+                "front_object_type",
+                "front_object_color",
+            ], "Invalid program"
+            assert end - start == 4, "Invalid program"
+            s2 = tokens[start + 2]
+            if s1 == "front_object_type":
+                return MinigridObjectFeatureNode.new(s1, s2), end
+            elif s1 == "front_object_color":
+                return MinigridColorFeatureNode.new(s1, s2), end
+
+        return dsl_nodes.BoolFeature(tokens[start]), end
@@ -3,6 +3,8 @@ from prog_policies.base import dsl_nodes
 
 class MinigridObjectFeatureNode(dsl_nodes.BoolFeature, dsl_nodes.TerminalNode):
 
+    __slots__ = ('object',)
+
     def __init__(self, name: str):
         super(dsl_nodes.BoolFeature, self).__init__(name)
         self.object = "object"
@@ -19,6 +21,8 @@ class MinigridObjectFeatureNode(dsl_nodes.BoolFeature, dsl_nodes.TerminalNode):
 
 class MinigridColorFeatureNode(dsl_nodes.BoolFeature, dsl_nodes.TerminalNode):
 
+    __slots__ = ('color',)
+
     def __init__(self, name: str):
         super(dsl_nodes.BoolFeature, self).__init__(name)
         self.color = "color"
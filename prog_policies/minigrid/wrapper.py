@@ -3,7 +3,7 @@ from typing import Any, SupportsFloat
 
 from gymnasium import Wrapper
 from ..base.dsl_nodes import dsl_nodes
-from ..base import BaseDSL
+from ..base import BaseDSL, CompiledProgram, compile_program
 from minigrid.core.actions import Actions
 from minigrid.minigrid_env import MiniGridEnv
 from .dsl import MinigridDSL
@@ -13,7 +13,7 @@ from minigrid.core.grid import Grid
 import os
 from PIL import Image
 
-from copy import deepcopy
+from copy import copy, deepcopy
 
 
 class RewardWrapper(Wrapper):
@@ -87,32 +87,107 @@ class ProgramWrapper(Wrapper):
         self.record_history = record_history
         self.history = []
         self.program_num = 0
+        # Snapshot of the underlying env right after the first seeded reset
+        self.initial_snapshot = None
         super().__init__(env)
 
     def __eq__(self, other):
         return self.hash() == other.hash()
 
+    def state_fingerprint(self) -> str:
+        return self.hash()
+
     def reset(self) -> tuple[Any, dict[str, Any]]:
+        self.reset_episode()
+        return self.unwrapped.gen_obs(), {}
+
+    def reset_episode(self) -> None:
+        """
+        Same as reset, without building the first observation
+        """
         self.reward = 0.0
         self.terminated = False
         self.info = {}
         self.num_calls = 0
         self.crushed = False
         self.history = []
-        return super().reset(seed=self.seed)
+        if self.initial_snapshot is None:
+            super().reset(seed=self.seed)
+            self.initial_snapshot = self.snapshot()
+        else:
+            # The seeded reset always regenerates the same grid, so restore it instead
+            self.restore(self.initial_snapshot)
+
+    # Attributes of the underlying env that are not episode state
+    snapshot_excluded_attributes = (
+        "actions",
+        "action_space",
+        "observation_space",
+        "mission_space",
+        "window",
+        "clock",
+        "_np_random",
+    )
+
+    def snapshot(self) -> tuple[dict[str, Any], dict[str, Any]]:
+        env = self.unwrapped
+        attributes = {
+            name: value
+            for name, value in vars(env).items()
+            if name not in self.snapshot_excluded_attributes
+        }
+        return self._copy_episode_state(attributes), deepcopy(env.np_random.bit_generator.state)
+
+    def restore(self, snapshot: tuple[dict[str, Any], dict[str, Any]]) -> None:
+        attributes, rng_state = snapshot
+        env = self.unwrapped
+        env.__dict__.update(self._copy_episode_state(attributes))
+        env.np_random.bit_generator.state = rng_state
+
+    @staticmethod
+    def _copy_episode_state(attributes: dict[str, Any]) -> dict[str, Any]:
+        """
+        Copy the episode attributes of a MiniGridEnv, much faster than a deepcopy of the grid.
+        Minigrid only reassigns the attributes of world objects, so a shallow copy per object is
+        enough as long as every reference to an object (grid cell, carrying, env attribute) points
+        to the same copy.
+        """
+        copies = {}
+
+        def copy_object(obj: WorldObj | None) -> WorldObj | None:
+            if obj is None:
+                return None
+            if id(obj) not in copies:
+                obj_copy = object.__new__(type(obj))
+                obj_copy.__dict__.update(obj.__dict__)
+                copies[id(obj)] = obj_copy
+                obj_copy.contains = copy_object(obj.contains)
+            return copies[id(obj)]
+
+        episode_state = {}
+        for name, value in attributes.items():
+            if isinstance(value, Grid):
+                grid = copy(value)
+                grid.grid = [copy_object(obj) for obj in value.grid]
+                episode_state[name] = grid
+            elif isinstance(value, WorldObj):
+                episode_state[name] = copy_object(value)
+            else:
+                episode_state[name] = deepcopy(value)
+        return episode_state
 
     def evaluate_program(
         self,
-        program: dsl_nodes.Program,
+        program: dsl_nodes.Program | CompiledProgram,
         record_video: bool = False,
         record_dir: str = None,
     ) -> float:
-        self.reset()
+        self.reset_episode()
         reward = 0.0
         self.program_num += 1
         if record_video:
             images = []
-        for _ in program.run_generator(self):
+        for _ in compile_program(program).run_generator(self):
             if record_video:
                 images.append(self.get_frame())
             terminated, instant_reward = self.get_reward()
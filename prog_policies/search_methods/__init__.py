@@ -6,6 +6,9 @@ from .cem import CEM
 from .cebs import CEBS
 from .hill_climbing_latent import HillClimbingLatent
 from .scheduled_hill_climbing import Scheduled_HillClimbing
+from .parallel_evaluation import ParallelEvaluator
+from .evaluation_cache import EvaluationCache
+from .behavior_cache import BehaviorCache
 
 def get_search_method_cls(search_cls_name: str) -> type[BaseSearch]:
     search_cls = globals().get(search_cls_name)
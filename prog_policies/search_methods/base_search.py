@@ -1,9 +1,18 @@
 from __future__ import annotations
 from abc import ABC, abstractmethod
+from typing import Iterable, Iterator, Union
 import numpy as np
 
 from ..search_space import BaseSearchSpace
-from ..base import dsl_nodes, BaseTask, BaseDSL
+from ..base import dsl_nodes, BaseTask, BaseDSL, CompiledProgram, compile_program
+from ..base.compiler import get_divergence_path
+
+
+def iter_and_keep(items: Iterable, kept: list) -> Iterator:
+    """Yields the items of an iterable, appending each one to kept as it is consumed"""
+    for item in items:
+        kept.append(item)
+        yield item
 
 
 class BaseSearch(ABC):
@@ -14,6 +23,25 @@ class BaseSearch(ABC):
         self.best_reward = -float("inf")
         self.record = {}
         self.program_record = {}
+        self.batch_evaluation = False
+        self.parallel_evaluator = None
+        self.evaluation_cache = None
+        self.incremental_evaluation = False
+        self.early_cutoff = False
+        self.fidelity_ladder = None
+        self.checkpoint_program = None
+        self.checkpoint_records = None
+        # Canonical subtree ids (SubtreeTable) shared with the evaluation cache, compares programs
+        # to the checkpoint program without walking their equal subtrees
+        self.subtree_table = None
+        # Programs are rewritten into their canonical form (ProgramNormalizer) before being evaluated
+        # and cached, the search itself keeps the original programs
+        self.normalizer = None
+        # Programs whose return is proven from the initial states (ProgramAnalyzer) are not run
+        self.analyzer = None
+        # Programs that run the same actions as an evaluated one in the first environments
+        # (BehaviorCache) reuse its mean return, only used by sequential evaluation
+        self.behavior_cache = None
     
     @abstractmethod
     def search(self, search_space: BaseSearchSpace, task_envs: list[BaseTask],
@@ -37,6 +65,97 @@ class BaseSearch(ABC):
                seed = None, n_iterations: int = 10000, dsl: BaseDSL = None, record_type: str = "") -> tuple[list[dsl_nodes.Program], list[float]]:
         pass
     
+    def evaluate_program_per_env(self, program: dsl_nodes.Program, task_envs: list[BaseTask],
+                                 threshold: float = None, rewards: list[float] = None,
+                                 stop: int = None) -> list[float]:
+        """Evaluates a program in each task environment
+
+        Args:
+            program (dsl_nodes.Program): Input program
+            task_envs (list[BaseTask]): List of task environments
+            threshold (float, optional): If provided, environments are evaluated in order until the
+            mean return can no longer exceed threshold (see is_cut_off). Defaults to None.
+            rewards (list[float], optional): Returns already obtained in the first environments, the
+            evaluation continues from the next one. Defaults to None.
+            stop (int, optional): Evaluates only up to this environment index. Defaults to None (all).
+
+        Returns:
+            list[float]: Episodic return obtained in each evaluated task environment, shorter than
+            task_envs if the evaluation was cut off or stopped
+        """
+        rewards = [] if rewards is None else list(rewards)
+        start = len(rewards)
+        stop = len(task_envs) if stop is None else stop
+        if start >= stop:
+            return rewards
+        if self.checkpoint_program is not None and isinstance(task_envs[0], BaseTask) \
+                and all(task_env.checkpointable for task_env in task_envs):
+            checkpoint_rewards = self._evaluate_program_from_checkpoints(program, task_envs, threshold,
+                                                                         rewards, stop)
+            if checkpoint_rewards is not None:
+                return checkpoint_rewards
+        # Compile once, all task environments share the same instruction list
+        compiled_program = compile_program(program)
+        if self.batch_evaluation and isinstance(task_envs[0], BaseTask):
+            batch_rewards = type(task_envs[0]).evaluate_program_batch(compiled_program, task_envs[start:stop])
+            if batch_rewards is not None:
+                return rewards + batch_rewards
+        for task_env in task_envs[start:stop]:
+            rewards.append(task_env.evaluate_program(compiled_program))
+            if self.is_cut_off(rewards, task_envs, threshold):
+                break
+        return rewards
+
+    def is_cut_off(self, rewards: list[float], task_envs: list[BaseTask], threshold: float = None) -> bool:
+        # The remaining environments can at most reach the maximum return of the task
+        if threshold is None or len(rewards) == len(task_envs):
+            return False
+        return self.get_reward_bound(rewards, task_envs) <= threshold
+
+    def get_reward_bound(self, rewards: list[float], task_envs: list[BaseTask]) -> float:
+        sum_reward = 0.
+        for reward in rewards:
+            sum_reward += reward
+        return (sum_reward + task_envs[0].max_return * (len(task_envs) - len(rewards))) / len(task_envs)
+    
+    def set_checkpoint_program(self, program: dsl_nodes.Program) -> None:
+        """Sets the program whose neighbors are evaluated next (e.g. the current hill climbing
+        solution). With incremental_evaluation, its episodes are recorded on first use and programs
+        that differ from it in one subtree resume from the first time that subtree is reached
+
+        Args:
+            program (dsl_nodes.Program): Reference program
+        """
+        if not self.incremental_evaluation or program is self.checkpoint_program:
+            return
+        self.checkpoint_program = program
+        self.checkpoint_records = None
+
+    def _evaluate_program_from_checkpoints(self, program: dsl_nodes.Program, task_envs: list[BaseTask],
+                                           threshold: float, rewards: list[float],
+                                           stop: int) -> Union[list[float], None]:
+        if isinstance(program, CompiledProgram):
+            program = program.program
+        if self.checkpoint_records is None or self.checkpoint_records[0] is not task_envs:
+            recorded_program = CompiledProgram(self.checkpoint_program, record_checkpoints=True)
+            records = [task_env.record_checkpoints(recorded_program) for task_env in task_envs]
+            self.checkpoint_records = (task_envs, recorded_program, records)
+        _, recorded_program, records = self.checkpoint_records
+        start = len(rewards)
+        path = get_divergence_path(self.checkpoint_program, program, self.subtree_table)
+        if path is None:
+            for task_env in task_envs[start:stop]:
+                task_env.program_num += 1
+            return rewards + [record["reward"] for record in records[start:stop]]
+        path = recorded_program.get_statement_path(path)
+        if path is None:
+            return None
+        for task_env, record in zip(task_envs[start:stop], records[start:stop]):
+            rewards.append(task_env.evaluate_program_from_checkpoint(program, record, path))
+            if self.is_cut_off(rewards, task_envs, threshold):
+                break
+        return rewards
+    
     def evaluate_program(self, program: dsl_nodes.Program, task_envs: list[BaseTask]) -> float:
         """Evaluates a program in a list of task environments
 
@@ -47,21 +166,231 @@ class BaseSearch(ABC):
         Returns:
             float: Mean episodic return obtained in the task environments
         """
+        average_reward, _ = self.evaluate_program_bounded(program, task_envs)
+        return average_reward
+
+    def evaluate_program_bounded(self, program: dsl_nodes.Program, task_envs: list[BaseTask],
+                                 threshold: float = float("inf")) -> tuple[float, bool]:
+        """Evaluates a program in a list of task environments. With early_cutoff, the evaluation
+        stops as soon as the mean return can no longer exceed threshold, assuming every remaining
+        environment reaches the maximum return of the task. With a fidelity_ladder (increasing numbers
+        of environments), the program is first evaluated in the first environments of each rung and
+        only promoted to the next rung if its mean return there exceeds threshold. With a
+        behavior_cache, the program is first evaluated in the environments of its lookup and is rejected
+        without further evaluation if a program with the same action traces there has a mean return not
+        above threshold
+
+        Args:
+            program (dsl_nodes.Program): Input program
+            task_envs (list[BaseTask]): List of task environments
+            threshold (float, optional): Reward to improve on. Defaults to inf (full evaluation).
+
+        Returns:
+            float: Mean episodic return, or if truncated an estimate of it not above threshold (upper
+            bound, low fidelity mean or mean return of a program with the same behavior)
+            bool: Whether the evaluation was truncated
+        """
+        if self.normalizer is not None:
+            program = self.normalizer.normalize(program)
+        if self.evaluation_cache is not None:
+            key = self.evaluation_cache.get_key(program)
+            cached_reward = self.evaluation_cache.get(key)
+            if cached_reward is not None:
+                if self.evaluation_cache.count_hits:
+                    for task_env in task_envs:
+                        task_env.program_num += 1
+                return cached_reward, False
+        cutoff_threshold = threshold
+        if not self.early_cutoff or threshold == float("inf") or getattr(task_envs[0], "max_return", None) is None:
+            cutoff_threshold = None
+        if self.analyzer is not None:
+            known_rewards = self.analyzer.get_env_rewards(program, task_envs)
+            if known_rewards is not None and all(reward is not None for reward in known_rewards):
+                self.analyzer.skipped += 1
+                for task_env in task_envs:
+                    task_env.program_num += 1
+                average_reward = self.get_average_reward(known_rewards, task_envs)
+                if self.evaluation_cache is not None:
+                    self.evaluation_cache.put(key, average_reward)
+                return average_reward, False
+            if known_rewards is not None and cutoff_threshold is not None:
+                bound = self.get_reward_bound([reward for reward in known_rewards if reward is not None], task_envs)
+                if bound <= cutoff_threshold:
+                    self.analyzer.bounded += 1
+                    return self._truncate_evaluation([], task_envs, bound)
+        rewards = []
+        traces = None
+        if self.behavior_cache is not None \
+                and all(isinstance(task_env, BaseTask) and task_env.seed is not None for task_env in task_envs):
+            rewards, traces = self._evaluate_program_traces(program, task_envs, cutoff_threshold)
+            if len(traces) < self.behavior_cache.get_num_envs(len(task_envs)):
+                return self._truncate_evaluation(rewards, task_envs, self.get_reward_bound(rewards, task_envs))
+            # A reused reward only rejects the program, accepted and recorded rewards are always full
+            # means of the program itself
+            if threshold != float("inf"):
+                behavior_reward = self.behavior_cache.get(traces, threshold)
+                if behavior_reward is not None:
+                    return self._truncate_evaluation(rewards, task_envs, behavior_reward)
+        if self.fidelity_ladder is not None and threshold != float("inf"):
+            for num_envs in self.fidelity_ladder:
+                if num_envs >= len(task_envs):
+                    break
+                # Rungs already reached by the rewards obtained so far (e.g. the behavior cache runs) are skipped
+                if num_envs <= len(rewards):
+                    continue
+                rewards = self.evaluate_program_per_env(program, task_envs, cutoff_threshold, rewards, num_envs)
+                if len(rewards) < num_envs or self.is_cut_off(rewards, task_envs, cutoff_threshold):
+                    return self._truncate_evaluation(rewards, task_envs, self.get_reward_bound(rewards, task_envs))
+                low_fidelity_reward = sum(rewards) / len(rewards)
+                if low_fidelity_reward <= threshold:
+                    return self._truncate_evaluation(rewards, task_envs, low_fidelity_reward)
+        rewards = self.evaluate_program_per_env(program, task_envs, cutoff_threshold, rewards)
+        if len(rewards) < len(task_envs):
+            return self._truncate_evaluation(rewards, task_envs, self.get_reward_bound(rewards, task_envs))
+        average_reward = self.get_average_reward(rewards, task_envs)
+        if self.evaluation_cache is not None:
+            self.evaluation_cache.put(key, average_reward)
+        if traces is not None:
+            self.behavior_cache.put(traces, average_reward)
+        return average_reward, False
+
+    def _evaluate_program_traces(self, program: dsl_nodes.Program, task_envs: list[BaseTask],
+                                 threshold: float = None) -> tuple[list[float], tuple[int, ...]]:
+        # Evaluates the program in the environments looked up by the behavior cache, returns their
+        # rewards and traces (fewer if cut off)
+        compiled_program = compile_program(program)
+        rewards = []
+        traces = []
+        for task_env in task_envs[:self.behavior_cache.get_num_envs(len(task_envs))]:
+            reward, trace = task_env.evaluate_program_trace(compiled_program)
+            rewards.append(reward)
+            traces.append(trace)
+            if self.is_cut_off(rewards, task_envs, threshold):
+                break
+        return rewards, tuple(traces)
+
+    def get_average_reward(self, rewards: list[float], task_envs: list[BaseTask]) -> float:
         sum_reward = 0.
-        for task_env in task_envs:
-            sum_reward += task_env.evaluate_program(program)
+        for reward in rewards:
+            sum_reward += reward
         return sum_reward / len(task_envs)
     
+    def _truncate_evaluation(self, rewards: list[float], task_envs: list[BaseTask],
+                             reward: float) -> tuple[float, bool]:
+        # A truncated evaluation still counts as one evaluated program in every environment
+        for task_env in task_envs[len(rewards):]:
+            task_env.program_num += 1
+        return reward, True
+
     def record_evaluate_program(self, program: dsl_nodes.Program, task_envs: list[BaseTask], dsl: BaseDSL, record_type: str = "") -> float:
-        sum_reward = 0.
-        for task_env in task_envs:
-            sum_reward += task_env.evaluate_program(program)
-        
-        average_reward = sum_reward / len(task_envs)
-        
+        average_reward = self.evaluate_program(program, task_envs)
+        self.record_reward(program, average_reward, task_envs, dsl, record_type)
+        return average_reward
+    
+    def record_reward(self, program: dsl_nodes.Program, average_reward: float, task_envs: list[BaseTask], dsl: BaseDSL, record_type: str = "") -> None:
         if average_reward > self.best_reward:
             self.best_reward = average_reward
             self.record[task_envs[0].program_num] = average_reward
             self.program_record[task_envs[0].program_num] = {"type": record_type, "program": dsl.parse_node_to_str(program)}
-        
-        return average_reward
+    
+    def _uses_parallel_evaluator(self, task_envs: list[BaseTask]) -> bool:
+        return self.parallel_evaluator is not None and self.parallel_evaluator.task_envs is task_envs
+    
+    def _parallel_evaluate_candidates(self, programs: Iterable[dsl_nodes.Program],
+                                      best_reward: float) -> tuple[list[float], list[bool], list[bool]]:
+        # Returns the rewards up to the first improvement, whether each one counts toward program_num
+        # and whether it is the bound of a truncated evaluation
+        if self.normalizer is not None:
+            programs = (self.normalizer.normalize(program) for program in programs)
+        cache = self.evaluation_cache
+        analyzer = self.analyzer
+        if cache is None and analyzer is None:
+            rewards, truncated, _ = self.parallel_evaluator.evaluate_until_improvement(programs, best_reward,
+                                                                                       self.checkpoint_program)
+            return rewards, [True] * len(rewards), truncated
+        # Cached and proven programs are answered in place, the statistics only count the consumed results
+        keys = []
+        proven = []
+        def lookup(program):
+            if cache is not None:
+                keys.append(cache.get_key(program))
+                reward = cache.peek(keys[-1])
+                if reward is not None:
+                    proven.append(False)
+                    return reward
+            reward = None
+            if analyzer is not None:
+                task_envs = self.parallel_evaluator.task_envs
+                known_rewards = analyzer.get_env_rewards(program, task_envs)
+                if known_rewards is not None and all(known_reward is not None for known_reward in known_rewards):
+                    reward = self.get_average_reward(known_rewards, task_envs)
+            proven.append(reward is not None)
+            return reward
+        rewards, truncated, known = self.parallel_evaluator.evaluate_until_improvement(
+            programs, best_reward, self.checkpoint_program, lookup)
+        counted = []
+        for index, (reward, is_truncated, is_known) in enumerate(zip(rewards, truncated, known)):
+            if is_known and not proven[index]:
+                cache.record_hit(keys[index])
+                counted.append(cache.count_hits)
+                continue
+            if is_known:
+                analyzer.skipped += 1
+            if cache is not None:
+                cache.misses += 1
+                if not is_truncated:
+                    cache.put(keys[index], reward)
+            counted.append(True)
+        return rewards, counted, truncated
+    
+    def evaluate_candidates(self, programs: Iterable[dsl_nodes.Program], task_envs: list[BaseTask],
+                            best_reward: float = float("inf")) -> list[float]:
+        """Evaluates programs in order, stopping at the first one whose reward is greater than
+        best_reward. Uses the parallel evaluator if one is set for these task environments
+
+        Args:
+            programs (Iterable[dsl_nodes.Program]): Candidate programs, consumed lazily
+            task_envs (list[BaseTask]): List of task environments
+            best_reward (float, optional): Reward to improve on. Defaults to inf (evaluate all).
+
+        Returns:
+            list[float]: Rewards of the evaluated programs, the last one is the improvement if any.
+            With early_cutoff, programs that cannot improve on best_reward may report an upper bound
+        """
+        if not self._uses_parallel_evaluator(task_envs):
+            rewards = []
+            for program in programs:
+                reward, _ = self.evaluate_program_bounded(program, task_envs, best_reward)
+                rewards.append(reward)
+                if reward > best_reward:
+                    break
+            return rewards
+        rewards, counted, _ = self._parallel_evaluate_candidates(programs, best_reward)
+        # Workers evaluate their own copies of the tasks, only the accepted evaluations are counted
+        for task_env in task_envs:
+            task_env.program_num += sum(counted)
+        return rewards
+    
+    def record_evaluate_candidates(self, programs: Iterable[dsl_nodes.Program], task_envs: list[BaseTask], dsl: BaseDSL,
+                                   record_type: str = "", best_reward: float = float("inf")) -> list[float]:
+        if not self._uses_parallel_evaluator(task_envs):
+            rewards = []
+            for program in programs:
+                reward, truncated = self.evaluate_program_bounded(program, task_envs, best_reward)
+                # Bounds of truncated evaluations are not above best_reward, so they are never recorded
+                if not truncated:
+                    self.record_reward(program, reward, task_envs, dsl, record_type)
+                rewards.append(reward)
+                if reward > best_reward:
+                    break
+            return rewards
+        consumed_programs = []
+        rewards, counted, truncated = self._parallel_evaluate_candidates(iter_and_keep(programs, consumed_programs),
+                                                                         best_reward)
+        for program, reward, is_counted, is_truncated in zip(consumed_programs, rewards, counted, truncated):
+            if is_counted:
+                for task_env in task_envs:
+                    task_env.program_num += 1
+            if not is_truncated:
+                self.record_reward(program, reward, task_envs, dsl, record_type)
+        return rewards
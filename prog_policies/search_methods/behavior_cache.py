@@ -0,0 +1,65 @@
+from __future__ import annotations
+from collections import OrderedDict
+from typing import Union
+
+
+class BehaviorCache:
+    """LRU cache of mean episodic returns, keyed on the behavior of programs in the first task
+    environments.
+
+    The behavior of a program in an environment is the hash of the actions it runs there, whether it
+    crashed and its return (see BaseTask.evaluate_program_trace). A program is looked up with its
+    traces in the first reference_envs environments, and reuses the mean return of the cached program
+    with the same traces only if their traces also match in the next verify_envs environments. The
+    reuse is exact if these environments are all the task environments, otherwise programs that
+    behave the same in them are assumed to behave the same in the others. Reused returns only reject
+    programs that can not improve on a threshold, an improvement is always evaluated in full.
+    """
+
+    def __init__(self, reference_envs: int = 1, verify_envs: int = 1, max_size: int = 1000000):
+        """
+        Args:
+            reference_envs (int, optional): Number of environments whose traces are the key.
+            Defaults to 1.
+            verify_envs (int, optional): Number of following environments whose traces must also
+            match to reuse a return. Defaults to 1.
+            max_size (int, optional): Maximum number of entries. Defaults to 1000000.
+        """
+        assert reference_envs > 0, "At least one reference environment is required"
+        self.reference_envs = reference_envs
+        self.verify_envs = verify_envs
+        self.max_size = max_size
+        self.entries: OrderedDict[tuple[int, ...], tuple[tuple[int, ...], float]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Lookups whose reference traces matched but not the verification traces
+        self.rejected = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get_num_envs(self, num_task_envs: int) -> int:
+        """Number of environments whose traces are needed for a lookup"""
+        return min(self.reference_envs + self.verify_envs, num_task_envs)
+
+    def get(self, traces: tuple[int, ...], threshold: float = float("inf")) -> Union[float, None]:
+        """Mean return of the cached program with the same traces, None if there is none or if its mean
+        return is above threshold (a program with the same behavior could be an improvement)"""
+        key = traces[:self.reference_envs]
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != traces[self.reference_envs:] or entry[1] > threshold:
+            if entry is not None and entry[0] != traces[self.reference_envs:]:
+                self.rejected += 1
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, traces: tuple[int, ...], reward: float) -> None:
+        # The latest program with these reference traces replaces the previous one
+        key = traces[:self.reference_envs]
+        self.entries[key] = (traces[self.reference_envs:], reward)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
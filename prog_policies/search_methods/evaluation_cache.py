@@ -0,0 +1,106 @@
+from __future__ import annotations
+from collections import OrderedDict
+import json
+import os
+from typing import Union
+
+from ..base import dsl_nodes, BaseDSL, CompiledProgram, SubtreeTable
+
+
+class EvaluationCache:
+    """LRU cache of mean episodic returns, keyed on the program string.
+
+    A cache is only valid for one set of task environments: config describes that set (task name,
+    number of environments, crash settings, ...) and is checked when loading a cache from disk.
+    """
+
+    def __init__(self, dsl: BaseDSL, max_size: int = 1000000, count_hits: bool = True, config: dict = None,
+                 subtree_table: SubtreeTable = None):
+        """
+        Args:
+            dsl (BaseDSL): DSL used to turn programs into keys
+            max_size (int, optional): Maximum number of entries. Defaults to 1000000.
+            count_hits (bool, optional): Whether cache hits still count toward the task program_num,
+            keeping the number of evaluated programs comparable to an uncached run. Defaults to True.
+            config (dict, optional): Description of the task environments. Defaults to None.
+            subtree_table (SubtreeTable, optional): If provided, programs equal to an already seen
+            one get its key from their canonical id instead of building their string. Defaults to None.
+        """
+        self.dsl = dsl
+        self.max_size = max_size
+        self.count_hits = count_hits
+        self.config = config if config is not None else {}
+        self.subtree_table = subtree_table
+        self.subtree_keys: dict[int, str] = {}
+        self.entries: OrderedDict[str, float] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_key(self, program: Union[dsl_nodes.Program, CompiledProgram]) -> str:
+        if isinstance(program, CompiledProgram):
+            program = program.program
+        if self.subtree_table is None:
+            return self.dsl.parse_node_to_str(program)
+        subtree_id = self.subtree_table.get_id(program)
+        key = self.subtree_keys.get(subtree_id)
+        if key is None:
+            if len(self.subtree_keys) >= self.max_size:
+                self.subtree_keys = {}
+            key = self.subtree_keys[subtree_id] = self.dsl.parse_node_to_str(program)
+        return key
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def peek(self, key: str) -> Union[float, None]:
+        # Lookup without touching the statistics or the LRU order, see record_hit
+        return self.entries.get(key)
+
+    def record_hit(self, key: str) -> None:
+        self.hits += 1
+        if key in self.entries:
+            self.entries.move_to_end(key)
+
+    def get(self, key: str) -> Union[float, None]:
+        reward = self.entries.get(key)
+        if reward is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return reward
+
+    def put(self, key: str, reward: float) -> None:
+        self.entries[key] = reward
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def load(self, path: str) -> bool:
+        """Loads the entries saved at path, returns False if the file is missing or was saved with
+        a different config"""
+        if not os.path.isfile(path):
+            return False
+        with open(path, "r") as f:
+            data = json.load(f)
+        if data["config"] != self.config:
+            return False
+        # Loaded entries are older than the ones in memory, they go in front keeping their order
+        for key, reward in reversed(data["entries"]):
+            if key not in self.entries:
+                self.entries[key] = reward
+                self.entries.move_to_end(key, last=False)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return True
+
+    def save(self, path: str) -> None:
+        # Entries saved meanwhile by other runs (e.g. other seeds) are merged before writing
+        self.load(path)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"config": self.config, "entries": list(self.entries.items())}, f)
+        os.replace(tmp_path, path)
@@ -47,7 +47,7 @@ class HillClimbingLatent(BaseSearch):
         for _ in range(n_iterations):
             if best_reward >= 1.0:
                 break
-            candidates = search_space.get_neighbors(best_ind, k=self.k)
+            candidates = search_space.iter_neighbors(best_ind, k=self.k)
             in_local_maximum = True
             for ind, prog in candidates:
                 reward = self.record_evaluate_program(prog, task_envs, dsl, record_type=record_type)
@@ -102,7 +102,7 @@ class HillClimbingLatent(BaseSearch):
         for _ in range(n_iterations):
             if best_reward >= 1.0:
                 break
-            candidates = search_space.get_neighbors(best_ind, k=self.k)
+            candidates = search_space.iter_neighbors(best_ind, k=self.k)
             in_local_maximum = True
             for ind, prog in candidates:
                 reward = self.evaluate_program(prog, task_envs)
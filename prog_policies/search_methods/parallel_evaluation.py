@@ -0,0 +1,132 @@
+from __future__ import annotations
+from collections import deque
+from typing import Callable, Iterable, Union
+import itertools
+import multiprocessing
+
+from ..base import dsl_nodes, BaseTask, BaseDSL
+
+
+# State of each worker process, set once by the pool initializer
+_worker_search_method = None
+_worker_task_envs = None
+_worker_dsl = None
+_worker_checkpoint_program_str = None
+
+
+def _init_worker(search_method, task_envs: list[BaseTask], dsl: BaseDSL) -> None:
+    global _worker_search_method, _worker_task_envs, _worker_dsl
+    # The main process answers cache hits and proven programs, workers only see the other programs.
+    # The behavior cache is only used by sequential evaluation, per worker copies would make the
+    # reused rewards depend on which worker gets each chunk
+    search_method.evaluation_cache = None
+    search_method.analyzer = None
+    search_method.behavior_cache = None
+    _worker_search_method = search_method
+    _worker_task_envs = task_envs
+    _worker_dsl = dsl
+
+
+def _evaluate_chunk(program_strs: list[str], checkpoint_program_str: str = None,
+                    threshold: float = float("inf")) -> list[tuple[float, bool]]:
+    global _worker_checkpoint_program_str
+    # Each worker records the checkpoints of the reference program on its own task environments
+    if checkpoint_program_str is not None and checkpoint_program_str != _worker_checkpoint_program_str:
+        _worker_search_method.set_checkpoint_program(_worker_dsl.parse_str_to_node(checkpoint_program_str))
+        _worker_checkpoint_program_str = checkpoint_program_str
+    results = []
+    for program_str in program_strs:
+        program = _worker_dsl.parse_str_to_node(program_str)
+        results.append(_worker_search_method.evaluate_program_bounded(program, _worker_task_envs, threshold))
+    return results
+
+
+class ParallelEvaluator:
+    """Persistent pool of worker processes, each one holding its own copy of the task environments.
+
+    Programs are sent to the workers as DSL strings, in chunks, and results are consumed in
+    submission order, so the outcome of a first-improvement scan is the same as evaluating the
+    programs one after the other.
+    """
+
+    def __init__(self, search_method, task_envs: list[BaseTask], dsl: BaseDSL, num_workers: int,
+                 chunk_size: int = 16):
+        assert num_workers > 0, "Parallel evaluation requires at least one worker"
+        self.task_envs = task_envs
+        self.dsl = dsl
+        self.num_workers = num_workers
+        self.chunk_size = chunk_size
+        # Forking avoids pickling the task environments, other start methods pickle them once per worker
+        if "fork" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("fork")
+        else:
+            context = multiprocessing.get_context()
+        self.pool = context.Pool(num_workers, initializer=_init_worker,
+                                 initargs=(search_method, task_envs, dsl))
+
+    def evaluate_until_improvement(self, programs: Iterable[dsl_nodes.Program],
+                                   best_reward: float = float("inf"),
+                                   checkpoint_program: dsl_nodes.Program = None,
+                                   lookup: Callable[[dsl_nodes.Program], Union[float, None]] = None
+                                   ) -> tuple[list[float], list[bool], list[bool]]:
+        """Evaluates the programs in order, stopping at the first reward greater than best_reward
+
+        Args:
+            programs (Iterable[dsl_nodes.Program]): Programs to evaluate, consumed lazily a bounded
+            number of chunks ahead of the results
+            best_reward (float, optional): Reward to improve on. Defaults to inf (evaluate all).
+            checkpoint_program (dsl_nodes.Program, optional): Reference program of incremental
+            evaluation, see BaseSearch.set_checkpoint_program. Defaults to None.
+            lookup (Callable[[dsl_nodes.Program], Union[float, None]], optional): Returns the known
+            reward of a program (e.g. a cache hit), or None to evaluate it. Called once per consumed
+            program, in order. Defaults to None.
+
+        Returns:
+            list[float]: Rewards of the programs up to and including the first improvement
+            list[bool]: Whether each reward is the bound of a truncated evaluation (see
+            BaseSearch.evaluate_program_bounded)
+            list[bool]: Whether each reward was given by lookup
+        """
+        programs = iter(programs)
+        if checkpoint_program is not None:
+            checkpoint_program_str = self.dsl.parse_node_to_str(checkpoint_program)
+        else:
+            checkpoint_program_str = None
+        # Keep a bounded number of chunks in flight so little work is wasted after an improvement
+        max_pending = 2 * self.num_workers
+        pending = deque()
+        exhausted = False
+        rewards, truncated, known = [], [], []
+        while True:
+            while not exhausted and len(pending) < max_pending:
+                chunk = list(itertools.islice(programs, self.chunk_size))
+                exhausted = len(chunk) < self.chunk_size
+                if len(chunk) == 0:
+                    break
+                known_rewards = [lookup(program) if lookup is not None else None for program in chunk]
+                program_strs = [self.dsl.parse_node_to_str(program)
+                                for program, known_reward in zip(chunk, known_rewards) if known_reward is None]
+                if len(program_strs) > 0:
+                    result = self.pool.apply_async(_evaluate_chunk, (program_strs, checkpoint_program_str, best_reward))
+                else:
+                    result = None
+                pending.append((known_rewards, result))
+            if not pending:
+                break
+            known_rewards, result = pending.popleft()
+            results = iter(result.get() if result is not None else [])
+            for known_reward in known_rewards:
+                if known_reward is None:
+                    reward, is_truncated = next(results)
+                else:
+                    reward, is_truncated = known_reward, False
+                rewards.append(reward)
+                truncated.append(is_truncated)
+                known.append(known_reward is not None)
+                if reward > best_reward:
+                    return rewards, truncated, known
+        return rewards, truncated, known
+
+    def close(self) -> None:
+        self.pool.terminate()
+        self.pool.join()
@@ -3,7 +3,7 @@ from __future__ import annotations
 from ..search_space import BaseSearchSpace
 from ..base import dsl_nodes, BaseTask, BaseDSL
 
-from .base_search import BaseSearch
+from .base_search import BaseSearch, iter_and_keep
 import math
 import numpy as np
 
@@ -87,16 +87,18 @@ class Scheduled_HillClimbing(BaseSearch):
         for _ in range(n_iterations):
             if best_reward >= 1.0:
                 break
-            candidates = search_space.get_neighbors(best_ind, k=self.k)
+            self.set_checkpoint_program(best_prog)
+            # Neighbors are generated while they are evaluated, the consumed ones are kept in candidates
+            candidates = []
+            candidate_programs = (prog for _, prog in iter_and_keep(search_space.iter_neighbors(best_ind, k=self.k),
+                                                                    candidates))
             in_local_maximum = True
-            for ind, prog in candidates:
-                reward = self.record_evaluate_program(prog, task_envs, dsl, record_type=record_type)
-                if reward > best_reward:
-                    best_ind = ind
-                    best_prog = prog
-                    best_reward = reward
-                    in_local_maximum = False
-                    break
+            candidate_rewards = self.record_evaluate_candidates(candidate_programs, task_envs, dsl,
+                                                                record_type=record_type, best_reward=best_reward)
+            if len(candidate_rewards) > 0 and candidate_rewards[-1] > best_reward:
+                best_ind, best_prog = candidates[len(candidate_rewards) - 1]
+                best_reward = candidate_rewards[-1]
+                in_local_maximum = False
             if in_local_maximum:
                 break
             rewards.append(best_reward)
@@ -131,16 +133,17 @@ class Scheduled_HillClimbing(BaseSearch):
         for _ in range(n_iterations):
             if best_reward >= 1.0:
                 break
-            candidates = search_space.get_neighbors(best_ind, k=self.k)
+            self.set_checkpoint_program(best_prog)
+            # Neighbors are generated while they are evaluated, the consumed ones are kept in candidates
+            candidates = []
+            candidate_programs = (prog for _, prog in iter_and_keep(search_space.iter_neighbors(best_ind, k=self.k),
+                                                                    candidates))
             in_local_maximum = True
-            for ind, prog in candidates:
-                reward = self.evaluate_program(prog, task_envs)
-                if reward > best_reward:
-                    best_ind = ind
-                    best_prog = prog
-                    best_reward = reward
-                    in_local_maximum = False
-                    break
+            candidate_rewards = self.evaluate_candidates(candidate_programs, task_envs, best_reward=best_reward)
+            if len(candidate_rewards) > 0 and candidate_rewards[-1] > best_reward:
+                best_ind, best_prog = candidates[len(candidate_rewards) - 1]
+                best_reward = candidate_rewards[-1]
+                in_local_maximum = False
             if in_local_maximum:
                 break
             rewards.append(best_reward)
@@ -1,5 +1,5 @@
 from __future__ import annotations
-from typing import Any
+from typing import Any, Iterator
 from abc import ABC, abstractmethod
 import numpy as np
 import torch
@@ -36,6 +36,20 @@ class BaseSearchSpace(ABC):
         pass
     
     @abstractmethod
+    def iter_neighbors(self, individual: Any, k: int = 1) -> Iterator[tuple[Any, dsl_nodes.Program]]:
+        """Yields up to k neighbors of a given individual, generating each one on demand. The search
+        space RNG advances by the same amount whether all k neighbors are consumed or not, neighbors
+        are drawn from a child RNG seeded by it (see get_neighbors_rng)
+
+        Args:
+            individual (Any): Input individual
+            k (int, optional): Number of neighbors. Defaults to 1.
+
+        Yields:
+            tuple[Any, dsl_nodes.Program]: Individual and associated program
+        """
+        pass
+
     def get_neighbors(self, individual: Any, k: int = 1) -> list[tuple[Any, dsl_nodes.Program]]:
         """Returns k neighbors of a given individual
 
@@ -47,4 +61,8 @@ class BaseSearchSpace(ABC):
             list[tuple[Any, dsl_nodes.Program]]: List of individuals as tuple of individual and
             associated program
         """
-        pass
+        return list(self.iter_neighbors(individual, k))
+
+    def get_neighbors_rng(self) -> np.random.RandomState:
+        # Drawn when iter_neighbors is called, not when its first neighbor is consumed
+        return np.random.RandomState(self.np_rng.randint(2 ** 31 - 1))
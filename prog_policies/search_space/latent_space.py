@@ -1,4 +1,7 @@
 from __future__ import annotations
+from typing import Iterator, Union
+import numpy as np
+
 import torch
 from torch.autograd import Variable
 
@@ -38,11 +41,14 @@ class LatentSpace(BaseSearchSpace):
                             config['gamma'], None, self.torch_device, False,
                             custom_env=True, custom_kwargs={'config': config['args']})
         self.leaps_dsl = get_DSL(seed=seed)
+        self.leaps_i2t: dict[int, str] = {}
         config['dsl']['num_agent_actions'] = len(self.leaps_dsl.action_functions) + 1
         self.latent_model = ProgramVAE(envs, **config)
         params = torch.load('leaps/weights/LEAPS/best_valid_params.ptp', map_location=self.torch_device)
         self.latent_model.load_state_dict(params[0], strict=False)
         self.hidden_size = self.latent_model.recurrent_hidden_state_size
+        # Neighbors decoded per decoder call by iter_neighbors, get_neighbors decodes all of them at once
+        self.neighbors_batch_size = 32
     
     def _decode(self, individual: torch.Tensor) -> dsl_nodes.Program:
         """Decodes a single latent vector into a program using LEAPS
@@ -59,10 +65,38 @@ class LatentSpace(BaseSearchSpace):
         )
         prog = progs.numpy().tolist()[0]
         prog_len = progs_len.numpy().tolist()[0][0]
+        return self._tokens_to_program(prog, prog_len)
+    
+    def _decode_batch(self, population: torch.Tensor) -> list[Union[dsl_nodes.Program, None]]:
+        """Decodes a batch of latent vectors into programs with a single decoder call
+
+        Args:
+            population (torch.Tensor): latent vectors, one per row
+
+        Returns:
+            list[Union[dsl_nodes.Program, None]]: decoded programs, None for invalid programs
+        """
+        _, progs, progs_len, _, _, _, _, _, _ = self.latent_model.vae.decoder(
+            None, population, teacher_enforcing=False, deterministic=True, evaluate=False
+        )
+        progs = progs.numpy()
+        # Model outputs tokens starting from index 1, the DEF token (index 0) is prepended
+        tokens = np.concatenate([np.zeros((len(progs), 1), dtype=progs.dtype), progs], axis=1)
+        tokens_len = progs_len.numpy().reshape(-1) + 1
+        return self.dsl.parse_int_batch_to_nodes(tokens, tokens_len, self._get_leaps_i2t(tokens, tokens_len))
+    
+    def _get_leaps_i2t(self, tokens: np.ndarray, tokens_len: np.ndarray) -> dict[int, str]:
+        # Tokens of the LEAPS vocabulary, looked up the first time an id is decoded
+        in_program = np.arange(tokens.shape[1])[None, :] < tokens_len[:, None]
+        for i in np.unique(tokens[in_program]).tolist():
+            if i not in self.leaps_i2t:
+                self.leaps_i2t[i] = self.leaps_dsl.intseq2str([i])
+        return self.leaps_i2t
+    
+    def _tokens_to_program(self, prog: list[int], prog_len: int) -> dsl_nodes.Program:
         # Model outputs tokens starting from index 1
         prog_str = self.leaps_dsl.intseq2str([0] + prog[:prog_len])
-        prog = self.dsl.parse_str_to_node(prog_str)
-        return prog
+        return self.dsl.parse_str_to_node(prog_str)
     
     def _encode(self, program: dsl_nodes.Program) -> torch.Tensor:
         """Encodes a program into a latent vector using LEAPS
@@ -105,35 +139,65 @@ class LatentSpace(BaseSearchSpace):
                 continue
         return latent, prog
     
-    def get_neighbors(self, individual: torch.Tensor, k: int = 1) -> list[tuple[torch.Tensor, dsl_nodes.Program]]:
-        """Returns k neighbors of a given latent vector
+    def iter_neighbors(self, individual: torch.Tensor, k: int = 1) -> Iterator[tuple[torch.Tensor, dsl_nodes.Program]]:
+        """Yields up to k neighbors of a given latent vector, decoding them in batches of
+        neighbors_batch_size on demand
 
         Args:
             individual (torch.Tensor): Latent vector
             k (int, optional): Number of neighbors. Defaults to 1.
 
-        Raises:
-            Exception: If no valid neighbor is found after 50 tries
+        Neighbors that do not decode to a valid program after 50 tries fall back to the
+        given latent vector.
+
+        Yields:
+            tuple[torch.Tensor, dsl_nodes.Program]: Latent vector and associated program
+        """
+        return self._iter_neighbors(individual, k, self._get_neighbors_torch_rng())
+
+    def get_neighbors(self, individual: torch.Tensor, k: int = 1) -> list[tuple[torch.Tensor, dsl_nodes.Program]]:
+        """Returns k neighbors of a given latent vector, decoding them in one decoder call
+
+        Args:
+            individual (torch.Tensor): Latent vector
+            k (int, optional): Number of neighbors. Defaults to 1.
 
         Returns:
-            list[tuple[torch.Tensor, dsl_nodes.Program]]: List of individuals as tuples of
-            latent vector and associated program
+            list[tuple[torch.Tensor, dsl_nodes.Program]]: List of latent vectors and associated programs
         """
-        neighbors = []
-        for _ in range(k):
-            n_tries = 0
-            while n_tries < 50:
-                try:
-                    neighbor = individual + self.sigma * torch.randn(
-                        self.hidden_size, generator=self.torch_rng, device=self.torch_device
-                    )
-                    prog = self._decode(neighbor) # Check if it's a valid program
-                    break
-                except (AssertionError, IndexError): # In case of invalid program, try again
-                    n_tries += 1
-                    continue
-            if n_tries >= 50: 
-                neighbor = individual
-                prog = self._decode(neighbor)
-            neighbors.append((neighbor, prog))
+        return self._get_neighbors_batch(individual, k, self._get_neighbors_torch_rng())
+
+    def _get_neighbors_torch_rng(self) -> torch.Generator:
+        torch_rng = torch.Generator(device=self.torch_device)
+        torch_rng.manual_seed(int(self.get_neighbors_rng().randint(1000000)))
+        return torch_rng
+
+    def _iter_neighbors(self, individual: torch.Tensor, k: int,
+                        torch_rng: torch.Generator) -> Iterator[tuple[torch.Tensor, dsl_nodes.Program]]:
+        for start in range(0, k, self.neighbors_batch_size):
+            yield from self._get_neighbors_batch(individual, min(self.neighbors_batch_size, k - start), torch_rng)
+
+    def _get_neighbors_batch(self, individual: torch.Tensor, k: int,
+                             torch_rng: torch.Generator) -> list[tuple[torch.Tensor, dsl_nodes.Program]]:
+        neighbors: list[Union[tuple[torch.Tensor, dsl_nodes.Program], None]] = [None] * k
+        # All perturbations are decoded in one batch, only rows that decode to invalid programs
+        # are sampled again in the next batch
+        pending = list(range(k))
+        n_tries = 0
+        while len(pending) > 0 and n_tries < 50:
+            noise = torch.randn(
+                (len(pending), self.hidden_size), generator=torch_rng, device=self.torch_device
+            )
+            population = individual.unsqueeze(0) + self.sigma * noise
+            progs = self._decode_batch(population)
+            invalid = []
+            for row, index in enumerate(pending):
+                if progs[row] is None:
+                    invalid.append(index)
+                else:
+                    neighbors[index] = (population[row], progs[row])
+            pending = invalid
+            n_tries += 1
+        for index in pending:
+            neighbors[index] = (individual, self._decode(individual))
         return neighbors
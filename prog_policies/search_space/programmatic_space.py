@@ -1,8 +1,9 @@
 from __future__ import annotations
-import copy
+from typing import Iterator
 import numpy as np
 
-from ..base.dsl import dsl_nodes
+from ..base.dsl import BaseDSL, dsl_nodes
+from ..base.sampler import ProgramSampler
 
 from .base_space import BaseSearchSpace
 
@@ -18,11 +19,7 @@ def get_max_height(program: dsl_nodes.Program) -> int:
     Returns:
         int: Maximum height of AST
     """
-    height = 0
-    for child in program.children:
-        if child is not None:
-            height = max(height, get_max_height(child))
-    return height + program.node_depth
+    return program.get_subtree_stats().height
 
 def get_node_current_height(node: dsl_nodes.BaseNode) -> int:
     """Calculates the current height of an input node in a program AST
@@ -39,7 +36,7 @@ def get_node_current_height(node: dsl_nodes.BaseNode) -> int:
         node = node.parent
     return height
 
-def get_max_sequence(program: dsl_nodes.Program, _current_sequence = 1, _max_sequence = 0) -> int:
+def get_max_sequence(program: dsl_nodes.Program) -> int:
     """Returns the length of maximum sequence of Concatenate nodes in an input program
 
     Args:
@@ -48,14 +45,7 @@ def get_max_sequence(program: dsl_nodes.Program, _current_sequence = 1, _max_seq
     Returns:
         int: Length of maximum sequence of Concatenate nodes
     """
-    if isinstance(program, dsl_nodes.Concatenate):
-        _current_sequence += 1
-    else:
-        _current_sequence = 1
-    _max_sequence = max(_max_sequence, _current_sequence)
-    for child in program.children:
-        _max_sequence = max(_max_sequence, get_max_sequence(child, _current_sequence, _max_sequence))
-    return _max_sequence
+    return program.get_subtree_stats().max_sequence_run + 1
 
 def get_node_current_sequence(node: dsl_nodes.BaseNode) -> int:
     """Returns the length of the current sequence of Concatenate nodes in an input program
@@ -72,9 +62,53 @@ def get_node_current_sequence(node: dsl_nodes.BaseNode) -> int:
         node = node.parent
     return current_sequence
 
+def copy_path(program: dsl_nodes.Program, index: int) -> tuple[dsl_nodes.Program, dsl_nodes.BaseNode]:
+    """Copies the nodes from the root of an input program to one of its nodes, the copy shares every
+    other subtree with the input program
+
+    Args:
+        program (dsl_nodes.Program): Input program
+        index (int): Index of the node in program.get_all_nodes()
+
+    Returns:
+        dsl_nodes.Program: Copy of the program
+        dsl_nodes.BaseNode: Copy of the node, whose ancestors are all copies
+    """
+    copied_program = program.shallow_copy()
+    node = copied_program
+    while index > 0:
+        index -= 1
+        for i, child in enumerate(node.children):
+            if child is None:
+                continue
+            child_num_nodes = child.get_subtree_stats().num_nodes
+            if index < child_num_nodes:
+                copied_child = child.shallow_copy()
+                node.set_child(i, copied_child)
+                node = copied_child
+                break
+            index -= child_num_nodes
+    return copied_program, node
+
+def replace_node(node: dsl_nodes.BaseNode, new_node: dsl_nodes.BaseNode) -> None:
+    """Replaces a node by another one in the children of its parent
+
+    Args:
+        node (dsl_nodes.BaseNode): Node to replace
+        new_node (dsl_nodes.BaseNode): New node
+    """
+    for i, child in enumerate(node.parent.children):
+        if child is node:
+            node.parent.set_child(i, new_node)
+
 
 class ProgrammaticSpace(BaseSearchSpace):
     
+    def __init__(self, dsl: BaseDSL, sigma: float = 0.25) -> None:
+        super().__init__(dsl, sigma)
+        # Samples valid programs and mutations directly, instead of rejecting invalid ones
+        self.sampler = ProgramSampler(dsl, max_height=4, max_sequence=6, max_cost=45)
+    
     def _fill_children(self, node: dsl_nodes.BaseNode,
                           current_height: int = 1, current_sequence: int = 0,
                           max_height: int = 4, max_sequence: int = 6) -> None:
@@ -87,20 +121,11 @@ class ProgrammaticSpace(BaseSearchSpace):
             max_height (int, optional): Maximum allowed AST height. Defaults to 4.
             max_sequence (int, optional): Maximum allowed Concatenate sequence. Defaults to 6.
         """
-        node_prod_rules = self.dsl.prod_rules[type(node)]
-        for i, child_type in enumerate(node.get_children_types()):
-            child_probs = self.dsl.get_dsl_nodes_probs(child_type)
-            for child_type in child_probs:
-                if child_type not in node_prod_rules[i]:
-                    child_probs[child_type] = 0.
-                if current_height >= max_height and child_type.get_node_depth() > 0:
-                    child_probs[child_type] = 0.
-            if isinstance(node, dsl_nodes.Concatenate) and current_sequence + 1 >= max_sequence:
-                if dsl_nodes.Concatenate in child_probs:
-                    child_probs[dsl_nodes.Concatenate] = 0.
-            
-            p_list = list(child_probs.values()) / np.sum(list(child_probs.values()))
-            child = self.np_rng.choice(list(child_probs.keys()), p=p_list)
+        height_exhausted = current_height >= max_height
+        sequence_exhausted = isinstance(node, dsl_nodes.Concatenate) and current_sequence + 1 >= max_sequence
+        for i in range(node.get_number_children()):
+            child_table = self.dsl.get_children_table(type(node), i, height_exhausted, sequence_exhausted)
+            child = child_table.sample(self.np_rng)
             child_instance = child()
             if child.get_number_children() > 0:
                 if isinstance(node, dsl_nodes.Concatenate):
@@ -111,16 +136,12 @@ class ProgrammaticSpace(BaseSearchSpace):
                                         1, max_height, max_sequence)
             
             elif isinstance(child_instance, dsl_nodes.Action):
-                child_instance.name = self.np_rng.choice(list(self.dsl.action_probs.keys()),
-                                                         p=list(self.dsl.action_probs.values()))
+                child_instance.name = self.dsl.get_terminal_table('action_probs').sample(self.np_rng)
             elif isinstance(child_instance, dsl_nodes.BoolFeature):
-                child_instance.name = self.np_rng.choice(list(self.dsl.bool_feat_probs.keys()),
-                                                         p=list(self.dsl.bool_feat_probs.values()))
+                child_instance.name = self.dsl.get_terminal_table('bool_feat_probs').sample(self.np_rng)
             elif isinstance(child_instance, dsl_nodes.ConstInt):
-                child_instance.value = self.np_rng.choice(list(self.dsl.const_int_probs.keys()),
-                                                          p=list(self.dsl.const_int_probs.values()))
-            node.children[i] = child_instance
-            child_instance.parent = node
+                child_instance.value = self.dsl.get_terminal_table('const_int_probs').sample(self.np_rng)
+            node.set_child(i, child_instance)
 
     def initialize_individual(self) -> tuple[dsl_nodes.Program, dsl_nodes.Program]:
         """Initializes individual using probabilistic DSL
@@ -129,13 +150,16 @@ class ProgrammaticSpace(BaseSearchSpace):
             tuple[dsl_nodes.Program, dsl_nodes.Program]: Individual as tuple of
             program (individual) and program (decoding)
         """
+        if self.sampler is not None:
+            program = dsl_nodes.Program()
+            self.sampler.fill_children(program, self.np_rng)
+            return program, program
         accepted = False
         while not accepted:
             program = dsl_nodes.Program()
             self._fill_children(program, max_height=4, max_sequence=6)
-            prog_str = self.dsl.parse_node_to_str(program)
             accepted = get_max_height(program) <= 4 and get_max_sequence(program) <= 6 \
-                and len(prog_str.split(" ")) <= 45
+                and self.dsl.get_num_tokens(program) <= 45
         return program, program
     
     def _mutate_node(self, node_to_mutate: dsl_nodes.BaseNode) -> None:
@@ -146,67 +170,78 @@ class ProgrammaticSpace(BaseSearchSpace):
         """
         for i, child in enumerate(node_to_mutate.parent.children):
             if child == node_to_mutate:
-                child_type = node_to_mutate.parent.children_types[i]
-                node_prod_rules = self.dsl.prod_rules[type(node_to_mutate.parent)]
-                child_probs = self.dsl.get_dsl_nodes_probs(child_type)
-                for child_type in child_probs:
-                    if child_type not in node_prod_rules[i]:
-                        child_probs[child_type] = 0.
-                
-                p_list = list(child_probs.values()) / np.sum(list(child_probs.values()))
-                child = self.np_rng.choice(list(child_probs.keys()), p=p_list)
+                child = self.dsl.get_children_table(type(node_to_mutate.parent), i).sample(self.np_rng)
                 child_instance = child()
                 if child.get_number_children() > 0:
-                    curr_seq = get_node_current_sequence(node_to_mutate)
-                    if child_type == dsl_nodes.Concatenate:
-                        curr_seq += 1
-                    else:
-                        curr_seq = 1
+                    # The sequence restarts at the new node
+                    curr_seq = 1
                     curr_height = get_node_current_height(node_to_mutate) + child.get_node_depth()
                     self._fill_children(child_instance, current_height=curr_height, current_sequence=curr_seq,
                         max_height=4, max_sequence=6)
                 elif isinstance(child_instance, dsl_nodes.Action):
-                    child_instance.name = self.np_rng.choice(list(self.dsl.action_probs.keys()),
-                                                             p=list(self.dsl.action_probs.values()))
+                    child_instance.name = self.dsl.get_terminal_table('action_probs').sample(self.np_rng)
                 elif isinstance(child_instance, dsl_nodes.BoolFeature):
-                    child_instance.name = self.np_rng.choice(list(self.dsl.bool_feat_probs.keys()),
-                                                             p=list(self.dsl.bool_feat_probs.values()))
+                    child_instance.name = self.dsl.get_terminal_table('bool_feat_probs').sample(self.np_rng)
                 elif isinstance(child_instance, dsl_nodes.ConstInt):
-                    child_instance.value = self.np_rng.choice(list(self.dsl.const_int_probs.keys()),
-                                                              p=list(self.dsl.const_int_probs.values()))
-                node_to_mutate.parent.children[i] = child_instance
-                child_instance.parent = node_to_mutate.parent
+                    child_instance.value = self.dsl.get_terminal_table('const_int_probs').sample(self.np_rng)
+                node_to_mutate.parent.set_child(i, child_instance)
             
-    def get_neighbors(self, individual, k = 1) -> list[tuple[dsl_nodes.Program, dsl_nodes.Program]]:
-        """Returns k neighbors of a given individual encoded as a program
+    def iter_neighbors(self, individual, k = 1) -> Iterator[tuple[dsl_nodes.Program, dsl_nodes.Program]]:
+        """Yields up to k neighbors of a given individual encoded as a program, generating each one
+        on demand. Neighbors only copy the path from the root to the mutated node and share every other
+        subtree with the individual, whose nodes are left unchanged
 
         Args:
             individual (dsl_nodes.Program): Individual as a program
             k (int, optional): Number of neighbors. Defaults to 1.
 
-        Returns:
-            list[tuple[dsl_nodes.Program, dsl_nodes.Program]]: List of individuals as tuples of
-            program (individual) and program (decoding)
+        Yields:
+            tuple[dsl_nodes.Program, dsl_nodes.Program]: Individual as a tuple of program (individual)
+            and program (decoding)
         """
-        neighbors = []
+        return self._iter_neighbors(individual, k, self.get_neighbors_rng())
+
+    def _iter_neighbors(self, individual: dsl_nodes.Program, k: int,
+                        rng: np.random.RandomState) -> Iterator[tuple[dsl_nodes.Program, dsl_nodes.Program]]:
+        mutations = None
         for _ in range(k):
-            # Easiest way to do a valid mutation is to do a random mutation until we find a valid one
-            # This could be changed by restricting the mutation space (_fill_children args in _mutate_node)
-            accepted = False
-            while not accepted:
-                mutated_program = copy.deepcopy(individual)
-                node_to_mutate = self.np_rng.choice(mutated_program.get_all_nodes()[1:])
-                self._mutate_node(node_to_mutate)
-                prog_str = self.dsl.parse_node_to_str(mutated_program)
-                accepted = get_max_height(mutated_program) <= 4 and get_max_sequence(mutated_program) <= 6 \
-                    and len(prog_str.split(" ")) <= 45
-            neighbors.append((mutated_program, mutated_program))
-        return neighbors
+            if self.sampler is not None:
+                # Mutation probabilities are computed once for all the neighbors
+                if mutations is None:
+                    mutations = self.sampler.get_mutations(individual)
+                index, new_node = self.sampler.sample_mutation(mutations, rng)
+                mutated_program, node_to_mutate = copy_path(individual, index)
+                replace_node(node_to_mutate, new_node)
+                yield mutated_program, mutated_program
+                continue
+            # Mutations draw from self.np_rng, which is the neighbors RNG only while a neighbor is built
+            search_space_rng, self.np_rng = self.np_rng, rng
+            try:
+                mutated_program = self._get_neighbor(individual)
+            finally:
+                self.np_rng = search_space_rng
+            yield mutated_program, mutated_program
+
+    def _get_neighbor(self, individual: dsl_nodes.Program) -> dsl_nodes.Program:
+        # Easiest way to do a valid mutation is to do a random mutation until we find a valid one
+        # This could be changed by restricting the mutation space (_fill_children args in _mutate_node)
+        accepted = False
+        while not accepted:
+            # Same draw as choosing from get_all_nodes()[1:], the root is never mutated
+            index = self.np_rng.choice(individual.get_subtree_stats().num_nodes - 1) + 1
+            mutated_program, node_to_mutate = copy_path(individual, index)
+            self._mutate_node(node_to_mutate)
+            accepted = get_max_height(mutated_program) <= 4 and get_max_sequence(mutated_program) <= 6 \
+                and self.dsl.get_num_tokens(mutated_program) <= 45
+        return mutated_program
     
 
 class MinigridProgrammaticSpace(ProgrammaticSpace):
     def __init__(self, dsl: MinigridDSL, sigma: float = 0.25):
         super().__init__(dsl, sigma)
+        # Object and color features expand to several tokens depending on the drawn name, which
+        # the sampler does not model: programs and mutations are rejected until valid instead
+        self.sampler = None
 
     def _fill_children(self, node: dsl_nodes.BaseNode,
                           current_height: int = 1, current_sequence: int = 0,
@@ -222,20 +257,11 @@ class MinigridProgrammaticSpace(ProgrammaticSpace):
         """
         # Minigrid environment is different from the general one because boolean features contains terminal node and non-terminal node
         # So, we need to handle the boolean features separately
-        node_prod_rules = self.dsl.prod_rules[type(node)]
-        for i, child_type in enumerate(node.get_children_types()):
-            child_probs = self.dsl.get_dsl_nodes_probs(child_type)
-            for child_type in child_probs:
-                if child_type not in node_prod_rules[i]:
-                    child_probs[child_type] = 0.
-                if current_height >= max_height and child_type.get_node_depth() > 0:
-                    child_probs[child_type] = 0.
-            if isinstance(node, dsl_nodes.Concatenate) and current_sequence + 1 >= max_sequence:
-                if dsl_nodes.Concatenate in child_probs:
-                    child_probs[dsl_nodes.Concatenate] = 0.
-            
-            p_list = list(child_probs.values()) / np.sum(list(child_probs.values()))
-            child = self.np_rng.choice(list(child_probs.keys()), p=p_list)
+        height_exhausted = current_height >= max_height
+        sequence_exhausted = isinstance(node, dsl_nodes.Concatenate) and current_sequence + 1 >= max_sequence
+        for i in range(node.get_number_children()):
+            child_table = self.dsl.get_children_table(type(node), i, height_exhausted, sequence_exhausted)
+            child = child_table.sample(self.np_rng)
             child_instance = child()
             if child.get_number_children() > 0:
                 if isinstance(node, dsl_nodes.Concatenate):
@@ -246,25 +272,19 @@ class MinigridProgrammaticSpace(ProgrammaticSpace):
                                         1, max_height, max_sequence)
             
             elif isinstance(child_instance, dsl_nodes.Action):
-                child_instance.name = self.np_rng.choice(list(self.dsl.action_probs.keys()),
-                                                         p=list(self.dsl.action_probs.values()))
+                child_instance.name = self.dsl.get_terminal_table('action_probs').sample(self.np_rng)
             elif isinstance(child_instance, dsl_nodes.BoolFeature):
-                child_instance.name = self.np_rng.choice(list(self.dsl.bool_feat_probs.keys()),
-                                                         p=list(self.dsl.bool_feat_probs.values()))
+                child_instance.name = self.dsl.get_terminal_table('bool_feat_probs').sample(self.np_rng)
                 # case for MinigridObjectFeatureNode and MinigridColorFeatureNode
                 if child_instance.name == 'front_object_type':
                     child_instance = minigrid_node.MinigridObjectFeatureNode("front_object_type")
-                    child_instance.object = self.np_rng.choice(list(self.dsl.obj_feat_probs.keys()),
-                                                            p=list(self.dsl.obj_feat_probs.values()))
+                    child_instance.object = self.dsl.get_terminal_table('obj_feat_probs').sample(self.np_rng)
                 elif child_instance.name == 'front_object_color':
                     child_instance = minigrid_node.MinigridColorFeatureNode("front_object_color")
-                    child_instance.color = self.np_rng.choice(list(self.dsl.color_feat_probs.keys()),
-                                                            p=list(self.dsl.color_feat_probs.values()))
+                    child_instance.color = self.dsl.get_terminal_table('color_feat_probs').sample(self.np_rng)
             elif isinstance(child_instance, dsl_nodes.ConstInt):
-                child_instance.value = self.np_rng.choice(list(self.dsl.const_int_probs.keys()),
-                                                          p=list(self.dsl.const_int_probs.values()))
-            node.children[i] = child_instance
-            child_instance.parent = node
+                child_instance.value = self.dsl.get_terminal_table('const_int_probs').sample(self.np_rng)
+            node.set_child(i, child_instance)
 
 
     def _mutate_node(self, node_to_mutate):
@@ -276,42 +296,25 @@ class MinigridProgrammaticSpace(ProgrammaticSpace):
         # Like the _fill_children method, we need to handle the boolean features separately
         for i, child in enumerate(node_to_mutate.parent.children):
             if child == node_to_mutate:
-                child_type = node_to_mutate.parent.children_types[i]
-                node_prod_rules = self.dsl.prod_rules[type(node_to_mutate.parent)]
-                child_probs = self.dsl.get_dsl_nodes_probs(child_type)
-                for child_type in child_probs:
-                    if child_type not in node_prod_rules[i]:
-                        child_probs[child_type] = 0.
-                
-                p_list = list(child_probs.values()) / np.sum(list(child_probs.values()))
-                child = self.np_rng.choice(list(child_probs.keys()), p=p_list)
+                child = self.dsl.get_children_table(type(node_to_mutate.parent), i).sample(self.np_rng)
                 child_instance = child()
                 if child.get_number_children() > 0:
-                    curr_seq = get_node_current_sequence(node_to_mutate)
-                    if child_type == dsl_nodes.Concatenate:
-                        curr_seq += 1
-                    else:
-                        curr_seq = 1
+                    # The sequence restarts at the new node
+                    curr_seq = 1
                     curr_height = get_node_current_height(node_to_mutate) + child.get_node_depth()
                     self._fill_children(child_instance, current_height=curr_height, current_sequence=curr_seq,
                         max_height=4, max_sequence=6)
                 elif isinstance(child_instance, dsl_nodes.Action):
-                    child_instance.name = self.np_rng.choice(list(self.dsl.action_probs.keys()),
-                                                             p=list(self.dsl.action_probs.values()))
+                    child_instance.name = self.dsl.get_terminal_table('action_probs').sample(self.np_rng)
                 elif isinstance(child_instance, dsl_nodes.BoolFeature):
-                    child_instance.name = self.np_rng.choice(list(self.dsl.bool_feat_probs.keys()),
-                                                             p=list(self.dsl.bool_feat_probs.values()))
+                    child_instance.name = self.dsl.get_terminal_table('bool_feat_probs').sample(self.np_rng)
                     # case for MinigridObjectFeatureNode and MinigridColorFeatureNode
                     if child_instance.name == 'front_object_type':
                         child_instance = minigrid_node.MinigridObjectFeatureNode('front_object_type')
-                        child_instance.object = self.np_rng.choice(list(self.dsl.obj_feat_probs.keys()),
-                                                                p=list(self.dsl.obj_feat_probs.values()))
+                        child_instance.object = self.dsl.get_terminal_table('obj_feat_probs').sample(self.np_rng)
                     elif child_instance.name == 'front_object_color':
                         child_instance = minigrid_node.MinigridColorFeatureNode('front_object_color')
-                        child_instance.color = self.np_rng.choice(list(self.dsl.color_feat_probs.keys()),
-                                                                p=list(self.dsl.color_feat_probs.values()))
+                        child_instance.color = self.dsl.get_terminal_table('color_feat_probs').sample(self.np_rng)
                 elif isinstance(child_instance, dsl_nodes.ConstInt):
-                    child_instance.value = self.np_rng.choice(list(self.dsl.const_int_probs.keys()),
-                                                              p=list(self.dsl.const_int_probs.values()))
-                node_to_mutate.parent.children[i] = child_instance
-                child_instance.parent = node_to_mutate.parent
+                    child_instance.value = self.dsl.get_terminal_table('const_int_probs').sample(self.np_rng)
+                node_to_mutate.parent.set_child(i, child_instance)
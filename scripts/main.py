@@ -14,7 +14,8 @@ from prog_policies.minigrid.dsl import MinigridDSL
 from prog_policies.karel_tasks import get_task_cls as get_karel_task_cls
 from prog_policies.minigrid_tasks import get_task_cls as get_minigrid_task_cls
 from prog_policies.search_space import get_search_space_cls
-from prog_policies.search_methods import get_search_method_cls
+from prog_policies.search_methods import get_search_method_cls, ParallelEvaluator, EvaluationCache, BehaviorCache
+from prog_policies.base import SubtreeTable, ProgramNormalizer, ProgramAnalyzer
 from prog_policies.utils.save_file import (
     inside_seed_save_log_file,
     outside_seed_save_log_file,
@@ -31,6 +32,7 @@ def karel_env(args):
         "crashable": args.crashable,
         "leaps_behaviour": True,
         "max_calls": 10000,
+        "backend": args.karel_backend,
     }
 
     if (
@@ -52,17 +54,24 @@ def karel_env(args):
 
     task_cls = get_karel_task_cls(args.task)
     task_envs = [task_cls(env_args, i) for i in range(args.num_envs)]
-    return task_envs, dsl
+    return task_envs, dsl, env_args
 
 
 def minigrid_env(args):
     dsl = MinigridDSL()
+
+    env_args = {
+        "crashable": args.crashable,
+        "crash_penalty": args.crash_penalty,
+        "max_calls": args.max_calls,
+    }
+
     task_cls = get_minigrid_task_cls(args.task)
     task_envs = [
-        task_cls(i, args.crashable, args.crash_penalty, args.max_calls)
+        task_cls(i, env_args["crashable"], env_args["crash_penalty"], env_args["max_calls"])
         for i in range(args.num_envs)
     ]
-    return task_envs, dsl
+    return task_envs, dsl, env_args
 
 
 if __name__ == "__main__":
@@ -100,6 +109,101 @@ if __name__ == "__main__":
         help="Max calls for both actions and perceptions.",
     )
     parser.add_argument("--crash_penalty", type=float, default=-0.00)
+    parser.add_argument(
+        "--karel_backend",
+        default="onehot",
+        choices=["onehot", "compact"],
+        help="State representation of the Karel environment",
+    )
+    parser.add_argument(
+        "--batch_evaluation",
+        action="store_true",
+        help="Evaluate each program on all task seeds at once when the task supports it",
+    )
+    parser.add_argument(
+        "--incremental_evaluation",
+        action="store_true",
+        help="Resume the episodes of hill climbing neighbors from checkpoints of the current program",
+    )
+    parser.add_argument(
+        "--early_cutoff",
+        action="store_true",
+        help="Stop evaluating a neighbor once its mean return can no longer beat the current best",
+    )
+    parser.add_argument(
+        "--fidelity_ladder",
+        type=int,
+        nargs="+",
+        default=None,
+        help="Increasing numbers of environments a neighbor must beat the current best on before being "
+        "evaluated on all of them, e.g. 4 16",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=0,
+        help="Worker processes for evaluating neighbors in parallel (0 evaluates sequentially)",
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=16,
+        help="Number of programs sent to a worker at once",
+    )
+    parser.add_argument(
+        "--evaluation_cache",
+        action="store_true",
+        help="Cache program rewards, shared on disk by the seeds of the same task and output name",
+    )
+    parser.add_argument(
+        "--evaluation_cache_size",
+        type=int,
+        default=1000000,
+        help="Maximum number of cached programs (and of subtrees with --intern_subtrees)",
+    )
+    parser.add_argument(
+        "--intern_subtrees",
+        action="store_true",
+        help="Give structurally equal subtrees a shared id, used to compare neighbors and as cache key",
+    )
+    parser.add_argument(
+        "--normalize_programs",
+        action="store_true",
+        help="Evaluate and cache programs in a canonical form with the same episodes",
+    )
+    parser.add_argument(
+        "--normalize_change_calls",
+        action="store_true",
+        help="Also apply normalizations that change the number of environment calls (e.g. merging turns)",
+    )
+    parser.add_argument(
+        "--static_analysis",
+        action="store_true",
+        help="Skip the evaluation of programs whose return is proven from the initial states of the tasks",
+    )
+    parser.add_argument(
+        "--behavior_cache",
+        action="store_true",
+        help="Reuse the reward of an evaluated program that runs the same actions in the first environments "
+        "(ignored with --num_workers > 0, workers evaluate every program in full)",
+    )
+    parser.add_argument(
+        "--behavior_reference_envs",
+        type=int,
+        default=1,
+        help="Number of environments whose action traces identify the behavior of a program",
+    )
+    parser.add_argument(
+        "--behavior_verify_envs",
+        type=int,
+        default=1,
+        help="Number of following environments whose action traces must also match to reuse a reward",
+    )
+    parser.add_argument(
+        "--cache_uncounted_hits",
+        action="store_true",
+        help="Do not count cache hits toward the number of evaluated programs",
+    )
     parser.add_argument(
         "--sigma",
         type=float,
@@ -142,6 +246,13 @@ if __name__ == "__main__":
     # LLM
     parser.add_argument("--temperature", type=float, default=1.0)
     parser.add_argument("--top_p", type=float, default=1.0)
+    parser.add_argument(
+        "--llm_concurrent_requests",
+        type=int,
+        default=1,
+        help="Number of LLM requests sent concurrently, 1 sends them one after the other",
+    )
+    parser.add_argument("--llm_base_url", type=str, default=None)
 
     # Output
     parser.add_argument("--output_dir", type=str, default="output")
@@ -164,9 +275,9 @@ if __name__ == "__main__":
     pathlib.Path(output_dir_seed).mkdir(parents=True, exist_ok=True)
 
     if get_env_name(args.task) == "karel":
-        task_envs, dsl = karel_env(args)
+        task_envs, dsl, env_args = karel_env(args)
     elif get_env_name(args.task) == "minigrid":
-        task_envs, dsl = minigrid_env(args)
+        task_envs, dsl, env_args = minigrid_env(args)
     else:
         assert 0, "Invalid task name."
 
@@ -188,6 +299,37 @@ if __name__ == "__main__":
         )
     else:
         search_method = search_method_cls(args.k, args.e)
+    search_method.batch_evaluation = args.batch_evaluation
+    search_method.incremental_evaluation = args.incremental_evaluation
+    search_method.early_cutoff = args.early_cutoff
+    search_method.fidelity_ladder = args.fidelity_ladder
+    if args.intern_subtrees:
+        search_method.subtree_table = SubtreeTable(args.evaluation_cache_size)
+    if args.normalize_programs or args.normalize_change_calls:
+        search_method.normalizer = ProgramNormalizer(dsl, change_calls=args.normalize_change_calls)
+    if args.static_analysis:
+        search_method.analyzer = ProgramAnalyzer()
+    if args.behavior_cache and args.num_workers == 0:
+        search_method.behavior_cache = BehaviorCache(args.behavior_reference_envs, args.behavior_verify_envs)
+    if args.evaluation_cache:
+        evaluation_cache_path = os.path.join(output_dir, "evaluation_cache.json")
+        search_method.evaluation_cache = EvaluationCache(
+            dsl,
+            args.evaluation_cache_size,
+            count_hits=not args.cache_uncounted_hits,
+            # Settings the tasks were actually built with, the state backend does not change the returns
+            config={
+                "task": args.task,
+                "num_envs": args.num_envs,
+                **{name: value for name, value in env_args.items() if name != "backend"},
+            },
+            subtree_table=search_method.subtree_table,
+        )
+        search_method.evaluation_cache.load(evaluation_cache_path)
+    if args.num_workers > 0:
+        search_method.parallel_evaluator = ParallelEvaluator(
+            search_method, task_envs, dsl, args.num_workers, args.chunk_size
+        )
 
     best_reward = -float("inf")
     best_prog = None
@@ -197,7 +339,8 @@ if __name__ == "__main__":
     log["seed"] = args.seed
 
     llm_program_generator = LLMProgramGenerator(
-        args.seed, args.task, dsl, args.llm_program_num, args.temperature, args.top_p
+        args.seed, args.task, dsl, args.llm_program_num, args.temperature, args.top_p,
+        concurrent_requests=args.llm_concurrent_requests, base_url=args.llm_base_url,
     )
     program_list, llm_log = llm_program_generator.get_program_list_python_to_dsl()
     log["llm_log"] = [llm_log]
@@ -290,3 +433,20 @@ if __name__ == "__main__":
         search_method.record,
         search_method.program_record,
     )
+
+    if search_method.parallel_evaluator is not None:
+        search_method.parallel_evaluator.close()
+    if search_method.evaluation_cache is not None:
+        search_method.evaluation_cache.save(evaluation_cache_path)
+        print(
+            f"Evaluation cache: {search_method.evaluation_cache.hits} hits, {search_method.evaluation_cache.misses} misses"
+        )
+    if search_method.analyzer is not None:
+        print(
+            f"Static analysis: {search_method.analyzer.skipped} evaluations skipped, {search_method.analyzer.bounded} cut off"
+        )
+    if search_method.behavior_cache is not None:
+        print(
+            f"Behavior cache: {search_method.behavior_cache.hits} hits, {search_method.behavior_cache.misses} misses, "
+            f"{search_method.behavior_cache.rejected} rejected by verification"
+        )
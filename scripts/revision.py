@@ -84,6 +84,13 @@ if __name__ == "__main__":
     # LLM
     parser.add_argument("--temperature", type=float, default=1.0)
     parser.add_argument("--top_p", type=float, default=1.0)
+    parser.add_argument(
+        "--llm_concurrent_requests",
+        type=int,
+        default=1,
+        help="Number of LLM requests sent concurrently, 1 sends them one after the other",
+    )
+    parser.add_argument("--llm_base_url", type=str, default=None)
 
     # Output
     parser.add_argument("--output_dir", type=str, default="output")
@@ -156,6 +163,8 @@ if __name__ == "__main__":
         args.action_shots,
         args.perception_shots,
         args.program_shots,
+        args.llm_concurrent_requests,
+        args.llm_base_url,
     )
     program_list, llm_log = llm_program_generator.get_program_list_python_to_dsl()
     log["llm_log"] = [llm_log]
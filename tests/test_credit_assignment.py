@@ -0,0 +1,24 @@
+import sys
+
+sys.path.append(".")
+
+# Imported first, as in scripts/main.py, to avoid the circular import of prog_policies.base
+from prog_policies.utils import get_env_name
+from prog_policies.karel import KarelDSL
+from prog_policies.karel_tasks import get_task_cls
+from prog_policies.search_space import ProgrammaticSpace
+
+
+def test_credit_assignment_on_neighbors():
+    # Neighbors share subtrees with the individual, whose nodes keep their parent links
+    dsl = KarelDSL()
+    env_args = {"env_height": 12, "env_width": 12, "crashable": True, "leaps_behaviour": True, "max_calls": 10000}
+    task = get_task_cls("StairClimber")(env_args, 0)
+    search_space = ProgrammaticSpace(dsl)
+    search_space.set_seed(0)
+    _, individual = search_space.initialize_individual()
+    for _, neighbor in search_space.iter_neighbors(individual, k=50):
+        reward, node_score, node_count = task.evaluate_and_assign_credit(neighbor)
+        assert set(node_score) == set(neighbor.get_all_nodes())
+        assert sum(node_count[node] for node in neighbor.children) == \
+            sum(node_count[node] for node in neighbor.get_all_nodes() if type(node).__name__ == "Action")